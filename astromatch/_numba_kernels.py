@@ -0,0 +1,98 @@
+"""
+Numba implementation of the kernels in ``astromatch.kernels``.
+This module is only imported when the 'numba' backend is selected.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def rayleigh(dist, perr, serr, pidx, sidx, scale):
+    pef = np.empty(len(dist))
+    for i in prange(len(dist)):
+        p = perr[pidx[i]]
+        s = serr[sidx[i]]
+        sigma2 = p**2 + s**2
+        exponent = (-dist[i]**2 / sigma2) * scale
+        pef[i] = np.exp(exponent) / sigma2 * 2 * dist[i]
+
+    return pef
+
+
+@njit(parallel=True, cache=True)
+def normal(dist, perr, serr, pidx, sidx, scale):
+    pef = np.empty(len(dist))
+    for i in prange(len(dist)):
+        p = perr[pidx[i]]
+        s = serr[sidx[i]]
+        sigma2 = p**2 + s**2
+        exponent = (-dist[i]**2 / (2*sigma2)) * scale
+        pef[i] = np.exp(exponent) / (2*np.pi*sigma2)
+
+    return pef
+
+
+@njit(parallel=True, cache=True)
+def grid_lookup(points, start, width, nbins, strides, grid):
+    ndim, npoints = points.shape
+    gvals = np.empty(npoints)
+    for j in prange(npoints):
+        flat = 0
+        inside = True
+        for i in range(ndim):
+            x = (points[i, j] - start[i]) / width[i]
+            # Equivalent to the truncation and clipping of the numpy
+            # backend (NaN and infinite values are outside the grid)
+            if x > -1.0 and x < nbins[i]:
+                flat += int(x) * strides[i]
+            else:
+                inside = False
+
+        gvals[j] = grid[flat] if inside else 0.0
+
+    return gvals
+
+
+@njit(parallel=True, cache=True)
+def segment_sum(values, offsets):
+    nseg = len(offsets)
+    ncols = values.shape[1]
+    result = np.empty((nseg, ncols))
+    for k in prange(nseg):
+        first = offsets[k]
+        last = offsets[k + 1] if k + 1 < nseg else values.shape[0]
+        last = max(last, first + 1)
+        for c in range(ncols):
+            total = values[first, c]
+            for i in range(first + 1, last):
+                total += values[i, c]
+            result[k, c] = total
+
+    return result
+
+
+@njit(parallel=True, cache=True)
+def segment_max(values, offsets):
+    nseg = len(offsets)
+    ncols = values.shape[1]
+    result = np.empty((nseg, ncols))
+    for k in prange(nseg):
+        first = offsets[k]
+        last = offsets[k + 1] if k + 1 < nseg else values.shape[0]
+        last = max(last, first + 1)
+        for c in range(ncols):
+            vmax = values[first, c]
+            for i in range(first + 1, last):
+                v = values[i, c]
+                # NaN values propagate, as in np.maximum
+                if v > vmax or v != v:
+                    vmax = v
+            result[k, c] = vmax
+
+    return result
@@ -3,56 +3,45 @@ Functions for statistics calculations following the Broos et al. 2006 method.
 
 @author: A.Ruiz
 """
+import warnings
+
 import numpy as np
 from astropy.table import Table
 
+from .sweep import ThresholdSweep, cutoff_grid
 
-def set_stats_table(ncutoff=101, mincutoff=0.0, maxcutoff=10.0):
-    stats = Table()
-    stats["cutoff"] = np.linspace(mincutoff, maxcutoff, num=ncutoff)
-    stats["false_positives"] = [0] * ncutoff    # FP
-    stats["true_negatives"] = [0] * ncutoff     # TN
-    stats["correct_matches"] = [0] * ncutoff    # CM
-    stats["incorrect_matches"] = [0] * ncutoff  # IM
-    stats["false_negatives"] = [0] * ncutoff    # FN
-
-    return stats
-
-
-def _count_true_negatives_base(match):
-    # Number of primary sources with no match
-    # This base number have to be corrected including
-    # the number of rejected matches after applying a cutoff
-    mask_true_negatives_base = np.logical_and(
-        match["ncat"] == 1, match["match_flag"] == 1
-    )
-
-    return len(match[mask_true_negatives_base])
 
+# Columns of the statistics table counted in each Monte Carlo iteration
+MC_COLUMNS = [
+    "false_positives",
+    "true_negatives",
+    "correct_matches",
+    "incorrect_matches",
+    "false_negatives",
+]
 
-def _count_true_negatives_correction(match, cutoff, cutoff_column):
-    # Number of primary sources with a match but below the cutoff limit
-    # This correction have to be added to the true negatives base number
-    mask_below_cutoff = match[cutoff_column] <= cutoff
 
-    mask_true_negatives_correction = np.logical_and(
-        match["ncat"] == 2, match["match_flag"] == 1
-    )
-    mask_true_negatives_correction = np.logical_and(
-        mask_below_cutoff, mask_true_negatives_correction
-    )
+def set_stats_table(ncutoff=101, mincutoff=0.0, maxcutoff=10.0, cutoffs=None):
+    # If `cutoffs` is None, they are set with ncutoff, mincutoff and
+    # maxcutoff (see ``sweep.cutoff_grid``)
+    if cutoffs is None:
+        cutoffs = cutoff_grid(ncutoff, mincutoff, maxcutoff)
 
-    return len(match[mask_true_negatives_correction])
+    stats = Table()
+    stats["cutoff"] = cutoffs
+    for col in MC_COLUMNS:
+        stats[col] = np.zeros(len(cutoffs), dtype=int)
 
+    return stats
 
-def _count_false_positives(match, cutoff, cutoff_column):
-    # Number of primary sources with a match above the cutoff limit
-    mask_above_cutoff = match[cutoff_column] > cutoff
 
-    mask_false_positives = np.logical_and(match["ncat"] == 2, match["match_flag"] == 1)
-    mask_false_positives = np.logical_and(mask_above_cutoff, mask_false_positives)
+def _primary_sweep(match, cutoff_column):
+    # Sweep over the cutoff column for primary matches
+    # (match_flag == 1), and the flags of these matches.
+    primary = match[match["match_flag"] == 1]
+    sweep = ThresholdSweep(primary[cutoff_column])
 
-    return len(match[mask_false_positives])
+    return primary, sweep
 
 
 def stats_isolated_pop(match, stats, cutoff_column):
@@ -60,74 +49,18 @@ def stats_isolated_pop(match, stats, cutoff_column):
     Statistics for the isolated population:
     true negatives and false positives.
     """
-    stats["true_negatives"] = _count_true_negatives_base(match)
-
-    for i, lrlim in enumerate(stats['cutoff']):
-        stats["false_positives"][i] = _count_false_positives(
-            match, lrlim, cutoff_column
-        )
-        stats["true_negatives"][i] += _count_true_negatives_correction(
-            match, lrlim, cutoff_column
-        )
-
-    return stats
-
+    primary, sweep = _primary_sweep(match, cutoff_column)
+    is_match = primary["ncat"] == 2
 
-def _count_false_negatives_base(match):
-    # Number of primary sources without a match in the fake counterparts catalogue
-    # This number has to be corrected by the number of rejected correct matches
-    # when a cutoff is applied to the match.
-    mask_false_negatives_base = np.logical_and(
-        match["match_flag"] == 1, match["ncat"] == 1
-    )
+    # Primary sources with a match above the cutoff limit
+    stats["false_positives"] = sweep.above(stats["cutoff"], is_match)
 
-    return len(match[mask_false_negatives_base])
+    # Primary sources with no match, plus those with a match
+    # below the cutoff limit
+    stats["true_negatives"] = np.count_nonzero(primary["ncat"] == 1)
+    stats["true_negatives"] += sweep.below(stats["cutoff"], is_match)
 
-
-def _count_false_negatives_correction(match, cutoff, cutoff_column, pcat_id, scat_id):
-    # Number of correct matches in the fake counterparts catalogue rejected
-    # when a cutoff is applied to the match. This has to be added to the
-    # base number of false negatives.
-    mask_below_cutoff = match[cutoff_column] <= cutoff
-
-    mask_false_negatives_correction = np.logical_and(
-        match["match_flag"] == 1, match[pcat_id] == match[scat_id]
-    )
-    mask_false_negatives_correction = np.logical_and(
-        mask_below_cutoff, mask_false_negatives_correction
-    )
-
-    return len(match[mask_false_negatives_correction])
-
-
-def _count_correct_matches(match, cutoff, cutoff_column, pcat_id, scat_id):
-    # Number of correct matches in the fake counterparts catalogue
-    # above a given cutoff
-    mask_above_cutoff = match[cutoff_column] > cutoff
-
-    mask_correct_matches = np.logical_and(
-        match["match_flag"] == 1,
-        match[pcat_id] == match[scat_id]
-    )
-    mask_correct_matches = np.logical_and(mask_above_cutoff, mask_correct_matches)
-
-    return len(match[mask_correct_matches])
-
-
-def _count_incorrect_matches(match, cutoff, cutoff_column, pcat_id, scat_id):
-    # Number of incorrect matches in the fake counterparts
-    # catalogue above a given cutoff
-    mask_above_cutoff = match[cutoff_column] > cutoff
-
-    mask_incorrect_matches = np.logical_and(
-        match["match_flag"] == 1, match[pcat_id] != match[scat_id]
-    )
-    mask_incorrect_matches = np.logical_and(
-        mask_incorrect_matches, match["ncat"] == 2
-    )
-    mask_incorrect_matches = np.logical_and(mask_above_cutoff, mask_incorrect_matches)
-
-    return len(match[mask_incorrect_matches])
+    return stats
 
 
 def stats_associated_pop(match, stats, cutoff_column, pcat_id, scat_id):
@@ -135,53 +68,21 @@ def stats_associated_pop(match, stats, cutoff_column, pcat_id, scat_id):
     Statistics for the associated population:
     correct matches, incorrect matches and false negatives.
     """
-    stats["false_negatives"] = _count_false_negatives_base(match)
-
-    for i, cutoff in enumerate(stats['cutoff']):
-        stats["correct_matches"][i] = _count_correct_matches(
-            match, cutoff, cutoff_column, pcat_id, scat_id
-        )
-        stats["incorrect_matches"][i] = _count_incorrect_matches(
-            match, cutoff, cutoff_column, pcat_id, scat_id
-        )
-        stats["false_negatives"][i] += _count_false_negatives_correction(
-            match, cutoff, cutoff_column, pcat_id, scat_id
-        )
+    primary, sweep = _primary_sweep(match, cutoff_column)
+    is_correct = primary[pcat_id] == primary[scat_id]
+    is_incorrect = np.logical_and(~is_correct, primary["ncat"] == 2)
 
-    return stats
-
-
-def _count_negative_matches_base(match):
-    # Number of sources with no match in the actual crossmatch results.
-    # This has to be corrected by the number of rejected matches
-    # when a cutoff is applied.
-    mask_negative_matches_base = np.logical_and(
-        match["match_flag"] == 1, match["ncat"] == 1
-    )
-
-    return len(match[mask_negative_matches_base])
-
-
-def _count_negative_matches_correction(match, cutoff, cutoff_column):
-    mask_below_cutoff = match[cutoff_column] <= cutoff
-
-    mask_negative_matches_correction = np.logical_and(
-        match["ncat"] == 2, match["match_flag"] == 1
-    )
-    mask_negative_matches_correction = np.logical_and(
-        mask_below_cutoff, mask_negative_matches_correction
-    )
+    # Correct and incorrect matches in the fake
+    # counterparts catalogue above the cutoff limit
+    stats["correct_matches"] = sweep.above(stats["cutoff"], is_correct)
+    stats["incorrect_matches"] = sweep.above(stats["cutoff"], is_incorrect)
 
-    return len(match[mask_negative_matches_correction])
+    # Primary sources without a match in the fake counterparts catalogue,
+    # plus correct matches rejected when the cutoff is applied
+    stats["false_negatives"] = np.count_nonzero(primary["ncat"] == 1)
+    stats["false_negatives"] += sweep.below(stats["cutoff"], is_correct)
 
-
-def _count_positive_matches(match, cutoff, cutoff_column):
-    mask_above_cutoff = match[cutoff_column] > cutoff
-
-    mask_positive_matches = np.logical_and(match["ncat"] == 2, match["match_flag"] == 1)
-    mask_positive_matches = np.logical_and(mask_above_cutoff, mask_positive_matches)
-
-    return len(match[mask_positive_matches])
+    return stats
 
 
 def _completeness(fstats):
@@ -217,16 +118,14 @@ def stats_global_pop(match, stats, cutoff_column, ntest):
     for col in stats.colnames[1:]:
         stats[col] = stats[col] / ntest
 
-    stats["negative_matches"] = _count_negative_matches_base(match)
-    stats["positive_matches"] = 0
+    primary, sweep = _primary_sweep(match, cutoff_column)
+    is_match = primary["ncat"] == 2
 
-    for i, cutoff in enumerate(stats['cutoff']):
-        stats["positive_matches"][i] = _count_positive_matches(
-            match, cutoff, cutoff_column
-        )
-        stats["negative_matches"][i] += _count_negative_matches_correction(
-            match, cutoff, cutoff_column
-        )
+    # Sources with no match in the actual crossmatch or rejected by
+    # the cutoff, and sources with a match above the cutoff limit
+    stats["negative_matches"] = np.count_nonzero(primary["ncat"] == 1)
+    stats["negative_matches"] += sweep.below(stats["cutoff"], is_match)
+    stats["positive_matches"] = sweep.above(stats["cutoff"], is_match)
 
     stats["frac_assoc_pop"] = _frac_associated_pop(stats)
     stats["completeness"] = _completeness(stats)
@@ -235,3 +134,50 @@ def stats_global_pop(match, stats, cutoff_column, ntest):
     stats["CR"] = stats["completeness"] + stats["error_rate"]
 
     return stats
+
+
+def stats_bootstrap(stats, iter_stats, nboot=1000, seed=None):
+    """
+    Bootstrap uncertainties for the statistics that depend on the Monte Carlo
+    iterations (frac_assoc_pop, error_rate and reliability). The iterations
+    are resampled with replacement `nboot` times and the statistics are
+    recalculated for each resample. The uncertainties are the standard
+    deviations of the resampled statistics.
+
+    `stats` is the final statistics table (see ``stats_global_pop``) and
+    `iter_stats` is a list with the statistics table of each iteration.
+    """
+    ntest = len(iter_stats)
+    rng = np.random.default_rng(seed)
+
+    # Each resample is defined by the number of times each iteration
+    # is drawn, so the mean counts of all resamples are a matrix product
+    weights = rng.multinomial(ntest, np.full(ntest, 1/ntest), size=nboot) / ntest
+
+    boot = {}
+    for col in MC_COLUMNS:
+        counts = np.array([s[col] for s in iter_stats], dtype=float)
+        boot[col] = weights @ counts
+
+    boot["negative_matches"] = np.asarray(stats["negative_matches"])
+    boot["positive_matches"] = np.asarray(stats["positive_matches"])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        boot["frac_assoc_pop"] = _frac_associated_pop(boot)
+        error_rate = _error_rate(boot)
+
+    stats["frac_assoc_pop_err"] = _nanstd(boot["frac_assoc_pop"])
+    stats["error_rate_err"] = _nanstd(error_rate)
+    stats["reliability_err"] = stats["error_rate_err"]
+
+    return stats
+
+
+def _nanstd(values):
+    # Standard deviation of the finite values along the first axis
+    values = np.where(np.isfinite(values), values, np.nan)
+
+    with warnings.catch_warnings():
+        # All-nan columns (e.g. no positive matches) give nan
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanstd(values, axis=0)
@@ -12,29 +12,40 @@ from io import open
 import os
 import warnings
 import tempfile
-import subprocess
-from copy import deepcopy
+from copy import copy
 from string import ascii_uppercase
 
 import numpy as np
 from astropy import log
 from astropy import units as u
 from astropy.coordinates import SkyCoord
+from astropy.io import fits
 #from astropy.utils.misc import ShapedLikeNDArray
-from astropy.table import Table, join, setdiff, unique, vstack
+from astropy.table import Table, Column, unique, vstack
 from astropy.units.quantity import Quantity
 from astropy.utils.misc import indent
 from astropy.utils.exceptions import AstropyUserWarning
 from mocpy import MOC
 
+from .spatial import SpatialIndex, coords_fingerprint
+
 
 # Global
 ALLSKY_AREA_DEG = (4*np.pi * u.rad**2).to(u.deg**2)
 
+# Files read by columns (see Catalogue._read_data)
+FITS_EXTENSIONS = ['.fits', '.fit', '.fts']
+ARROW_EXTENSIONS = ['.parquet', '.pq', '.arrow', '.feather']
+
 
 class SkyCoordErr(object):
     """
     A class for the positional errors of a SkyCoord object    
+
+    The error components are stored in a (N, k) float array, a column
+    per component in a fixed unit, so selecting the errors of any set of
+    sources is a single indexing operation of the array. The components
+    of the covariance matrix are calculated once and kept with the errors.
     """
     # TODO: Use ShapedLikeNDArray as base object
     ERRTYPE = ['circle', 'ellipse', 'rcd_dec_ellipse',
@@ -43,7 +54,9 @@ class SkyCoordErr(object):
     def __init__(self, data, errtype='circle', unit=None, errsys=None, check=True):
 
         self.errtype = self._set_errtype(errtype)
-        self.components = self._set_components(data, unit)
+        self._names, self._units, self._values = self._set_components(data, unit)
+        self._covariance = None
+        self._covariance_array = None
 
         if errsys is not None:
             self.add_syserr(errsys)
@@ -52,25 +65,56 @@ class SkyCoordErr(object):
             self._check_components()
         
     def __repr__(self):
-        comp_str = ', '.join(self.components.colnames)
-        unit_str = ', '.join([str(col.unit) for col in self.components.itercols()])
+        comp_str = ', '.join(self._names)
+        unit_str = ', '.join([str(unit) for unit in self._units])
         data_str = indent(str(self.components.as_array()))
         err_str = '<SkyCoordErr ({}): ({}) in {}\n{}>'
 
         return err_str.format(self.errtype, comp_str, unit_str, data_str)
 
     def __getitem__(self, key):
-        item_data = self.components[key]
-        if not isinstance(item_data, Table):
-            # We do this because when key is an integer and the components
-            # only have one column, it returns components[key] returns a row
-            # instead of a Table.
-            item_data = self.components[key:key+1]
+        if isinstance(key, (int, np.integer)):
+            # An integer selects a single source, but we keep a
+            # (1, k) array of components
+            key = slice(key, key + 1 or None)
+
+        item = object.__new__(SkyCoordErr)
+        item.errtype = self.errtype
+        item._names = self._names
+        item._units = self._units
+        if isinstance(key, slice):
+            item._values = self._values[key]
+        else:
+            # np.take is much faster than indexing the rows with an array
+            key = np.asarray(key)
+            if key.dtype == bool:
+                key = np.flatnonzero(key)
+
+            item._values = np.take(self._values, key, axis=0)
+
+        # Slices of the covariance components are views, other selections
+        # are calculated again when needed
+        item._covariance = None
+        item._covariance_array = None
+        if self._covariance is not None and isinstance(key, slice):
+            item._covariance = tuple(c[key] for c in self._covariance)
 
-        return SkyCoordErr(item_data, errtype=self.errtype, check=False)
+        return item
 
     def __len__(self):
-        return len(self.components)
+        return len(self._values)
+
+    @property
+    def components(self):
+        """
+        Astropy ``Table`` with the error components, a column for each
+        component. Columns are views of the error values.
+        """
+        columns = [
+            Column(self._values[:, i], name=name, unit=unit, copy=False)
+            for i, (name, unit) in enumerate(zip(self._names, self._units))
+        ]
+        return Table(columns, copy=False)
 
     def transform_to(self, errtype='ellipse'):
         """
@@ -99,18 +143,14 @@ class SkyCoordErr(object):
 
     def as_array(self):
         """
-        Return error values as a numpy array.
+        Return error values as a numpy array. For circular errors this is
+        a ``Quantity`` (a view of the error values), otherwise a (k, N)
+        array with a row per component.
         """
-        errs = self.components
         if self.errtype == 'circle':
-            #err_arrays = errs.columns[0].data << errs.columns[0].unit
-            err_arrays = errs.columns[0].data * errs.columns[0].unit
+            err_arrays = u.Quantity(self._values[:, 0], self._units[0], copy=False)
         else:
-            err_arrays = []
-            for col in errs.itercols():
-                #err_arrays.append(col.data << col.unit)
-                err_arrays.append(col.data * u.Unit(col.unit))
-            err_arrays = np.array(err_arrays)
+            err_arrays = np.array(self._values.T)
 
         return err_arrays
 
@@ -128,17 +168,38 @@ class SkyCoordErr(object):
 
         return V
 
+    def covariance_array(self):
+        """
+        Returns a (N, 3) ``Quantity`` with the independent elements of
+        the covariance matrix of each source: the variances along RA and
+        Dec and the covariance, in squared units of the errors.
+        """
+        if self._covariance_array is None:
+            sigma_x, sigma_y, rhoxy = self._covariance_components()
+            unit = sigma_x.unit**2
+
+            cov = np.empty((len(self), 3))
+            cov[:, 0] = (sigma_x**2).to_value(unit)
+            cov[:, 1] = (sigma_y**2).to_value(unit)
+            cov[:, 2] = rhoxy.to_value(unit)
+
+            self._covariance_array = u.Quantity(cov, unit, copy=False)
+
+        return self._covariance_array
+
     def add_syserr(self, syserr):
         """
         Add systematic to the error components. Only works for circular errors.
         """
         if self.errtype == 'circle':
-            data = self.components.columns[0].data
-            unit = self.components.columns[0].unit
-            err = data * u.Unit(unit)
+            err = self.as_array()
 
-            errcol = self.components.colnames[0]
-            self.components[errcol] = np.sqrt(syserr**2 + err**2)
+            # New array, since the values can be shared with other objects
+            values = np.empty_like(self._values)
+            values[:, 0] = np.sqrt(syserr**2 + err**2).to_value(self._units[0])
+            self._values = values
+            self._covariance = None
+            self._covariance_array = None
 
         else:
             raise NotImplementedError
@@ -154,20 +215,24 @@ class SkyCoordErr(object):
 
     def _set_components(self, data, unit=None):
         """
-        Define an astropy table with statistical positional errors
-        (no systematic errors applied here). The number of columns depends
-        on what kind of errors are defined
+        Define an array with statistical positional errors (no systematic
+        errors applied here), with a column for each component, in the units
+        of `unit`. The number of columns depends on what kind of errors are
+        defined. Returns the names and units of the components and the array.
         """
         
         if unit is None:        
             unit = self._get_default_units()
 
-        poserr = Table()
-        for col, col_unit in zip(data.colnames, unit):
+        names = list(data.colnames[:len(unit)])
+        units = [u.Unit(col_unit) for col_unit in unit[:len(names)]]
+
+        values = np.empty((len(data), len(names)))
+        for i, (col, col_unit) in enumerate(zip(names, units)):
             if data[col].unit is None:
-                poserr[col] = data[col]*col_unit
+                values[:, i] = data[col]
             else:
-                poserr[col] = data[col].to(col_unit)
+                values[:, i] = data[col].to(col_unit)
 
 #            # Set bad values to zero
 #            good_mask = np.isfinite(poserr[col])
@@ -176,21 +241,19 @@ class SkyCoordErr(object):
 #            negative_mask = poserr[col] < 0
 #            poserr[col][negative_mask] = 0.0
 
-        return poserr
+        return names, units, values
 
     def _check_components(self):
         """
         Check that all errors are positive and finite (not nan or inf)
         """
-        for i, col in enumerate(self.components.colnames):
-            if i >= 2:
-                break
+        errs = self._values[:, :2]
+
+        if not np.all(np.isfinite(errs)):
+            raise ValueError('Some positional errors are not finite!')
             
-            if not all(np.isfinite(self.components[col])):
-                raise ValueError('Some positional errors are not finite!')
-                
-            if not all(self.components[col] > 0):
-                raise ValueError('Some positional errors are non positive!')
+        if not np.all(errs > 0):
+            raise ValueError('Some positional errors are non positive!')
 
     def _get_default_units(self):
         """
@@ -256,26 +319,34 @@ class SkyCoordErr(object):
 
     def _covariance_components(self):
         """
-        Calculate the components of the covariance matrix from the errors
+        Calculate the components of the covariance matrix from the errors.
+        They are calculated once and kept for later calls.
         """
-        npars = len(self.components.colnames)
-        errs = self.components
+        if self._covariance is None:
+            self._covariance = self._calc_covariance_components()
+
+        return self._covariance
+
+    def _calc_covariance_components(self):
+        npars = len(self._names)
+        errs = [
+            u.Quantity(self._values[:, i], unit, copy=False)
+            for i, unit in enumerate(self._units)
+        ]
 
         if self.errtype == "circle":
             if npars != 1:
                 raise ValueError('Wrong error type!')
             else:
-                sigma_x = np.array(errs.columns[0])*errs.columns[0].unit
-                sigma_y = np.array(errs.columns[0])*errs.columns[0].unit
-                rhoxy = np.zeros(len(sigma_x))*errs.columns[0].unit**2
+                sigma_x = errs[0]
+                sigma_y = errs[0]
+                rhoxy = np.zeros(len(sigma_x))*errs[0].unit**2
                             
         elif self.errtype == "ellipse":
             if npars != 3:
                 raise ValueError('Wrong error type!')
             else:
-                err0 = np.array(errs.columns[0])*errs.columns[0].unit
-                err1 = np.array(errs.columns[1])*errs.columns[1].unit
-                err2 = np.array(errs.columns[2])*errs.columns[2].unit
+                err0, err1, err2 = errs
 
                 sigma_x = np.sqrt((err0*np.sin(err2))**2 + 
                                   (err1*np.cos(err2))**2)
@@ -287,25 +358,21 @@ class SkyCoordErr(object):
             if npars != 2:
                 raise ValueError('Wrong error type!')
             else:
-                sigma_x = np.array(errs.columns[0])*errs.columns[0].unit
-                sigma_y = np.array(errs.columns[1])*errs.columns[1].unit
-                rhoxy = np.zeros(len(sigma_x))*errs.columns[0].unit**2
+                sigma_x = errs[0]
+                sigma_y = errs[1]
+                rhoxy = np.zeros(len(sigma_x))*errs[0].unit**2
 
         elif self.errtype == "cov_ellipse":
             if npars != 3:
                 raise ValueError('Wrong error type!')
             else:
-                sigma_x = np.array(errs.columns[0])*errs.columns[0].unit
-                sigma_y = np.array(errs.columns[1])*errs.columns[1].unit
-                rhoxy = np.array(errs.columns[2])*errs.columns[2].unit
+                sigma_x, sigma_y, rhoxy = errs
 
         elif self.errtype == "cor_ellipse":
             if npars != 3:
                 raise ValueError('Wrong error type!')
             else:
-                err0 = np.array(errs.columns[0])*errs.columns[0].unit
-                err1 = np.array(errs.columns[1])*errs.columns[1].unit
-                err2 = np.array(errs.columns[2])*errs.columns[2].unit
+                err0, err1, err2 = errs
 
                 sigma_x = err0
                 sigma_y = err1
@@ -379,7 +446,9 @@ class Catalogue(object):
         to a file containing the catalogue data in a format compatible with
         Astropy (fits, csv, VOTable, etc) can be passed. It should contain at
         least three columns: the identification labels of the sources and their
-        coordinates (e.g. RA and Dec).
+        coordinates (e.g. RA and Dec). Only the columns used by the catalogue
+        are read. FITS binary tables are memory-mapped, and Parquet or Arrow
+        (Feather) files are read by columns (this needs pyarrow).
     area : ``str``, ``MOC`` or ``Quantity``
         Sky area covered by the catalogue. the area can be defined as a path
         to the catalogue MOC, a mocpy ``MOC`` object or an Astropy ``Quantity``
@@ -421,7 +490,11 @@ class Catalogue(object):
     area : Astropy ``Quantity``
         Sky area covered by the catalogue in square deg.
     mags : Astropy ``Table`` or ``None``
-        Source magnitudes.
+        Source magnitudes. They are loaded the first time they are used.
+    index : ``SpatialIndex``
+        Spatial index of the catalogue coordinates, used for neighbour
+        searches. It is built the first time is needed, unless a
+        previously built index is passed through ``set_index``.
     """
 
     def __init__(self, data_table, area, name=None, id_col=None,
@@ -429,15 +502,23 @@ class Catalogue(object):
                  poserr_cols=['RADEC_ERR'], poserr_type='circle',
                  mag_cols=None):
 
+        self._index = None
+        self._id_index = None
+        self._knn = None
+        self._mags = None
+        self._mag_data = None
+        self._mag_rows = None
         self.name = self._set_name(name, data_table)
 
         # if data_table is a string, assumes it is the path to the data file
         if isinstance(data_table, str):
-            data_table = Table.read(data_table)
+            data_table = self._read_data(
+                data_table, id_col, coord_cols, poserr_cols, mag_cols
+            )
             
         self.ids = self._set_ids(data_table, id_col)
         self.coords = self._set_coords(data_table, coord_cols, frame)
-        self.mags = self._set_mags(data_table, mag_cols)
+        self._mag_data = self._mag_columns(data_table, mag_cols)
         self.area, self.moc = self._set_area(area)
         self.poserr = self._set_poserr(data_table, poserr_cols, poserr_type)
 
@@ -452,12 +533,22 @@ class Catalogue(object):
         return str(self.save(filename=None))
 
     def __getitem__(self, key):
-        newcat = deepcopy(self)
+        # The new catalogue shares the metadata (name, area, MOC...) with
+        # this one. Only the data of the selected sources are copied.
+        newcat = copy(self)
         newcat.ids = self.ids[key]
         newcat.coords = self.coords[key]
         newcat.poserr = self.poserr[key]
 
-        if self.mags is not None:
+        if self._mag_data is not None:
+            # Magnitudes not loaded yet, we keep the selected rows
+            rows = self._mag_rows
+            if rows is None:
+                rows = np.arange(len(self._mag_data))
+
+            newcat._mag_rows = rows[key]
+
+        elif self.mags is not None:
             newcat.mags = self.mags[key]
 
         return newcat
@@ -466,6 +557,101 @@ class Catalogue(object):
     def poserr_type(self):
         return self.poserr.errtype
 
+    @property
+    def ids(self):
+        return self._ids
+
+    @ids.setter
+    def ids(self, value):
+        # The index of the ids is no longer valid for the new ids
+        self._ids = value
+        self._id_index = None
+
+    @property
+    def mags(self):
+        # Magnitudes are selected and cleaned (see _set_mags) the first
+        # time they are used, so they are not loaded if not needed.
+        if self._mag_data is not None:
+            data = self._mag_data
+            if self._mag_rows is not None:
+                data = data[self._mag_rows]
+
+            self.mags = self._set_mags(data)
+
+        return self._mags
+
+    @mags.setter
+    def mags(self, value):
+        self._mags = value
+        self._mag_data = None
+        self._mag_rows = None
+
+    @property
+    def coords(self):
+        return self._coords
+
+    @coords.setter
+    def coords(self, value):
+        # The spatial index (and the nearest neighbours used for fake
+        # catalogues) are no longer valid for the new coordinates
+        self._coords = value
+        self._index = None
+        self._knn = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = SpatialIndex(self.coords)
+
+        return self._index
+
+    def set_index(self, index, memmap=True):
+        """
+        Set the spatial index of the catalogue.
+
+        Parameters
+        ----------
+        index : ``SpatialIndex`` or ``str``
+            Spatial index of the catalogue coordinates, or the path
+            to a file where the index was saved.
+        memmap : ``bolean``, optional
+            If ``True`` and `index` is a path, the index is memory-mapped.
+            Defaults to ``True``.
+
+        The fingerprint of the index is checked against the coordinates
+        of the catalogue, so an index built for a different catalogue
+        (or a different version of it) is rejected.
+        """
+        if isinstance(index, str):
+            index = SpatialIndex.load(index, memmap=memmap)
+
+        if len(index) != len(self):
+            raise ValueError('The index and the catalogue have different lengths!')
+
+        if index.fingerprint != coords_fingerprint(self.coords):
+            raise ValueError('The index was not built for the coordinates of this catalogue!')
+
+        self._index = index
+
+    def build_index(self, filename=None, order=20):
+        """
+        Build the spatial index of the catalogue and, optionally,
+        save it into a file for later use (see ``set_index``).
+
+        Parameters
+        ----------
+        filename : ``str`` or ``None``, optional
+            Path of the index file. If ``None``, the index is not saved.
+        order : ``int``, optional
+            HEALPix order of the index. Defaults to 20.
+        """
+        self._index = SpatialIndex(self.coords, order=order)
+
+        if filename is not None:
+            self._index.save(filename)
+
+        return self._index
+
     def apply_moc(self, moc, outside=False):
         """
         Returns a new ``Catalogue`` including only sources
@@ -535,19 +721,14 @@ class Catalogue(object):
         ids : ``list``
             List of ids to be selected.
         """
-        catids = Table()
-        catids['ID'] = self.ids
-        catids['IDX'] = range(len(self.ids))
+        rows, found = self._id_rows(ids)
 
-        newids = Table()
-        newids['ID'] = ids#.columns[0]
-        newids['newIDX'] = range(len(ids))
-        
-        joincat = join(newids, catids, keys='ID', join_type='left')
-        joincat.sort('newIDX') # This way we always get the same row order as in ids
-        joinidx = joincat['IDX'].data
-        
-        return self[joinidx]
+        if not np.all(found):
+            raise ValueError(
+                '{} ids not found in the catalogue!'.format(np.sum(~found))
+            )
+
+        return self[rows]
 
     def remove_by_id(self, ids):
         """
@@ -558,18 +739,57 @@ class Catalogue(object):
         ids : ``list`` or ``Column``
             List of ids to be selected.
         """
-        catids = Table()
-        catids['ID'] = self.ids
-        catids['IDX'] = range(len(self.ids))
+        rows, found = self._id_rows(ids)
 
-        rmids = Table()
-        rmids['ID'] = ids
-        rmids['newIDX'] = range(len(ids))
+        keep = np.ones(len(self), dtype=bool)
+        keep[rows[found]] = False
 
-        rmcat_ids = setdiff(catids, rmids, keys='ID')
-        rmcat_ids.sort('IDX')
+        return self[np.flatnonzero(keep)]
 
-        return self.select_by_id(rmcat_ids['ID'])
+    def rows_by_id(self, ids):
+        """
+        Rows in the catalogue of the sources with ids equal to `ids`, or -1
+        for ids not found in the catalogue.
+
+        Rows are dense integer codes of the sources, and ``ids`` is the
+        look-up table from these codes to the original labels. Hence
+        sources in match tables can be handled as integers (for sorting,
+        grouping...) and labeled only when needed.
+
+        Parameters
+        ----------
+        ids : ``list`` or ``Column``
+            List of ids to be found. Masked ids are not found.
+        """
+        rows, found = self._id_rows(ids)
+        found = np.logical_and(found, ~np.ma.getmaskarray(ids))
+
+        return np.where(found, rows, -1)
+
+    def _id_rows(self, ids):
+        # Rows of the sources with `ids`, and a boolean array flagging the
+        # ids found in the catalogue. Ids are assumed to be unique. The
+        # look-up uses the sorted ids of the catalogue, which are built
+        # once and reused until the ids of the catalogue change.
+        if self._id_index is None:
+            catids = np.asarray(self.ids)
+            sorter = np.argsort(catids, kind='stable')
+            self._id_index = (sorter, catids[sorter])
+
+        sorter, sorted_ids = self._id_index
+
+        ids = np.asarray(ids)
+        if ids.dtype.kind != sorted_ids.dtype.kind:
+            ids = ids.astype(sorted_ids.dtype.kind)
+
+        if len(sorted_ids) == 0:
+            return np.zeros(len(ids), dtype=int), np.zeros(len(ids), dtype=bool)
+
+        pos = np.searchsorted(sorted_ids, ids)
+        pos[pos == len(sorted_ids)] = 0
+        found = sorted_ids[pos] == ids
+
+        return sorter[pos], found
 
     def join(self, cat, name=None):
         """
@@ -624,9 +844,14 @@ class Catalogue(object):
         numrepeat : ``int``, optional
             The total number of sources in the new catalogue is `numrepeat`
             times the number of sources in the original catalogue. Defaults to
-            10. If `numrepeat` is 1, the nway library is used to create a
-            random catalogue with the same number of sources and preserving
-            the spatial structure.
+            10. If `numrepeat` is 1, the new catalogue contains the same
+            sources (ids and positional errors) moved to random positions,
+            preserving the spatial structure (see ``_fake_coords``).
+        seed : ``int`` or ``None``, optional
+            Seed for the random generator. Defaults to ``None``.
+
+        See ``RandomPositions`` for random positions generated in blocks,
+        without building a catalogue.
         """
         if self.moc is None:
             area = self.area
@@ -634,20 +859,14 @@ class Catalogue(object):
             area = self.moc
 
         if numrepeat == 1:
-            # Use nway tool to generate a random catalogue: 
+            # Fake catalogue with the same sources, moved to random
+            # positions between each source and one of its neighbours:
             # good balance between reproducing local structures
             # and filling the field.
-            r_min = r_min.to(u.arcsec).value
-            poserr_cols = self.poserr.components.colnames
+            rnd_cat = self[:]
+            rnd_cat.coords = self._fake_coords(r_min, seed)
+            rnd_cat.mags = None
 
-            with tempfile.NamedTemporaryFile() as input_file:
-                filename = input_file.name
-                self.save(filename)
-                
-                rnd_cat_data = self._nway_fake_catalogue(filename, radius=r_min)
-                rnd_cat = Catalogue(
-                    rnd_cat_data, area=area, poserr_cols=poserr_cols, name=self.name
-                )
         else:
             # Use seed != None only for testing, to obtain the same random catalogue        
             ra, dec = self._random_coords(
@@ -672,11 +891,14 @@ class Catalogue(object):
 
         return rnd_cat
 
-    def set_fake_counterparts(self, candidates):
+    def set_fake_counterparts(self, candidates, seed=None):
         from scipy.stats import rayleigh
-        
+
+        # `seed` can be anything accepted by numpy.random.default_rng
+        rng = np.random.default_rng(seed)
+
         # Assign fake counterparts
-        idx_fake = np.random.choice(len(candidates), len(self))
+        idx_fake = rng.choice(len(candidates), len(self))
         cat_fake = candidates[idx_fake]
 
         # Calculate coordinates for fake candidates
@@ -695,8 +917,8 @@ class Catalogue(object):
             (cat_fake_poserr_circ.components.columns[0].to(u.deg))**2
         )
 
-        dr = rayleigh.rvs(loc=0.0, scale=sig_fake.value)
-        theta = 2 * np.pi * np.random.random_sample(size=len(cat_fake))
+        dr = rayleigh.rvs(loc=0.0, scale=sig_fake.value, random_state=rng)
+        theta = 2 * np.pi * rng.random(size=len(cat_fake))
 
         coords_ra_fake = mean_ra_fake + dr * np.cos(theta)
         coords_dec_fake = mean_dec_fake + dr * np.sin(theta)
@@ -836,7 +1058,29 @@ class Catalogue(object):
                           unit='deg', frame=frame)
         return coords.icrs
 
-    def _set_mags(self, data_table, mag_cols):
+    def _mag_columns(self, data_table, mag_cols):
+        # Table with the magnitude columns of data_table. Columns are not
+        # copied, so for memory-mapped files they are read only when
+        # the magnitudes are used.
+        if mag_cols is not None:
+            mag_cols1d = self._mag_colnames(mag_cols)
+
+            return Table([data_table[col] for col in mag_cols1d], copy=False)
+
+    @staticmethod
+    def _mag_colnames(mag_cols):
+        mag_cols1d=[]
+        for sub in mag_cols:
+            if(isinstance(sub,list)):
+                for item in sub:
+                    mag_cols1d.append(item) 
+            else:
+                mag_cols1d.append(sub)
+        # priors make consist of combinations of the
+        # same colour and for that reason a unique is needed
+        return list(np.unique(mag_cols1d))
+
+    def _set_mags(self, data_table):
         # If data_table is a masked table, we convert it to a normal table 
         # by filling masked values with -99 (assuming that they mask non-valid
         # magnitude values). This solves the problem of using a masked ndarray
@@ -847,25 +1091,89 @@ class Catalogue(object):
         # even when the edges of the bins are passed).
         #
         #
-        if mag_cols is not None:
+        mags = data_table.filled(-99)
+        for column in mags.colnames:
+            good_mask = np.isfinite(mags[column])
+            mags[column][~good_mask] = -99
+
+        return mags
+
+    def _read_data(self, filename, id_col, coord_cols, poserr_cols, mag_cols):
+        """
+        Read from `filename` only the columns used by the catalogue.
 
-            mag_cols1d=[]
-            for sub in mag_cols:
-                if(isinstance(sub,list)):
-                    for item in sub:
-                        mag_cols1d.append(item) 
+        FITS binary tables are memory-mapped and Parquet or Arrow (Feather)
+        files are read by columns with pyarrow (memory-mapped, without
+        copies when possible), so only these columns are loaded, and only
+        when they are used. Other formats are read with Astropy.
+        """
+        ext = os.path.splitext(filename)[1].lower()
+
+        if ext in FITS_EXTENSIONS:
+            hdul = fits.open(filename, memmap=True)
+            try:
+                hdu = next(hdu for hdu in hdul if isinstance(hdu, fits.BinTableHDU))
+            except StopIteration:
+                raise ValueError('No binary table found in {}!'.format(filename))
+
+            columns = self._data_colnames(
+                hdu.columns.names, id_col, coord_cols, poserr_cols, mag_cols
+            )
+            # Character columns are read as raw bytes, since Astropy
+            # decodes them converting the whole table
+            records = hdu.data.view(np.ndarray)
+            data = []
+            for col in columns:
+                if records.dtype[col].kind == 'S':
+                    values = np.char.rstrip(records[col])
                 else:
-                    mag_cols1d.append(sub)
-            # priors make consist of combinations of the
-            # same colour and for that reason a unique is needed
-            mag_cols1d=list(np.unique(mag_cols1d))
+                    values = hdu.data[col]
+
+                data.append(
+                    Column(values, name=col, unit=hdu.columns[col].unit, copy=False)
+                )
+
+        elif ext in ARROW_EXTENSIONS:
+            import pyarrow as pa
+
+            if ext in ['.parquet', '.pq']:
+                import pyarrow.parquet as pq
 
-            mags = data_table[mag_cols1d].filled(-99)
-            for column in mag_cols1d:
-                good_mask = np.isfinite(mags[column])
-                mags[column][~good_mask] = -99
+                names = pq.read_schema(filename, memory_map=True).names
+                read_table = pq.read_table
+            else:
+                import pyarrow.feather as feather
+
+                names = pa.ipc.open_file(pa.memory_map(filename)).schema.names
+                read_table = feather.read_table
 
-            return mags
+            columns = self._data_colnames(
+                names, id_col, coord_cols, poserr_cols, mag_cols
+            )
+            arrow = read_table(filename, columns=columns, memory_map=True)
+            data = [
+                Column(arrow.column(col).to_numpy(), name=col, copy=False)
+                for col in columns
+            ]
+
+        else:
+            return Table.read(filename)
+
+        return Table(data, copy=False)
+
+    def _data_colnames(self, names, id_col, coord_cols, poserr_cols, mag_cols):
+        # Columns used by the catalogue, with the ids in the first column
+        if id_col is None:
+            # Assume first column is the SRCID
+            id_col = names[0]
+
+        columns = [id_col] + list(coord_cols)
+        if poserr_cols is not None:
+            columns += list(poserr_cols)
+        if mag_cols is not None:
+            columns += self._mag_colnames(mag_cols)
+
+        return list(dict.fromkeys(columns))
         
     def _set_moc(self, mocfile):
         if mocfile is not None:
@@ -907,7 +1215,7 @@ class Catalogue(object):
         on what kind of errors are defined, given by `errtype`.
         """
         if columns is not None:
-            errs = data[columns]
+            errs = Table([data[col] for col in columns], copy=False)
             check = True
 
         else:
@@ -927,7 +1235,11 @@ class Catalogue(object):
             self.ids = new.ids
             self.coords = new.coords
             self.poserr = new.poserr
-            self.mags = new.mags
+
+            # Keep the magnitudes unloaded
+            self._mags = new._mags
+            self._mag_data = new._mag_data
+            self._mag_rows = new._mag_rows
             
     def _random_coords(self, a_min, a_max, r_min, r_max, numrepeat, seed):
         # a_min, a_max, r_min, r_max: Quantity type        
@@ -950,23 +1262,232 @@ class Catalogue(object):
 
         return rnd_ra, rnd_dec
 
+    def _fake_coords(self, r_min, seed=None, numneighbours=100, maxiter=100):
+        # Random positions for the sources of the catalogue, following
+        # the algorithm of nway-create-fake-catalogue: each source is
+        # moved to a random point of the great arc between the source
+        # and one of its nearest neighbours (one of the 10 nearest with
+        # 2/3 probability, one of the `numneighbours` nearest otherwise).
+        # Points closer than `r_min` to any source of the catalogue (or
+        # out of the MOC) are rejected and drawn again.
+        rng = np.random.default_rng(seed)
+        k = min(numneighbours + 1, len(self))
+        xyz, tree, all_sep, all_nbr = self._neighbours(k)
+
+        r_min = r_min.to(u.rad).value
+        chord_min = 2*np.sin(r_min/2)
+
+        fake = np.empty_like(xyz)
+        chunk_size = 2**16
+        for start in range(0, len(xyz), chunk_size):
+            src = np.arange(start, min(start + chunk_size, len(xyz)))
+            sep, nbr = all_sep[src], all_nbr[src]
+
+            # Neighbours are sorted by distance, so those useful (i.e. with
+            # some point of the arc at least r_min away from both ends) are
+            # always the last ones
+            first = np.sum(sep <= 2*r_min, axis=1)
+            nvalid = sep.shape[1] - first
+
+            if np.any(nvalid == 0):
+                raise ValueError(
+                    'Some sources have no neighbours farther than 2*r_min: '
+                    'the fake catalogue cannot be created!'
+                )
+
+            pending = np.arange(len(src))
+            for _ in range(maxiter):
+                nmax = np.where(rng.random(len(pending)) < 1/3, numneighbours, 10)
+                nmax = np.minimum(nmax, nvalid[pending])
+                rank = first[pending] + (nmax*rng.random(len(pending))).astype(int)
+
+                theta = sep[pending, rank]
+                f = rng.uniform(r_min/theta, 1 - r_min/theta)
+                a = xyz[src[pending]]
+                b = xyz[nbr[pending, rank]]
+                points = (np.sin((1 - f)*theta)[:, np.newaxis]*a
+                          + np.sin(f*theta)[:, np.newaxis]*b)
+                points /= np.sin(theta)[:, np.newaxis]
+
+                dist, _ = tree.query(points, k=1)
+                good = dist >= chord_min
+
+                if self.moc is not None:
+                    lon, lat = self._xyz_to_lonlat(points)
+                    good &= self.moc.contains_lonlat(lon*u.deg, lat*u.deg)
+
+                fake[src[pending[good]]] = points[good]
+                pending = pending[~good]
+
+                if len(pending) == 0:
+                    break
+            else:
+                raise ValueError(
+                    '{} sources could not be moved to a random position '
+                    'after {} iterations!'.format(len(pending), maxiter)
+                )
+
+        ra, dec = self._xyz_to_lonlat(fake)
+
+        return SkyCoord(ra, dec, unit='deg', frame='icrs')
+
+    def _neighbours(self, k):
+        # Unit vectors of the coordinates, their KD-tree, and the k nearest
+        # neighbours of each source (the first one is the source itself)
+        # with their angular separations in radians. They only depend on
+        # the coordinates, so (like the spatial index) they are kept for
+        # all the fake catalogues created from this one (see _fake_coords).
+        from scipy.spatial import cKDTree
+
+        if self._knn is None or self._knn[0] != k:
+            xyz = self.coords.icrs.cartesian.xyz.value.T
+            tree = cKDTree(xyz)
+
+            sep = np.empty((len(xyz), k))
+            nbr = np.empty((len(xyz), k), dtype=np.int32)
+
+            chunk_size = 2**16
+            for start in range(0, len(xyz), chunk_size):
+                stop = min(start + chunk_size, len(xyz))
+                chord, idx = tree.query(xyz[start:stop], k=k)
+                chord = chord.reshape(stop - start, -1)
+                sep[start:stop] = 2*np.arcsin(np.minimum(chord/2, 1))
+                nbr[start:stop] = idx.reshape(stop - start, -1)
+
+            self._knn = (k, xyz, tree, sep, nbr)
+
+        return self._knn[1:]
+
     @staticmethod
-    def _nway_fake_catalogue(input_file, radius=20):
-        # Create a fake catalogue based on the positions of input_file.
-        # No fake sources closer to `radius` arcsec with respect to the
-        # original sources
-        root, ext = os.path.splitext(input_file)
-        output_file = '{}_fake{}'.format(root, ext)
-
-        command = ('nway-create-fake-catalogue.py --radius {} {} {}')
-        command = command.format(radius, input_file, output_file)
-        print(command)
-        subprocess.check_output(command, shell=True)
-
-        fake_data = Table.read(output_file)
-        os.remove(output_file)
-
-        return fake_data
+    def _xyz_to_lonlat(xyz):
+        lon = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+        lat = np.degrees(np.arctan2(xyz[:, 2], np.hypot(xyz[:, 0], xyz[:, 1])))
+
+        return lon, lat
+
+
+class RandomPositions(object):
+    """
+    Random positions away from the sources of a catalogue, as those of
+    ``Catalogue.randomise``, generated lazily in blocks.
+
+    Positions are never stored all at once: each block can be generated
+    independently (and repeatedly, with the same result) using its own
+    random stream, derived from `seed` and the block number. Hence
+    the total number of positions can be much larger than the
+    catalogue, while the memory needed is that of a single block, and
+    blocks can be distributed among several processes.
+
+    Parameters
+    ----------
+    cat : ``Catalogue``
+        Positions are drawn around the sources of this catalogue.
+    r_min, r_max : Astropy ``Quantity``, optional
+        Minimum and maximum distance from the catalogue coordinates in
+        angular units. Defaults to 20 and 120 arcsec.
+    numrepeat : ``int``, optional
+        Number of random positions for each source of the catalogue
+        (before removing the positions out of the catalogue MOC).
+        Defaults to 10.
+    seed : ``int`` or ``None``, optional
+        Seed for the random streams. Defaults to ``None``.
+    """
+
+    # Number of positions in each block
+    BLOCK_SIZE = 2**18
+
+    def __init__(self, cat, r_min=20*u.arcsec, r_max=120*u.arcsec,
+                 numrepeat=10, seed=None):
+        coords = cat.coords.icrs
+        self._ra = np.asarray(coords.ra.deg, dtype=float)
+        self._dec = np.asarray(coords.dec.deg, dtype=float)
+        self.moc = cat.moc
+
+        self.r_min = r_min.to(u.deg).value
+        self.r_max = r_max.to(u.deg).value
+        self.numrepeat = numrepeat
+
+        # The entropy is fixed here, so all blocks (in any process)
+        # use streams of the same sequence, even if seed is None
+        self._entropy = np.random.SeedSequence(seed).entropy
+
+        # Number of positions of each block within the MOC
+        self.sizes = {}
+
+    def __len__(self):
+        for k in range(self.nblocks):
+            if k not in self.sizes:
+                self.block(k)
+
+        return sum(self.sizes.values())
+
+    def __iter__(self):
+        for k in range(self.nblocks):
+            yield self.block(k)
+
+    @property
+    def nblocks(self):
+        npositions = self.numrepeat * len(self._ra)
+        return -(-npositions // self.BLOCK_SIZE)
+
+    def block(self, k, sources=False):
+        """
+        Random positions of block `k`, as an Astropy ``SkyCoord``. If
+        `sources` is ``True``, it also returns the indexes of the catalogue
+        sources around which the positions were drawn.
+        """
+        start = k * self.BLOCK_SIZE
+        stop = min(start + self.BLOCK_SIZE, self.numrepeat * len(self._ra))
+
+        # numrepeat consecutive positions for each source
+        src = np.arange(start, stop) // self.numrepeat
+
+        seedseq = np.random.SeedSequence(self._entropy, spawn_key=(k,))
+        rng = np.random.default_rng(seedseq)
+        r = self.r_min + (self.r_max - self.r_min)*rng.random(len(src))
+        a = 2*np.pi*rng.random(len(src))
+
+        dec = self._dec[src] + r*np.sin(a)
+        ra = self._ra[src] + r*np.cos(a)/np.cos(np.radians(dec))
+
+        # Positions beyond the poles
+        beyond = np.abs(dec) > 90
+        dec[beyond] = np.sign(dec[beyond])*180 - dec[beyond]
+        ra[beyond] += 180
+        ra = np.mod(ra, 360)
+
+        if self.moc is not None:
+            inside = self.moc.contains_lonlat(ra*u.deg, dec*u.deg)
+            ra, dec, src = ra[inside], dec[inside], src[inside]
+
+        self.sizes[k] = len(ra)
+
+        coords = SkyCoord(ra, dec, unit='deg', frame='icrs')
+        if sources:
+            return coords, src
+
+        return coords
+
+    def search_area(self, radius):
+        """
+        Total area of the circles of `radius` around all positions.
+        `radius` is a scalar ``Quantity`` or an array with the radius for
+        the positions drawn around each source of the catalogue.
+        """
+        if radius.isscalar:
+            return len(self)*np.pi*radius**2
+
+        if self.moc is None:
+            # No positions are removed
+            return self.numrepeat*np.sum(np.pi*radius**2)
+
+        area = 0
+        for k in range(self.nblocks):
+            _, src = self.block(k, sources=True)
+            area += np.sum(np.pi*radius[src]**2)
+
+        return area
+
 
 def xmatch_mock_catalogues(xmatchserver_user=None, seed=None, **kwargs):
     """
@@ -15,12 +15,18 @@ from astropy.utils.exceptions import AstropyUserWarning
 
 from .catalogues import Catalogue
 from .lr import LRMatch
+from .profiling import StageProfile
+from .results import MatchFile, matchs_mask, write_table
 from .xmatch import XMatch
 
 
 class Match(object):
     """
     Main class for crossmatching catalogues.
+
+    The wall time, peak memory and row counts of each stage of ``run``
+    and of the statistics methods are recorded in the ``profile``
+    attribute (see ``StageProfile``), which can be exported as JSON.
     """
     def __init__(self, *args, **kwargs):
         self.catalogues = []
@@ -41,6 +47,7 @@ class Match(object):
         self._match = None
         self._result = None
         self._priors = None
+        self.profile = StageProfile()
 
 
     @property
@@ -85,7 +92,7 @@ class Match(object):
         else:
             raise AttributeError
 
-    def run(self, method='lr', **kwargs):
+    def run(self, method='lr', output=None, chunk_rows=100000, **kwargs):
         """
         Cross-matching between catalogues, using the method defined in `method`.
 
@@ -97,6 +104,15 @@ class Match(object):
         ----------
         method : 'lr', 'nway' or 'xmatch
             Cross-matching method. Defaults to 'lr'
+        output : ``str`` or `None`, optional
+            If not `None`, the results are written to this file (FITS, HDF5
+            or Parquet, depending on the extension) in chunks of about
+            `chunk_rows` rows, and a ``MatchFile`` is returned instead of a
+            table. The 'lr' method writes each chunk as soon as it is
+            calculated, so the full table is never held in memory. Other
+            methods write their final table. Defaults to `None`.
+        chunk_rows : ``int``, optional
+            Defaults to 100000.
 
         Other Parameters
         ----------------
@@ -109,18 +125,28 @@ class Match(object):
         # Crossmatch only for sources cointained in the intersection of mocs,
         # if no mocs were defined, we assume that all catalogues cover the same sky area
         if total_moc is not None:
-            catalogues_inmoc = []
-            for cat in self.catalogues:
-                #print(self.catalogues)
-                catalogues_inmoc.append(cat.apply_moc(total_moc))
-
-            self.catalogues = catalogues_inmoc
+            with self.profile.stage('apply_moc') as counts:
+                catalogues_inmoc = []
+                for cat in self.catalogues:
+                    #print(self.catalogues)
+                    catalogues_inmoc.append(cat.apply_moc(total_moc))
+
+                self.catalogues = catalogues_inmoc
+                counts['sources'] = sum(len(cat) for cat in self.catalogues)
         
         # Run the crossmatch with the defined method
         method_name = '_{}__{}'.format(self.__class__.__name__, method)
         match_method = getattr(self, method_name)
+
+        if output is not None and method == 'lr':
+            kwargs.update(output=output, chunk_rows=chunk_rows)
+
         self._result = match_method(**kwargs)
 
+        if output is not None and not isinstance(self._result, MatchFile):
+            with self.profile.stage('write_table', rows=len(self._result)):
+                self._result = write_table(self._result, output, chunk_rows)
+
         return self._result
 
     def total_moc(self):
@@ -159,33 +185,19 @@ class Match(object):
             'best' : Return only the matches with the most likely counterpart and above
             a likelihood limit. The likelihood limit is set through the `set_best_matchs`
             method.
+
+        If the results were written to a file (see `output` in ``run``),
+        only the selected rows are read from disk.
         """
         if self._result is None:
             raise AttributeError('Match has not been performed yet!')
 
-        if match_type not in ['all', 'primary_all', 'primary', 'best']:
-            raise ValueError('Unknown match type: {}'.format(match_type))
-
-        if match_type == 'primary_all':
-            mask = self._result['match_flag'] == 1
-            matchs = self._result[mask]
-
-        else:
-            mask = self._result['ncat'] > 1
-            matchs = self._result[mask]
-
-            if match_type == 'primary':
-                mask = matchs['match_flag'] == 1
-                matchs = matchs[mask]
+        if isinstance(self._result, MatchFile):
+            return self._result.get_matchs(match_type)
 
-            elif match_type == 'best':
-                try:
-                    mask = matchs['best_match_flag'] == 1
-                    matchs = matchs[mask]
-                except KeyError:
-                    raise ValueError('Best matchs not identified yet!')
+        mask = matchs_mask(lambda name: self._result[name], match_type)
 
-        return matchs
+        return self._result[mask]
 
     def offset(self, pcat_name, scat_name, only_best=False):
         cat_names = self._catalogue_names()
@@ -215,8 +227,7 @@ class Match(object):
         self, cutoff=None, false_rate=None, calibrate_with_random_cat=False, **kwargs,
     ):
 
-        if self._result is None:
-            raise AttributeError('Match has not been performed yet!')
+        self._results_table()
 
         match_rnd = None
         if cutoff is None:
@@ -243,6 +254,8 @@ class Match(object):
         MC simulations are used to characterize the properties of the isolated and
         the associated populations of the primary catalogue.
         """
+        self._results_table()
+
         if use_broos:
             stats = self._match.stats_broos(self.results, **kwargs)
 
@@ -269,13 +282,11 @@ class Match(object):
                 AstropyUserWarning
             )
 
-        # Our current implementation of the LR method always assumes 1-sigma
-        # circular positional errors. Hence, we transform non-circular errors
-        # to circular errors of equal area. We pass only the firs two catalogues,
+        # Non-circular positional errors are used with their full covariance
+        # matrices (see ``LRMatch``). We pass only the firs two catalogues,
         # other catalogues are ignored while using this method.
-        catalogues_circular = self._poserrs_to_circle(self.catalogues[:2])
-
-        self._match = LRMatch(*catalogues_circular)
+        self._match = LRMatch(*self.catalogues[:2])
+        self._match.profile = self.profile
 
         return self._match.run(**kwargs)
 
@@ -289,6 +300,7 @@ class Match(object):
         catalogues_circular = self._poserrs_to_circle(self.catalogues)
 
         self._match = NWMatch(*catalogues_circular)
+        self._match.profile = self.profile
 
         return self._match.run(**kwargs)
 
@@ -296,9 +308,20 @@ class Match(object):
         log.info('Using XMatch method:')
 
         self._match = XMatch(*self.catalogues)
+        self._match.profile = self.profile
 
         return self._match.run(**kwargs)
 
+    def _results_table(self):
+        # Results as a table in memory, needed for flags and statistics
+        if isinstance(self.results, MatchFile):
+            raise ValueError(
+                'Results were written to {}. Load them with results.read() '
+                'for flags or statistics.'.format(self.results.path)
+            )
+
+        return self.results
+
     def _catalogue_names(self):
         return [cat.name for cat in self.catalogues]
 
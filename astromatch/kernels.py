@@ -0,0 +1,555 @@
+"""
+astromatch module with the numerical kernels used in the hot paths of the
+LR method: positional error functions, look-up of magnitude priors in their
+binned grids and reductions over groups of candidates.
+
+Two backends are available:
+
+'numpy'
+    Vectorised NumPy code. This is the default backend.
+
+'numba'
+    Kernels JIT-compiled with Numba, using parallel loops and avoiding the
+    temporary arrays of the NumPy code. Numba is an optional dependency;
+    kernels are compiled the first time they are used. Unless a threading
+    layer is set by the user (``NUMBA_THREADING_LAYER``), the fork-safe
+    'workqueue' layer is used, so the kernels can be combined with the
+    worker processes of ``LRMatch.run(n_workers=...)``.
+
+The backend is selected at runtime with ``set_backend``. Both backends
+use the same sequence of floating point operations, but results are not
+always bit for bit identical: the exponential function of NumPy (SIMD) and
+Numba (LLVM) can differ in the last bit, and the summation order within
+groups can be different (NumPy uses pairwise summation in some cases, Numba
+always adds sequentially). Prior look-ups and group maxima are identical,
+and relative differences in positional error functions and group sums are
+below 1e-15 (a few ULPs).
+
+Grid look-ups can also be split in two steps, finding the bins of the
+points (``axis_bins`` and ``grid_bins``) and taking the values of the grid
+(``grid_take``), so the bins are reused for all grids with the same
+binning (see ``priorsND.MagBins``). These functions are NumPy only.
+
+Positional error functions for non-circular errors use the full covariance
+matrix of each pair (``pos_err_function_cov``), evaluated in closed form
+for 2x2 matrices. These are NumPy only, too.
+
+Run ``python -m astromatch.kernels`` for a benchmark comparing both
+backends.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import warnings
+
+import numpy as np
+from astropy import units as u
+from astropy.table import Table
+from astropy.utils.exceptions import AstropyUserWarning
+
+
+BACKENDS = ['numpy', 'numba', 'auto']
+
+_backend = 'numpy'
+_numba_kernels = None
+
+
+def set_backend(backend='auto'):
+    """
+    Set the backend for the numerical kernels.
+
+    Parameters
+    ----------
+    backend : 'numpy', 'numba' or 'auto', optional
+        If 'auto', Numba is used when available. If 'numba' is selected but
+        Numba is not installed, a warning is raised and the 'numpy' backend
+        is used instead. Defaults to 'auto'.
+
+    Returns
+    -------
+    backend : ``str``
+        The backend actually selected.
+    """
+    global _backend
+
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend: {}'.format(backend))
+
+    if backend == 'numpy':
+        _backend = 'numpy'
+    elif _load_numba_kernels() is not None:
+        _backend = 'numba'
+    else:
+        if backend == 'numba':
+            warnings.warn(
+                'Numba is not available, using NumPy backend.', AstropyUserWarning
+            )
+        _backend = 'numpy'
+
+    return _backend
+
+
+def get_backend():
+    """
+    Name of the backend currently used for the numerical kernels.
+    """
+    return _backend
+
+
+def pos_err_function(dist, ppos_error, spos_error, pidx, sidx, poserr_dist):
+    """
+    Probability density of the distance between the primary sources `pidx`
+    and their counterparts `sidx`, assuming gaussian positional errors.
+
+    Parameters
+    ----------
+    dist : Astropy ``Quantity``
+        Distance between the primary source and the counterpart.
+    ppos_error, spos_error : Astropy ``Quantity``
+        Circular positional errors of all sources in the primary and the
+        secondary catalogues.
+    pidx, sidx : numpy ``ndarray``
+        Indexes of the pairs in the primary and secondary catalogues.
+    poserr_dist : 'rayleigh' or 'normal'
+        'rayleigh' is the distribution of the distance, 'normal' is the
+        bivariate normal distribution per unit area.
+
+    Returns
+    -------
+    pef : Astropy ``Quantity``
+    """
+    if poserr_dist not in ['rayleigh', 'normal']:
+        raise ValueError('Unknown method: {}'.format(poserr_dist))
+
+    if _backend == 'numba':
+        return _pos_err_function_numba(
+            dist, ppos_error, spos_error, pidx, sidx, poserr_dist
+        )
+
+    ppos_error = ppos_error[pidx]
+    spos_error = spos_error[sidx]
+    sigma2 = ppos_error**2 + spos_error**2
+
+    if poserr_dist == 'rayleigh':
+        exponent = -dist**2 / sigma2
+        return np.exp(exponent) / sigma2 * 2 * dist
+    else:
+        exponent = -dist**2 / (2*sigma2)
+        return np.exp(exponent) / (2*np.pi*sigma2)
+
+
+def pos_err_function_cov(dist, pa, cov, poserr_dist):
+    """
+    Probability density of the offset between pairs of sources with
+    gaussian positional errors of any shape. The offsets are distributed
+    as a bivariate normal with covariance matrix `cov`, the sum of the
+    covariance matrices of the two sources of each pair.
+
+    For circular errors this is the same as ``pos_err_function``, with
+    the squared distance divided by the variance replaced by the squared
+    Mahalanobis distance, and the variance by the square root of the
+    determinant of `cov`.
+
+    Parameters
+    ----------
+    dist : Astropy ``Quantity``
+        Distance between the sources of each pair.
+    pa : numpy ``ndarray``
+        Position angle (radians, East of North) of the offsets
+        (see ``position_angle``).
+    cov : Astropy ``Quantity``
+        (N, 3) array with the variances along RA and Dec and the covariance
+        of each pair (see ``pair_covariance``).
+    poserr_dist : 'rayleigh' or 'normal'
+        See ``pos_err_function``.
+
+    Returns
+    -------
+    pef : Astropy ``Quantity``
+    """
+    if poserr_dist not in ['rayleigh', 'normal']:
+        raise ValueError('Unknown method: {}'.format(poserr_dist))
+
+    m2, sqrt_det = _mahalanobis2(dist, pa, cov)
+
+    if poserr_dist == 'rayleigh':
+        return np.exp(-m2) / sqrt_det * 2 * dist
+    else:
+        return np.exp(-m2/2) / (2*np.pi*sqrt_det)
+
+
+def mahalanobis(dist, pa, cov):
+    """
+    Mahalanobis distance of offsets with length `dist` and position angle
+    `pa` for gaussian positional errors with covariance matrices `cov`
+    (see ``pos_err_function_cov``).
+    """
+    m2, _ = _mahalanobis2(dist, pa, cov)
+
+    return np.sqrt(m2)
+
+
+def pair_covariance(pcov, scov, pidx, sidx):
+    """
+    Sum of the covariance matrices of the primary sources `pidx` and their
+    counterparts `sidx`.
+
+    Parameters
+    ----------
+    pcov, scov : Astropy ``Quantity``
+        (N, 3) arrays with the variances along RA and Dec and the covariance
+        of all sources in the primary and the secondary catalogues (see
+        ``SkyCoordErr.covariance_array``).
+    pidx, sidx : numpy ``ndarray``
+        Indexes of the pairs in the primary and secondary catalogues.
+
+    Returns
+    -------
+    cov : Astropy ``Quantity``
+        (len(pidx), 3) array, in the units of `pcov`.
+    """
+    unit = pcov.unit
+    cov = np.take(pcov.value, pidx, axis=0)
+    cov += np.take(scov.to_value(unit), sidx, axis=0)
+
+    return u.Quantity(cov, unit, copy=False)
+
+
+def position_angle(plon, plat, slon, slat):
+    """
+    Position angle (radians, East of North) of the secondary positions
+    (`slon`, `slat`) relative to the primary positions (`plon`, `plat`).
+    All angles in radians.
+    """
+    dlon = slon - plon
+    x = np.sin(dlon) * np.cos(slat)
+    y = np.cos(plat)*np.sin(slat) - np.sin(plat)*np.cos(slat)*np.cos(dlon)
+
+    return np.arctan2(x, y)
+
+
+def _mahalanobis2(dist, pa, cov):
+    # Squared Mahalanobis distance of the offsets and square root of the
+    # determinant of the covariance matrices (closed form for 2x2 matrices)
+    err_unit = cov.unit**0.5
+    scale = (dist.unit / err_unit).to(u.dimensionless_unscaled)
+
+    d = np.asarray(dist.value) * scale
+    dx = d * np.sin(pa)
+    dy = d * np.cos(pa)
+
+    var_x, var_y, cov_xy = cov.value[:, 0], cov.value[:, 1], cov.value[:, 2]
+    det = var_x*var_y - cov_xy**2
+    m2 = (var_y*dx**2 - 2*cov_xy*dx*dy + var_x*dy**2) / det
+
+    return m2, np.sqrt(det) * err_unit**2
+
+
+def grid_lookup(values, edges, grid):
+    """
+    Values of `grid` in the bins of an N-dimensional regular grid
+    (defined by `edges`) containing the points in `values`. Points
+    outside the grid are assigned a zero value.
+
+    Parameters
+    ----------
+    values : ``list`` of numpy ``ndarray``
+        Coordinates of the points, one array for each dimension.
+    edges : ``list`` of numpy ``ndarray``
+        Bin edges of the grid in each dimension.
+    grid : numpy ``ndarray``
+        N-dimensional array with the values of the grid.
+
+    Returns
+    -------
+    gvals : numpy ``ndarray``
+    """
+    if _backend == 'numba':
+        return _grid_lookup_numba(values, edges, grid)
+
+    axes = [axis_bins(val, e) for val, e in zip(values, edges)]
+
+    return grid_take(grid, grid_bins(axes, grid.shape))
+
+
+def axis_bins(values, edges):
+    """
+    Bins of a regular 1D grid (defined by `edges`) containing `values`.
+    Values outside the grid are assigned to bin -1.
+
+    Parameters
+    ----------
+    values : numpy ``ndarray``
+    edges : numpy ``ndarray``
+        Bin edges of the grid.
+
+    Returns
+    -------
+    bins : numpy ``ndarray``
+    """
+    x = np.array(values, dtype=float)
+    x -= edges[0]
+    x /= edges[1] - edges[0]
+
+    bins = x.astype(int)
+    outside = bins < 0
+    outside |= bins > len(edges) - 2
+    bins[outside] = -1
+
+    return bins
+
+
+def grid_bins(axes, shape):
+    """
+    Flat indexes (C order) of the bins of an N-dimensional grid with
+    `shape`, given the bins in each dimension. Points outside the grid
+    (bin -1 in any dimension) are assigned to index -1.
+
+    Parameters
+    ----------
+    axes : ``list`` of numpy ``ndarray``
+        Bins of the points in each dimension (see ``axis_bins``).
+    shape : ``tuple``
+        Shape of the grid.
+
+    Returns
+    -------
+    bins : numpy ``ndarray``
+    """
+    if len(axes) == 1:
+        return axes[0]
+
+    strides = np.cumprod((shape[1:] + (1,))[::-1])[::-1]
+
+    flat = np.zeros(len(axes[0]), dtype=int)
+    outside = np.zeros(len(axes[0]), dtype=bool)
+    for bins, nbins, stride in zip(axes, shape, strides):
+        if np.any(bins >= nbins):
+            raise IndexError('Bins out of the grid!')
+
+        flat += bins * stride
+        outside |= bins < 0
+
+    flat[outside] = -1
+
+    return flat
+
+
+def grid_take(grid, bins):
+    """
+    Values of `grid` in the flat indexes `bins` (see ``grid_bins``).
+    Index -1 (points outside the grid) is assigned a zero value.
+    """
+    # The last element of the padded grid is the value for index -1
+    padded = np.append(grid.ravel(), np.zeros(1, dtype=grid.dtype))
+
+    return padded.take(bins)
+
+
+def segment_reduce(ufunc, values, offsets):
+    """
+    Reduce `values` with `ufunc` (``np.add`` or ``np.maximum`` for the
+    'numba' backend, any ufunc with a ``reduceat`` method for 'numpy')
+    within the segments starting at `offsets`.
+    """
+    if _backend == 'numba' and ufunc in (np.add, np.maximum):
+        values = np.asarray(values)
+        is_float64 = values.dtype.kind == 'f' and values.dtype.itemsize == 8
+        if is_float64 and values.ndim in (1, 2):
+            return _segment_reduce_numba(ufunc, values, offsets)
+
+    return ufunc.reduceat(values, offsets, axis=0)
+
+
+def benchmark(npairs=1000000, nsegments=200000, npriors=3, repeat=3, seed=None):
+    """
+    Compare the execution times of the kernels for the
+    'numpy' and 'numba' backends, using random data.
+
+    Parameters
+    ----------
+    npairs : ``int``, optional
+        Number of pairs (positional error functions, prior look-ups).
+    nsegments : ``int``, optional
+        Number of groups for the group reductions.
+    npriors : ``int``, optional
+        Number of columns for the group reductions.
+    repeat : ``int``, optional
+        Number of times each kernel is executed. The best time is reported.
+    seed : ``int`` or ``None``, optional
+        Seed for the random data.
+
+    Returns
+    -------
+    bench : Astropy ``Table``
+        Best execution times (in seconds) for each kernel and backend,
+        and maximum relative difference between the backends.
+    """
+    if _load_numba_kernels() is None:
+        raise ImportError('Numba is not installed!')
+
+    rng = np.random.RandomState(seed)
+
+    nsrcs = npairs // 5 + 1
+    dist = rng.uniform(0, 6, npairs) * u.arcsec
+    ppos_error = rng.uniform(0.5, 3, nsrcs) * u.arcsec
+    spos_error = rng.uniform(0.05, 0.5, nsrcs) * u.arcsec
+    pidx = np.sort(rng.randint(0, nsrcs, npairs))
+    sidx = rng.randint(0, nsrcs, npairs)
+
+    values = [rng.uniform(8, 32, npairs), rng.uniform(8, 32, npairs)]
+    edges = [np.arange(10, 30.5, 0.5), np.arange(10, 30.5, 0.5)]
+    grid = rng.uniform(0, 1, (len(edges[0]) - 1, len(edges[1]) - 1))
+
+    lr = rng.uniform(0, 1, (npairs, npriors))
+    offsets = np.unique(rng.randint(0, npairs, nsegments))
+    offsets[0] = 0
+
+    kernels = [
+        ('pos_err_function (rayleigh)', lambda: pos_err_function(
+            dist, ppos_error, spos_error, pidx, sidx, 'rayleigh'
+        ).value),
+        ('pos_err_function (normal)', lambda: pos_err_function(
+            dist, ppos_error, spos_error, pidx, sidx, 'normal'
+        ).value),
+        ('grid_lookup', lambda: grid_lookup(values, edges, grid)),
+        ('segment_reduce (sum)', lambda: segment_reduce(np.add, lr, offsets)),
+        ('segment_reduce (max)', lambda: segment_reduce(np.maximum, lr, offsets)),
+    ]
+
+    original_backend = _backend
+    bench = Table(names=['kernel', 'numpy', 'numba', 'speedup', 'max_rel_diff'],
+                  dtype=['U32', float, float, float, float])
+    try:
+        for name, kernel in kernels:
+            times, results = {}, {}
+            for backend in ['numpy', 'numba']:
+                set_backend(backend)
+                results[backend] = kernel()  # Numba compilation happens here
+
+                times[backend] = np.inf
+                for _ in range(repeat):
+                    start = time.time()
+                    kernel()
+                    times[backend] = min(times[backend], time.time() - start)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                diff = np.abs(results['numba'] - results['numpy'])
+                reldiff = np.nanmax(np.where(diff > 0, diff / np.abs(results['numpy']), 0))
+
+            bench.add_row([
+                name, times['numpy'], times['numba'],
+                times['numpy'] / times['numba'], reldiff,
+            ])
+    finally:
+        set_backend(original_backend)
+
+    for col in ['numpy', 'numba']:
+        bench[col].format = '.4f'
+    bench['speedup'].format = '.2f'
+    bench['max_rel_diff'].format = '.1e'
+
+    return bench
+
+
+def _pos_err_function_numba(dist, ppos_error, spos_error, pidx, sidx, poserr_dist):
+    # Same operations (and units) as in the numpy backend
+    perr_unit = ppos_error.unit
+    perr = _native(ppos_error.value)
+    serr = _native(spos_error.to_value(perr_unit))
+    dist_unit = dist.unit
+    dist = _native(dist.value)
+    pidx, sidx = _native(pidx, np.int64), _native(sidx, np.int64)
+
+    kernels = _load_numba_kernels()
+    if poserr_dist == 'rayleigh':
+        scale = (dist_unit**2 / perr_unit**2).to(u.dimensionless_unscaled)
+        pef = kernels['rayleigh'](dist, perr, serr, pidx, sidx, scale)
+
+        return pef * (dist_unit / perr_unit**2)
+    else:
+        scale = (dist_unit**2 / perr_unit**2).to(u.dimensionless_unscaled)
+        pef = kernels['normal'](dist, perr, serr, pidx, sidx, scale)
+
+        return pef / perr_unit**2
+
+
+def _grid_lookup_numba(values, edges, grid):
+    ndim = len(values)
+    npoints = len(values[0])
+
+    points = np.empty((ndim, npoints))
+    for i, val in enumerate(values):
+        points[i] = np.asarray(val)
+
+    start = np.array([e[0] for e in edges], dtype=float)
+    width = np.array([e[1] - e[0] for e in edges], dtype=float)
+    nbins = np.array([len(e) - 1 for e in edges], dtype=np.int64)
+
+    grid = np.ascontiguousarray(grid)
+    strides = np.array(grid.strides, dtype=np.int64) // grid.itemsize
+
+    kernels = _load_numba_kernels()
+    gvals = kernels['grid_lookup'](
+        points, start, width, nbins, strides, grid.ravel().astype(float)
+    )
+
+    return gvals.astype(grid.dtype, copy=False)
+
+
+def _segment_reduce_numba(ufunc, values, offsets):
+    kernels = _load_numba_kernels()
+    offsets = _native(offsets, np.int64)
+
+    values = _native(values)
+    values2d = values if values.ndim == 2 else values[:, np.newaxis]
+    if ufunc is np.add:
+        result = kernels['segment_sum'](values2d, offsets)
+    else:
+        result = kernels['segment_max'](values2d, offsets)
+
+    return result if values.ndim == 2 else result[:, 0]
+
+
+def _native(array, dtype=np.float64):
+    # Numba only accepts arrays in the native byte order
+    # (data read from FITS files are big-endian).
+    return np.asarray(array, dtype=dtype)
+
+
+def _load_numba_kernels():
+    # Import (and compile lazily) the numba kernels.
+    # Returns None if numba is not installed.
+    global _numba_kernels
+
+    if _numba_kernels is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+
+        if numba.config.THREADING_LAYER == 'default':
+            # Processes forked by LRMatch.run(n_workers > 1) after the
+            # kernels have been used deadlock with the TBB layer and are
+            # aborted with the GNU OpenMP layer. The workqueue layer is safe.
+            numba.config.THREADING_LAYER = 'workqueue'
+
+        from . import _numba_kernels as kernels
+
+        _numba_kernels = {
+            'rayleigh': kernels.rayleigh,
+            'normal': kernels.normal,
+            'grid_lookup': kernels.grid_lookup,
+            'segment_sum': kernels.segment_sum,
+            'segment_max': kernels.segment_max,
+        }
+
+    return _numba_kernels
+
+
+if __name__ == '__main__':
+    print(benchmark())
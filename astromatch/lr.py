@@ -12,24 +12,31 @@ from __future__ import division
 from __future__ import print_function
 from io import open
 
+import multiprocessing
 import os
-from copy import deepcopy
-
-try:
-    # python 3
-    from contextlib import redirect_stdout
-except:
-    # python 2
-    from contextlib2 import redirect_stdout
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 from astropy import log
 from astropy import units as u
-from astropy.table import Table, Column, join, vstack, unique
+from astropy.coordinates import concatenate
+from astropy.table import Table, Column, MaskedColumn, vstack
+from astropy.utils.exceptions import AstropyUserWarning
 import numpy as np
 
 from .priors import Prior #, BKGpdf
-from .priorsND import PriorND, BKGpdf
+from .priorsND import PriorND, BKGpdf, MagBins
+from .priorcache import PriorCache
+from .profiling import StageProfile, profiled
+from .kernels import (
+    pos_err_function, pos_err_function_cov, mahalanobis, pair_covariance, position_angle
+)
+from .catalogues import RandomPositions, SkyCoordErr
 from .match import BaseMatch
+from .results import MatchFile, MatchWriter
+from .segments import Segments
+from .spatial import tile_partition
+from .sweep import ThresholdSweep, cutoff_grid
 
 import sys
 
@@ -42,6 +49,10 @@ class LRMatch(BaseMatch):
     one for the secondary catalogue (e.g. a list of optical sources). The
     secondary catalogue must contain auxiliary data (e.g. magnitudes).
 
+    Positional errors can be of any type (see ``SkyCoordErr``). If they are
+    not circular in both catalogues, the positional term of the LR uses the
+    full covariance matrix of each pair of sources.
+
     Parameters
     ----------
     pcat : ``Catalogue``
@@ -51,16 +62,35 @@ class LRMatch(BaseMatch):
     """
 
     _lr_all = None
+    _lr_data = None
     _bkg = None
+    _max_memory = None
+    _max_mahalanobis = None
+    _search_radius = None
+    _run_params = None
+    _segments = None
+    _rndcat = None
+    _terms = None
+    _removed = None
+    _output = None
     _cutoff_column = 'LR_BEST'
 
     ### Class Properties
     @property
     def lr(self):
         if self._lr_all is None:
-            raise AttributeError('Match has not been performed yet!')
-        else:
-            return self._lr_all
+            if self._output is not None:
+                raise AttributeError('LRs for all priors are not kept '
+                                     'when results are written to a file!')
+
+            if self._lr_data is None:
+                raise AttributeError('Match has not been performed yet!')
+
+            # The table with the results for all priors
+            # is built only when it is requested.
+            self._lr_all = self._lr_all_table(self._lr_data)
+
+        return self._lr_all
 
     @property
     def bkg(self):
@@ -74,6 +104,7 @@ class LRMatch(BaseMatch):
         return self.scats[0]
 
     ### Public Methods
+    @profiled()
     def run(self,
         radius=6*u.arcsec,
         mags=None,
@@ -85,7 +116,14 @@ class LRMatch(BaseMatch):
         random_numrepeat=200,
         poserr_dist="rayleigh",
         prob_ratio_secondary=0.5,
-        seed=None            
+        seed=None,
+        max_memory=None,
+        n_workers=1,
+        output=None,
+        chunk_rows=100000,
+        prior_cache=None,
+        max_mahalanobis=None,
+        radius_nsigma=5.0
     ):
         """
         Performs the actual LR crossmatch between the two catalogues. The
@@ -95,9 +133,14 @@ class LRMatch(BaseMatch):
 
         Parameters
         ----------
-        radius : Astropy ``Quantity``, optional
+        radius : Astropy ``Quantity`` or 'auto', optional
             Distance limit for searching counterparts in the secondary
-            catalogue in angular units. Defaults to 6 arcsec.
+            catalogue in angular units. Defaults to 6 arcsec. If 'auto',
+            each primary source uses its own limit, `radius_nsigma` times
+            the combined 1-sigma error along the major axes of its
+            positional error and of the largest error of the secondary
+            catalogue. This gives far fewer candidates than a single
+            radius large enough for the sources with the largest errors.
         mag: 
         magmin : `float`, optional
             Lower magnitude limit to be considered in the LR calculation.
@@ -144,6 +187,54 @@ class LRMatch(BaseMatch):
         poserr_dist : "rayleigh" of "normal". Probability distribution that describes 
             the radial distance of two sources with positional errors. Defauls to "Rayleigh"
 
+        max_memory : Astropy ``Quantity``, `int` or `None`, optional
+            Approximate memory budget (bytes if an `int` is passed) for the
+            temporary arrays of the counterparts search. The sky is walked
+            tile by tile in batches that fit within this budget. If `None`,
+            the default of ``SpatialIndex`` is used. Defaults to `None`.
+
+        n_workers : `int`, optional
+            Number of processes used for the likelihood ratio calculation.
+            If larger than one, the primary catalogue is split in groups of
+            sky tiles that are processed in parallel, using the priors
+            estimated for the whole catalogue. The results are identical to
+            the serial calculation. Defaults to 1.
+
+        output : `str` or `None`, optional
+            If not `None`, the match table is written to this file (FITS,
+            HDF5 or Parquet, see ``results.MatchWriter``) and a
+            ``results.MatchFile`` is returned instead of the table. Primary
+            sources are processed in chunks, written as soon as they are
+            finished, so the full table is never held in memory. It cannot
+            be combined with `n_workers` larger than one. Defaults to `None`.
+
+        chunk_rows : `int`, optional
+            Approximate number of rows of the match table in each chunk
+            when `output` is set. Chunks contain all rows of a range of
+            primary sources. Defaults to 100000.
+
+        prior_cache : ``priorcache.PriorCache``, `str` or `None`, optional
+            Cache of priors (or the path of its directory). If `priors` is
+            `None`, priors are taken from the cache when they were already
+            estimated for the same catalogues and parameters, skipping the
+            prior calculation (and the search of field sources), and stored
+            in the cache otherwise. Note that with the 'random' method and
+            `seed` equal to `None` the cached priors come from a previous
+            set of random positions. Defaults to `None`.
+
+        max_mahalanobis : `float` or `None`, optional
+            If not `None`, counterparts within `radius` are discarded when
+            their Mahalanobis distance to the primary source (the offset
+            in units of the positional errors of the pair, using their
+            full covariance matrices) is larger than this value. For very
+            anisotropic errors this removes most of the candidates found
+            within a radius large enough for the major axes of the errors.
+            Defaults to `None`.
+
+        radius_nsigma : `float`, optional
+            Number of sigmas of the search limits when `radius` is 'auto'.
+            Defaults to 5.
+
         """
 
         assert poserr_dist.lower() in ['normal', 'rayleigh'], "xposerr_dist  should be one of normal, rayleigh"
@@ -160,29 +251,207 @@ class LRMatch(BaseMatch):
             raise ValueError('Secondary catalogue must contain '
                              'auxiliary data (e.g. magnitudes).')
         self.radius = radius
-        
+        self._search_radius = self._auto_radius(radius, radius_nsigma)
+        self._run_params = dict(
+            radius=radius, mags=mags, magmin=magmin, magmax=magmax,
+            magbinsize=magbinsize, prior_method=prior_method,
+            random_numrepeat=random_numrepeat, poserr_dist=poserr_dist,
+            prob_ratio_secondary=prob_ratio_secondary, seed=seed,
+            max_memory=max_memory, n_workers=n_workers, chunk_rows=chunk_rows,
+            prior_cache=prior_cache, max_mahalanobis=max_mahalanobis,
+            radius_nsigma=radius_nsigma,
+        )
+        self._max_memory = max_memory
+        self._max_mahalanobis = max_mahalanobis
+
+        profile = self.profile
+        profile.count(primary_sources=len(self.pcat), secondary_sources=len(self.scat))
+
+        if output is not None and n_workers > 1:
+            raise ValueError('Results cannot be written to a file using n_workers > 1.')
+
+        cache_key = None
+        if not priors and prior_cache is not None:
+            if not isinstance(prior_cache, PriorCache):
+                prior_cache = PriorCache(prior_cache)
+
+            cache_key = prior_cache.key(
+                self.pcat, self.scat, radius=radius, mags=mags, magmin=magmin,
+                magmax=magmax, magbinsize=magbinsize, prior_method=prior_method,
+                random_numrepeat=random_numrepeat, seed=seed,
+                mask_radius=PriorND.mask_radius, radius_nsigma=radius_nsigma,
+                max_mahalanobis=max_mahalanobis
+            )
+            priors = prior_cache.get(cache_key)
+            if priors:
+                cache_key = None
+
+        self._lr_all = None
+        self._lr_data = None
+        self._output = output
+        if n_workers > 1 and len(self.pcat) > 0:
+            match, self._lr_data = self._sharded_match(
+                priors, mags, magmin, magmax, magbinsize, prior_method, seed,
+                prob_ratio_secondary, n_workers
+            )
+            if cache_key is not None:
+                prior_cache.put(cache_key, self._priors)
+
+            return match
+
         log.info('Searching for match candidates within {}...'.format(self.radius))
-        mcat_pidx, mcat_sidx, mcat_d2d = self._candidates()
+        with profile.stage('candidates') as counts:
+            mcat_pidx, mcat_sidx, mcat_d2d = self._candidates()
+            counts['pairs'] = len(mcat_pidx)
 
         log.info('Calculating priors...')        
-        if not priors:
-            self._priors = self._calc_priors(
-                mcat_sidx, mags, magmin, magmax, magbinsize, prior_method, seed
-            )
-        else:            
-            self._priors = priors
-
-        self._bkg = BKGpdf(self.scat, mags, magmin, magmax, magbinsize)
+        with profile.stage('priors') as counts:
+            if not priors:
+                rndcat = self._prior_rndcat(prior_method, seed)
+                self._priors = self._calc_priors(
+                    mcat_sidx, mags, magmin, magmax, magbinsize, rndcat
+                )
+                counts['random_positions'] = _npositions(rndcat)
+                if cache_key is not None:
+                    prior_cache.put(cache_key, self._priors)
+            else:            
+                self._priors = priors
+
+        with profile.stage('background'):
+            self._bkg = BKGpdf(self.scat, mags, magmin, magmax, magbinsize)
         #sys.exit()
         log.info('Calculating likelihood ratios for match candidates...')
-        lr, self._lr_all = self._likelihood_ratio(mcat_pidx, mcat_sidx, mcat_d2d)
+        if output is not None:
+            with profile.stage('write_match', pairs=len(mcat_pidx)):
+                return self._write_match(
+                    mcat_pidx, mcat_sidx, mcat_d2d, prob_ratio_secondary, output, chunk_rows
+                )
+
+        with profile.stage('likelihood_ratio', pairs=len(mcat_pidx)) as counts:
+            lr, self._lr_data = self._likelihood_ratio(mcat_pidx, mcat_sidx, mcat_d2d)
+            counts['groups'] = len(self._segments)
 
         log.info('Sorting and flagging match results...')
-        match = self._final_table(lr, prob_ratio_secondary)
+        with profile.stage('final_table') as counts:
+            match = self._final_table(lr, prob_ratio_secondary)
+            counts['rows'] = len(match)
+
+        return match
+
+    @profiled()
+    def update(self, new_pcat, max_qcap_drift=0.05, on_drift='recompute'):
+        """
+        Add the sources of `new_pcat` to the primary catalogue of a
+        completed match and return the match results for all sources.
+
+        The LR of a primary source depends only on its own counterparts,
+        the priors and the background distribution. Hence, with frozen
+        priors, only the new sources are matched, and their results are
+        merged with the existing ones. The match uses the parameters
+        of the last ``run``.
+
+        The priors are no longer exact for the extended catalogue. Their
+        drift is estimated as the change in the overall identification
+        ratio (QCAP) of each prior: the mean ``prob_has_match`` of the
+        new sources is compared with that of the existing sources, and
+        weighted by the fraction of new sources. If the drift of any prior
+        is larger than `max_qcap_drift`, the policy set by `on_drift` is
+        applied.
+
+        Parameters
+        ----------
+        new_pcat : ``Catalogue``
+            New primary sources, with the same columns as the primary
+            catalogue.
+        max_qcap_drift : `float`, optional
+            Maximum drift of QCAP allowed with frozen priors. Defaults
+            to 0.05.
+        on_drift : ``str``, optional
+            Policy for larger drifts: 'recompute' runs the full match
+            (priors included) for the extended catalogue, 'warn' shows a
+            warning and keeps the frozen priors, and 'raise' raises a
+            ``ValueError``. Defaults to 'recompute'.
+
+        Returns
+        -------
+        match : Astropy ``Table``
+            Results for all primary sources, sorted as the extended
+            primary catalogue (see ``run``).
+        """
+        if on_drift not in ['recompute', 'warn', 'raise']:
+            raise ValueError('Unknown on_drift policy: {}'.format(on_drift))
+
+        if self._output is not None:
+            raise ValueError('Match results written to a file cannot be updated.')
+
+        if self._lr_data is None:
+            raise AttributeError('Match has not been performed yet!')
+
+        params = self._run_params
+        lr_data = self._lr_data
+        original_pcat = self.pcat
+        search_radius = self._search_radius
+
+        log.info('Matching {} new primary sources...'.format(len(new_pcat)))
+        self.profile.count(new_sources=len(new_pcat))
+        self.pcat = new_pcat
+        try:
+            self._search_radius = self._auto_radius(
+                params['radius'], params['radius_nsigma']
+            )
+            new_radius = self._search_radius
+            pidx, sidx, d2d = self._candidates()
+            self.profile.count(pairs=len(pidx))
+
+            _, new_data = self._likelihood_ratio(
+                pidx, sidx, d2d, self._source_terms()
+            )
+        finally:
+            self.pcat = original_pcat
+            self._search_radius = search_radius
+
+        pcat = self._append_sources(original_pcat, new_pcat)
+
+        drift = self._qcap_drift(lr_data, len(original_pcat), new_data, len(new_pcat))
+        log.info('QCAP drift with frozen priors: {}'.format(drift))
+
+        if np.any(np.abs(drift) > max_qcap_drift):
+            message = 'QCAP drift larger than {}.'.format(max_qcap_drift)
+            if on_drift == 'raise':
+                raise ValueError(message)
+
+            elif on_drift == 'warn':
+                warnings.warn(message + ' Using frozen priors.', AstropyUserWarning)
+
+            else:
+                log.info(message + ' Running full match...')
+                self.pcat = self.catalogues[0] = pcat
+
+                return self.run(**params)
+
+        # Candidates of the new sources go after the existing ones,
+        # so the merged candidates are still sorted by primary source
+        merged = dict(new_data)
+        merged['pidx'] = new_data['pidx'] + len(original_pcat)
+        for key in ['PEF', 'LR', 'REL', 'p_any', 'p_i', 'best', 'pidx', 'sidx', 'd2d']:
+            merged[key] = np.concatenate((lr_data[key], merged[key]))
+
+        if not search_radius.isscalar:
+            search_radius = np.concatenate((search_radius, new_radius))
+
+        self.pcat = self.catalogues[0] = pcat
+        self._search_radius = search_radius
+        self._lr_data = merged
+        self._lr_all = None
+
+        log.info('Sorting and flagging match results...')
+        self._segments = Segments(merged['pidx'])
+        match = self._final_table(self._lr_table(merged), params['prob_ratio_secondary'])
 
         return match
 
     # Override the BaseMatch method
+    @profiled()
     def stats(
         self,
         match,
@@ -196,6 +465,9 @@ class LRMatch(BaseMatch):
         Calculates and store match statistics (completness and reliability)
         for a range of LR thresholds. This can be used later to select the
         optimal threshold.
+
+        If `ncutoff` is 'unique', the thresholds are all the distinct
+        values of the cutoff column (see ``sweep.cutoff_grid``).
         """
         # parametrise common statistics/definitions that
         # quantify the reliability and completeness of
@@ -211,18 +483,19 @@ class LRMatch(BaseMatch):
             mask = match['ncat'] == 2
 
         lrdata = match[mask]
+        sweep = ThresholdSweep(lrdata[self._cutoff_column])
 
         stats = Table()
-        stats['cutoff'] = np.linspace(mincutoff, maxcutoff, num=ncutoff)
-        stats['completeness'] = np.nan
-        stats['reliability'] = np.nan
+        stats['cutoff'] = cutoff_grid(
+            ncutoff, mincutoff, maxcutoff, lrdata[self._cutoff_column]
+        )
+        ngood = sweep.above(stats['cutoff'])
 
-        for i, lrlim in enumerate(stats['cutoff']):
-            rel_good = lrdata['REL_BEST'][lrdata[self._cutoff_column] > lrlim]
-            #CHILR[i] = float(rel_good.size)/len(self.pcat) # sample completeness
-            #stats['CHILR'][i] = np.sum(rel_good)/len(self.pcat)  # completeness
-            stats['completeness'][i] = float(rel_good.size)/len(lrdata) # completeness (AGE)
-            stats['reliability'][i] = np.mean(rel_good)                # reliability
+        with np.errstate(divide='ignore', invalid='ignore'):
+            #CHILR = ngood/len(self.pcat) # sample completeness
+            #stats['CHILR'] = sweep.above(stats['cutoff'], lrdata['REL_BEST'])/len(self.pcat)  # completeness
+            stats['completeness'] = ngood/len(lrdata) # completeness (AGE)
+            stats['reliability'] = sweep.above(stats['cutoff'], lrdata['REL_BEST'])/ngood # reliability
 
         stats['error_rate'] = 1 - stats['reliability']
         stats['CR'] = stats['completeness'] + stats['reliability']
@@ -233,6 +506,7 @@ class LRMatch(BaseMatch):
         return stats
 
     # Overrides the BaseMatch method
+    @profiled()
     def stats_rndmatch(
         self,
         match,
@@ -264,18 +538,39 @@ class LRMatch(BaseMatch):
             (np.array(p_any0_offset), np.zeros(size))
         )
 
-        cutoffs = np.linspace(mincutoff, maxcutoff, num=ncutoff)
+        cutoffs = cutoff_grid(
+            ncutoff, mincutoff, maxcutoff, np.append(p_any0, p_any0_offset)
+        )
 
         stats = Table()
         stats['cutoff'] = cutoffs
-        stats['completeness'] = [(p_any0 > c).mean() for c in cutoffs]
-        stats['error_rate'] = [(p_any0_offset > c).mean() for c in cutoffs]
+        stats['completeness'] = ThresholdSweep(p_any0).above(cutoffs)/len(p_any0)
+        stats['error_rate'] = (
+            ThresholdSweep(p_any0_offset).above(cutoffs)/len(p_any0_offset)
+        )
         stats['reliability'] = 1 - stats['error_rate']
         stats['CR'] = stats['completeness'] + stats['reliability']
 
         return stats
 
     ### Internal Methods
+    def _auto_radius(self, radius, nsigma):
+        """
+        Search radius for each primary source if `radius` is 'auto' (see
+        ``run``), or `radius` otherwise.
+        """
+        if not isinstance(radius, str):
+            return radius
+
+        if radius != 'auto':
+            raise ValueError('Unknown radius: {}'.format(radius))
+
+        pvar = _max_variance(self.pcat.poserr)
+        svar = _max_variance(self.scat.poserr)
+        svar = svar.max() if len(svar) > 0 else 0
+
+        return (nsigma*np.sqrt(pvar + svar)).to(u.arcsec)
+
     def _candidates(self):
         """
         Identify all possible counterparts for the primary sources in the
@@ -291,16 +586,297 @@ class LRMatch(BaseMatch):
         d2d : numpy ``ndarray``
             Distance between the primary source and the counterpart in the
             secondary catalogue.
-        See the documentation of Astropy's ``search_around_sky`` tool for more
+        See the documentation of ``SpatialIndex.search_around_sky`` for more
         details about the output.
         """
         pcoords = self.pcat.coords
-        scoords = self.scat.coords
-        pidx, sidx, d2d, _ = scoords.search_around_sky(pcoords, self.radius)
+        pidx, sidx, d2d = self.scat.index.search_around_sky(
+            pcoords, self._search_radius, max_memory=self._max_memory
+        )
         #print(pidx, sidx, ded)
-        return pidx, sidx, d2d
+        return self._mahalanobis_cut(self.pcat, self.scat, pidx, sidx, d2d)
 
-    def _calc_priors(self, sidx, mags, magmin, magmax, magbinsize, method, seed):
+    @staticmethod
+    def _qcap_drift(lr_data, nsources, new_data, new_nsources):
+        """
+        Estimated change in the QCAP of each prior when the priors are
+        calculated again including the new sources (see ``update``).
+        """
+        def mean_p_any(data, n):
+            # Mean prob_has_match of all primary sources (zero for
+            # sources with no counterparts) for each prior
+            if n == 0:
+                return 0.0
+
+            first = Segments(data['pidx']).offsets[:-1]
+            return data['p_any'][first].sum(axis=0) / n
+
+        new_fraction = new_nsources / (nsources + new_nsources)
+        delta = mean_p_any(new_data, new_nsources) - mean_p_any(lr_data, nsources)
+
+        return new_fraction * np.atleast_1d(delta)
+
+    def _mahalanobis_cut(self, pcat, scat, pidx, sidx, d2d):
+        # Remove pairs with Mahalanobis distance above _max_mahalanobis
+        if self._max_mahalanobis is None or len(pidx) == 0:
+            return pidx, sidx, d2d
+
+        pa, cov = self._pair_covariance(pcat, scat, pidx, sidx)
+        keep = mahalanobis(d2d, pa, cov) <= self._max_mahalanobis
+
+        return pidx[keep], sidx[keep], d2d[keep]
+
+    def _sharded_match(
+        self,
+        priors,
+        mags,
+        magmin,
+        magmax,
+        magbinsize,
+        prior_method,
+        seed,
+        prob_ratio_secondary,
+        n_workers
+    ):
+        """
+        LR crossmatch (see ``run``) using a pool of `n_workers` processes.
+        The primary catalogue is split in shards of contiguous sky tiles
+        (several shards per worker, for a better balance of the load).
+
+        For each shard, the workers search for the match candidates and for
+        the field sources used in the estimation of the priors. Only the
+        reduced field counts are merged for building the global priors.
+        Then each shard, with its match candidates, is processed
+        independently using the global priors, since all the quantities
+        calculated in the LR method for a primary source depend only on
+        its own counterparts.
+        """
+        shards = tile_partition(self.pcat.coords, 4*n_workers)
+
+        if priors:
+            rndcat, rnd_shards = None, [None]*len(shards)
+        else:
+            rndcat = self._prior_rndcat(prior_method, seed)
+            if rndcat is not False:
+                # Blocks of random positions searched in each task
+                rnd_shards = np.array_split(np.arange(rndcat.nblocks), len(shards))
+            else:
+                rnd_shards = [None]*len(shards)
+
+        # The index of the secondary catalogue is built before starting the
+        # workers, so it is shared by all of them (see _map_shards)
+        self.scat.index
+        self._rndcat = rndcat
+
+        profile = self.profile
+
+        # Field sources for the priors are searched in the same tasks
+        log.info('Searching for match candidates within {}...'.format(self.radius))
+        tasks = [('_search_shard', shard, rnd_shard)
+                 for shard, rnd_shard in zip(shards, rnd_shards)]
+        with profile.stage('candidates', shards=len(shards)) as counts:
+            try:
+                candidates = self._map_shards(tasks, n_workers)
+            finally:
+                self._rndcat = None
+
+            counts['pairs'] = sum(len(shard_pidx) for shard_pidx, _, _, _ in candidates)
+
+        log.info('Calculating priors...')
+        with profile.stage('priors') as counts:
+            if not priors:
+                sidx = np.concatenate([shard_sidx for _, shard_sidx, _, _ in candidates])
+                field_counts = self._merge_field_counts(
+                    [field for _, _, _, field in candidates], rndcat
+                )
+                self._priors = self._calc_priors(
+                    sidx, mags, magmin, magmax, magbinsize, rndcat, field_counts
+                )
+                counts['random_positions'] = _npositions(rndcat)
+            else:
+                self._priors = priors
+
+        with profile.stage('background'):
+            self._bkg = BKGpdf(self.scat, mags, magmin, magmax, magbinsize)
+
+        log.info('Calculating likelihood ratios for match candidates...')
+        tasks = [
+            ('_match_shard', pidx, sidx, d2d)
+            for pidx, sidx, d2d, _ in candidates
+        ]
+        with profile.stage('likelihood_ratio', shards=len(shards)) as counts:
+            results = self._map_shards(tasks, n_workers)
+
+            # Candidates of each shard are sorted by primary source. The order
+            # of the candidates in the serial calculation is recovered
+            # sorting by primary source all candidates.
+            pidx = np.concatenate([shard_pidx for shard_pidx, _, _, _ in candidates])
+            sorter = np.argsort(pidx, kind='stable')
+
+            lr_data = {
+                'names': results[0]['names'],
+                'QCAP': results[0]['QCAP'],
+            }
+            for key in ['PEF', 'LR', 'REL', 'p_any', 'p_i', 'best']:
+                lr_data[key] = np.concatenate([data[key] for data in results])[sorter]
+
+            lr_data['pidx'] = pidx[sorter]
+            lr_data['sidx'] = np.concatenate([sidx for _, sidx, _, _ in candidates])[sorter]
+            lr_data['d2d'] = np.concatenate([d2d for _, _, d2d, _ in candidates])[sorter]
+            log.debug('QCAP: {}'.format(lr_data['QCAP']))
+
+            self._segments = Segments(lr_data['pidx'])
+            counts['pairs'] = len(lr_data['pidx'])
+            counts['groups'] = len(self._segments)
+
+        log.info('Sorting and flagging match results...')
+        with profile.stage('final_table') as counts:
+            match = self._final_table(self._lr_table(lr_data), prob_ratio_secondary)
+            counts['rows'] = len(match)
+
+        return match, lr_data
+
+    def _write_match(self, pidx, sidx, d2d, prob_ratio_secondary, output, chunk_rows):
+        # LR match written to `output` in chunks of about `chunk_rows` rows
+        # of the final table. Each chunk is the final table of a range of
+        # primary sources, matched with a slice of the primary catalogue,
+        # so chunks are written in the same order as the final table of a
+        # match done in a single step (see _final_table).
+        original_pcat = self.pcat
+        npsrcs = len(original_pcat)
+        terms = self._source_terms()
+
+        # Rows of the final table up to each primary source: a row with no
+        # counterpart plus a row for each candidate. Candidates are sorted
+        # by primary source, so the candidates of each chunk are contiguous.
+        nrows = np.cumsum(np.bincount(pidx, minlength=npsrcs) + 1)
+        total = nrows[-1] if npsrcs > 0 else 0
+        starts = np.searchsorted(
+            nrows, np.arange(0, max(total, 1), chunk_rows), side='right'
+        )
+        bounds = np.append(np.unique(starts), npsrcs)
+        cand_bounds = np.searchsorted(pidx, bounds)
+
+        with MatchWriter(output) as writer:
+            try:
+                for i in range(len(bounds) - 1):
+                    start, stop = bounds[i], bounds[i + 1]
+                    cands = slice(cand_bounds[i], cand_bounds[i + 1])
+                    self.pcat = original_pcat[start:stop]
+
+                    lr, _ = self._likelihood_ratio(
+                        pidx[cands] - start, sidx[cands], d2d[cands], terms
+                    )
+
+                    writer.write(self._final_table(lr, prob_ratio_secondary))
+            finally:
+                self.pcat = original_pcat
+
+        log.info('Match results written to {}.'.format(output))
+
+        return MatchFile(writer.path, writer.format)
+
+    def _map_shards(self, tasks, n_workers):
+        # Run the tasks (name of the method and its arguments) in a pool of
+        # processes. Workers are forked, so they get the current state of
+        # the match (catalogues, priors...) without copying it. Where the
+        # fork start method is not available (e.g. Windows), tasks are
+        # run serially in this process.
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            log.warning('fork start method not available, running shards serially')
+            return [getattr(self, task[0])(*task[1:]) for task in tasks]
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_shard_worker,
+            initargs=(self,),
+        ) as executor:
+            return list(executor.map(_run_shard, tasks))
+
+    def _search_shard(self, shard, rnd_shard):
+        # Match candidates for the primary sources in shard (with pidx
+        # relative to the whole catalogue) and field sources for the
+        # prior calculation (see _merge_field_counts).
+        pcoords = self.pcat.coords[shard]
+        index = self.scat.index
+        rndcat = self._rndcat
+
+        radius = self._search_radius
+        if not radius.isscalar:
+            radius = radius[shard]
+
+        pidx, sidx, d2d = index.search_around_sky(
+            pcoords, radius, max_memory=self._max_memory
+        )
+        pidx, sidx, d2d = self._mahalanobis_cut(
+            self.pcat, self.scat, shard[pidx], sidx, d2d
+        )
+
+        if rndcat is None:
+            field = None
+
+        elif rndcat is False:
+            # Mask method: sources close to the primary sources
+            near = index.near_mask(
+                pcoords, PriorND.mask_radius, max_memory=self._max_memory
+            )
+            field = np.flatnonzero(near)
+
+        else:
+            # Random method: sources close to the random positions
+            # (blocks in rnd_shard) and number of positions per block
+            counts = PriorND.random_field_counts(
+                self.scat,
+                (rndcat.block(k, sources=True) for k in rnd_shard),
+                self._search_radius,
+                max_memory=self._max_memory,
+            )
+            field_sidx = np.flatnonzero(counts)
+            sizes = {k: rndcat.sizes[k] for k in rnd_shard}
+            field = (field_sidx, counts[field_sidx], sizes)
+
+        return pidx, sidx, d2d, field
+
+    def _merge_field_counts(self, fields, rndcat):
+        # Number of times each source of the secondary catalogue is
+        # selected as a field source (see the field_counts of ``PriorND``).
+        if rndcat is False:
+            near = np.zeros(len(self.scat), dtype=bool)
+            for near_sidx in fields:
+                near[near_sidx] = True
+
+            return (~near).astype(int)
+
+        field_counts = np.zeros(len(self.scat), dtype=int)
+        for field_sidx, counts, sizes in fields:
+            field_counts[field_sidx] += counts
+            rndcat.sizes.update(sizes)
+
+        return field_counts
+
+    def _match_shard(self, pidx, sidx, d2d):
+        # LR for the match candidates of a shard, using the global priors.
+        # The final table is built with the results of all shards.
+        _, lr_data = self._likelihood_ratio(pidx, sidx, d2d)
+
+        return lr_data
+
+    def _prior_rndcat(self, method, seed):
+        # Random positions for the prior calculation, generated lazily
+        # (False for the mask method).
+        if method == 'mask':
+            return False
+        elif method == 'random':
+            return RandomPositions(
+                self.pcat, numrepeat=self.random_numrepeat, seed=seed
+            )
+        else:
+            raise ValueError('Unknown method: {}'.format(method))
+
+    def _calc_priors(
+        self, sidx, mags, magmin, magmax, magbinsize, rndcat, field_counts=None
+    ):
         """
         Estimates the prior probability distribution for a source in the
         primary catalogue having a counterpart in the secondary catalogue
@@ -326,9 +902,12 @@ class LRMatch(BaseMatch):
             Upper magnitude limit when estimating magnitude distributions.
         magbinsize : `float`, optional
             Magnitude bin width when estimating magnitude distributions.
-        method : 'random' or 'mask'
-            Method for estimating the magnitude distribution of spurious
-            matches. See the documentation of ``run`` method for details.
+        rndcat : ``RandomPositions``, ``Catalogue`` or `False`
+            Random positions for estimating the magnitude distribution of
+            spurious matches, or `False` for using the mask method. See the
+            documentation of ``run`` method for details.
+        field_counts : numpy ``ndarray`` or `None`, optional
+            Precomputed counts of field sources (see ``PriorND``).
 
         Return
         ------
@@ -338,21 +917,14 @@ class LRMatch(BaseMatch):
             secondary catalogue.
         """
         #print(magmin, magmax, magbinsize)
-        
-        if method == 'mask':
-            rndcat = False
-        elif method == 'random':
-            rndcat = self.pcat.randomise(numrepeat=self.random_numrepeat, seed=seed)
-        else:
-            raise ValueError('Unknown method: {}'.format(method))
-
-        priors = PriorND(self.pcat, self.scat, rndcat, self.radius, mags, 
-                       magmin, magmax, magbinsize, self.scat.mags[sidx])
+        priors = PriorND(self.pcat, self.scat, rndcat, self._search_radius, mags, 
+                       magmin, magmax, magbinsize, self.scat.mags[sidx],
+                       field_counts=field_counts)
 
         #priors.plot("prior0")
         return priors
 
-    def _likelihood_ratio(self, pidx, sidx, d2d):
+    def _likelihood_ratio(self, pidx, sidx, d2d, terms=None):
         """
         Estimates the likelihood ratio for all counterparts and for each
         magnitude band.
@@ -367,166 +939,210 @@ class LRMatch(BaseMatch):
         d2d : numpy ``ndarray``
             Distance between the primary source and the counterpart in the
             secondary catalogue.
+        terms : ``tuple`` or `None`, optional
+            Precomputed prior and background terms for all sources of the
+            secondary catalogue (see ``_source_terms``). If `None`, they
+            are calculated for the counterparts.
 
         Return
         ------
         lr : Astropy ``Table``
-            Table with the likelihood ratios for each counterpart and each
-            available magnitude in the secondary catalogue.
+            Table with the likelihood ratio, reliability and probabilities
+            of the best prior for each counterpart.
+        lr_data : ``dict``
+            Arrays with the results for all priors (see ``_lr_kernel``).
+            They can be converted into a table using ``_lr_all_table``.
         """
-        pcat_idcol = 'SRCID_{}'.format(self.pcat.name)
-        scat_idcol = 'SRCID_{}'.format(self.scat.name)
-        drcol = 'Separation_{}_{}'.format(self.pcat.name, self.scat.name)
-
-        lr = Table()
-        lr[pcat_idcol] = self.pcat.ids[pidx]
-        lr[scat_idcol] = self.scat.ids[sidx]
-        lr[drcol] = d2d.to(u.arcsec)
-        lr['ncat'] = 2
-        lr['PEF'] = self._pos_err_function(d2d, pidx, sidx)
-        #print(lr)
-        #self._qnterms(lr, self.scat.mags[sidx])
-        self._lrND(lr, self.scat.mags[sidx])
-
         # For estimating the reliability, the table has to be grouped.
-        # Note that this changes the order of the rows!!!
-        lr = lr.group_by(pcat_idcol)
-        self._reliabilityND(lr)
-
-        self._p_any_bestND(lr)
-        lr_all = lr.copy()
+        # Candidates are already sorted by primary source, so the groups
+        # are just contiguous segments of rows. These segments are reused
+        # later for building the final table.
+        self._segments = Segments(pidx)
 
-        final_columns = [pcat_idcol, scat_idcol, drcol, 'ncat',
-                         'LR_BEST', 'REL_BEST', 'LR_BEST_MAG',
-                         'prob_has_match', 'prob_this_match',
-                         ]
-        lr.keep_columns(final_columns)
+        if terms is None:
+            qterm, nterm = self._mag_terms(self.scat.mags[sidx])
+        else:
+            qterm, nterm = terms[0][sidx], terms[1][sidx]
 
-        return lr, lr_all
+        pef = self._pos_err_function(d2d, pidx, sidx)
+        lr_data = self._lr_kernel(pef, qterm, nterm, self._segments)
+        lr_data['pidx'], lr_data['sidx'], lr_data['d2d'] = pidx, sidx, d2d
+        log.debug('QCAP: {}'.format(lr_data['QCAP']))
 
-    ### methods for _likelihood_ratio
-    def _pos_err_function(self, radius, pidx, sidx):
+        return self._lr_table(lr_data), lr_data
 
-        if(self.poserr_dist.lower()=="normal"):
-            return self._pos_err_function_normal(radius, pidx, sidx)
-        elif(self.poserr_dist.lower()=="rayleigh"):
-           return self._pos_err_function_rayleigh(radius, pidx, sidx)
-        else:
-            raise ValueError('Unknown method: {}'.format(self.poserr_dist))
+    def _lr_table(self, lr_data):
+        # Table of the match candidates with the results for the best prior
+        pcat_idcol = 'SRCID_{}'.format(self.pcat.name)
+        scat_idcol = 'SRCID_{}'.format(self.scat.name)
+        drcol = 'Separation_{}_{}'.format(self.pcat.name, self.scat.name)
 
-        
-    def _pos_err_function_rayleigh(self, radius, pidx, sidx):
-        # radius is offset between opt/xray counter in arcsec
-        # I assume that the pos is Gaussian.
-        # NOTE: This returns prob per square *arcsec*  !!!!
-        ppos_error = self.pcat.poserr[pidx].as_array()
-        spos_error = self.scat.poserr[sidx].as_array()
+        rows = np.arange(len(lr_data['pidx']))
+        best = lr_data['best']
 
-        # Rayleigh
-        sigma2 = ppos_error**2 + spos_error**2
-        exponent = -radius**2 / sigma2        
-        return np.exp(exponent) / sigma2 * 2 * radius
+        # Sources are identified by their rows in the catalogues (integer
+        # codes). Their ids are added to the final table (see _add_srcids).
+        lr = Table()
+        lr[pcat_idcol] = lr_data['pidx']
+        lr[scat_idcol] = lr_data['sidx']
+        lr[drcol] = lr_data['d2d'].to(u.arcsec)
+        lr['ncat'] = np.full(len(lr), 2)
+        lr['LR_BEST'] = lr_data['LR'][rows, best]
+        lr['REL_BEST'] = lr_data['REL'][rows, best]
+        lr['LR_BEST_MAG'] = lr_data['names'][best]
+        lr['prob_has_match'] = lr_data['p_any'][rows, best]
+        lr['prob_this_match'] = lr_data['p_i'][rows, best]
+        lr.meta['QCAP'] = str(lr_data['QCAP'])
+
+        return lr
 
-    
-    def _pos_err_function_normal(self, radius, pidx, sidx):
-        # radius is offset between opt/xray counter in arcsec
+    ### methods for _likelihood_ratio
+    def _pos_err_function(self, radius, pidx, sidx):
+        # radius is offset between opt/xray counter
         # I assume that the pos is Gaussian.
         # NOTE: This returns prob per square *arcsec*  !!!!
-        ppos_error = self.pcat.poserr[pidx].as_array()
-        spos_error = self.scat.poserr[sidx].as_array()
-
-        # Gaussian
-        sigma2 = ppos_error**2 + spos_error**2
-        exponent = -radius**2 / (2*sigma2)
-        return np.exp(exponent) / (2*np.pi*sigma2)
+        # See ``kernels.pos_err_function``.
+        circular = [cat.poserr.errtype == 'circle' for cat in [self.pcat, self.scat]]
+        if all(circular):
+            return pos_err_function(
+                radius,
+                self.pcat.poserr.as_array(),
+                self.scat.poserr.as_array(),
+                pidx,
+                sidx,
+                self.poserr_dist.lower(),
+            )
 
+        # Non-circular errors: bivariate normal distribution with the
+        # sum of the covariance matrices of each pair
+        pa, cov = self._pair_covariance(self.pcat, self.scat, pidx, sidx)
+
+        return pos_err_function_cov(radius, pa, cov, self.poserr_dist.lower())
+
+    @staticmethod
+    def _pair_covariance(pcat, scat, pidx, sidx):
+        # Position angles of the offsets and summed covariance matrices
+        # of the pairs (see ``kernels.pos_err_function_cov``)
+        pa = position_angle(
+            pcat.coords.ra.rad[pidx],
+            pcat.coords.dec.rad[pidx],
+            scat.coords.ra.rad[sidx],
+            scat.coords.dec.rad[sidx],
+        )
+        cov = pair_covariance(
+            pcat.poserr.covariance_array(), scat.poserr.covariance_array(), pidx, sidx
+        )
 
-    def _lrND(self, lr_table, mags):
+        return pa, cov
 
-        # here the loop is over .priors.dict_prior.keys
-        # then for each [name] I define arrays
-        # I define tuples and the get the results from
-        # the prior. 
-        
-        for col in self._priors.prior_dict.keys():
-            #print(col,  self._priors.prior_dict.keys()
-            qterm = self._priors.interp(mags, col)
-            nterm = self._bkg.interp(mags, col)
+    def _mag_terms(self, mags):
+        # Prior (qterm) and background (nterm) terms of the LR for secondary
+        # sources with magnitudes `mags`, with a column per prior.
+        names = list(self._priors.prior_dict.keys())
 
-            m = nterm ==0            
-            lr_table['LR_' + col] =  lr_table['PEF'] * qterm / nterm
+        # Bins of the magnitudes are shared by all look-ups
+        cache = MagBins(mags)
 
-            # if nterm == 0 then do not assign a lr
-            lr_table['LR_' + col][m]=0.0
-            
+        qterm = np.empty((len(mags), len(names)))
+        nterm = np.empty((len(mags), len(names)))
+        for i, col in enumerate(names):
+            qterm[:, i] = self._priors.interp(mags, col, cache)
+            nterm[:, i] = self._bkg.interp(mags, col, cache)
 
-    def _reliabilityND(self, lr_table):
-        group_size = np.diff(lr_table.groups.indices)
+        return qterm, nterm
 
-       
+    def _source_terms(self):
+        # Terms of _mag_terms for all sources of the secondary catalogue.
+        # They only depend on the magnitudes of each source, so they are
+        # calculated once and reused by all the Monte Carlo realisations
+        # (random and fake matches), while the priors, the background and
+        # the secondary catalogue do not change.
+        key = (self._priors, self._bkg, self.scat)
 
-        QCAP = []
-        for col in self._priors.prior_dict.keys():
-            # Overall identification ratio
-            q = self._priors.qcap(col)
-            QCAP.append(q)
+        if self._terms is None or any(a is not b for a, b in zip(self._terms[0], key)):
+            self._terms = (key, self._mag_terms(self.scat.mags))
 
-            # Add all values of LR for each group, i.e., all
-            # matches for a source of the primary catalogue.
-            sumlr = lr_table['LR_' + col].groups.aggregate(np.sum)
-            #print(sumlr.shape)
-            # The previous array has a length equal to the number of groups.
-            # We need to rebuild the array having the same length as the
-            # original table for using element-wise operations. We repeat
-            # each element of sumlr as many times as the size of the
-            # corresponding group
-            sumlr = np.repeat(sumlr, group_size)
-            #print(sumlr.shape)
-            lr_table['REL_' + col] = lr_table['LR_' + col] / (sumlr + (1-q))
-
-            # Probability that the primary source has a counterpart in magcol
-            # i.e. the sum of reliabilities for all matches of a given source
-            sumrel = lr_table['REL_' + col].groups.aggregate(np.sum)
-            sumrel = np.repeat(sumrel, group_size)
-            lr_table['p_any_' + col] = sumrel
-
-            # Relative probability for a given counterpart
-            lr_table['p_i_' + col] = (lr_table['REL_' + col] /
-                                         lr_table['p_any_' + col])
-
-        print(QCAP)
-        #for g in lr_table.groups:
-        #    print(lr_table['LR_' + col])
-        
-        lr_table.meta['QCAP'] = str(QCAP)
-        #lr_table.write("e.fits", format='fits', overwrite=True)
-        
-    def _p_any_bestND(self, lr_table):
-        pa_array = np.ndarray((len(lr_table), len(self._priors.prior_dict)))
-        pi_array = np.ndarray((len(lr_table), len(self._priors.prior_dict)))
-        lr_array = np.ndarray((len(lr_table), len(self._priors.prior_dict)))
-        rel_array = np.ndarray((len(lr_table), len(self._priors.prior_dict)))
-
-        names=[]
-        for i, col in enumerate(self._priors.prior_dict.keys()):
-            lr_array[:, i] = lr_table['LR_' + col]
-            rel_array[:, i] = lr_table['REL_' + col]
-            pa_array[:, i] = lr_table['p_any_' + col]
-            pi_array[:, i] = lr_table['p_i_' + col]
-            names.append(col)
-        names=np.array(names)
-        idx_pbest = np.argmax(pa_array, axis=1)
-        #print(idx_pbest)
-        #print(names[idx_pbest])
-        uidx_pbest = (np.arange(len(lr_table)), idx_pbest)
+        return self._terms[1]
 
-        lr_table['LR_BEST'] = lr_array[uidx_pbest]
-        lr_table['REL_BEST'] = rel_array[uidx_pbest]
-        lr_table['LR_BEST_MAG'] = [names[i].encode('utf8')
-                                   for i in idx_pbest]
-        lr_table['prob_has_match'] = pa_array[uidx_pbest]
-        lr_table['prob_this_match'] = pi_array[uidx_pbest]
+    def _lr_kernel(self, pef, qterm, nterm, segments):
+        """
+        Likelihood ratio (LR), reliability (REL), probability of having a
+        counterpart (p_any) and relative probability of each counterpart
+        (p_i) for all priors, and the prior with the highest p_any for each
+        counterpart. Results for all priors are stored in 2D arrays, with
+        a column per prior, and group reductions are done at once for all
+        priors using `segments` (groups of candidates of each primary source).
+        The prior and background terms (`qterm`, `nterm`) are given with
+        the same layout (see ``_mag_terms``).
+        """
+        names = list(self._priors.prior_dict.keys())
+        pef_values = np.asarray(pef)
+
+        # if nterm == 0 then do not assign a lr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lr = pef_values[:, np.newaxis] * qterm / nterm
+        lr[nterm == 0] = 0.0
+
+        # Overall identification ratio
+        QCAP = [self._priors.qcap(col) for col in names]
+
+        # Add all values of LR for each group, i.e., all matches for a source
+        # of the primary catalogue, and repeat the sum for all rows in the group.
+        sumlr = segments.broadcast(segments.sum(lr))
+        rel = lr / (sumlr + (1 - np.array(QCAP)))
+
+        # Probability that the primary source has a counterpart
+        # i.e. the sum of reliabilities for all matches of a given source
+        p_any = segments.broadcast(segments.sum(rel))
+
+        # Relative probability for a given counterpart
+        p_i = rel / p_any
+
+        lr_data = {
+            'names': np.array([name.encode('utf8') for name in names]),
+            'QCAP': QCAP,
+            'PEF': pef,
+            'LR': lr,
+            'REL': rel,
+            'p_any': p_any,
+            'p_i': p_i,
+            'best': np.argmax(p_any, axis=1),
+        }
+
+        return lr_data
+
+    def _lr_all_table(self, lr_data):
+        # Table with the results of the LR method for all priors
+        pcat_idcol = 'SRCID_{}'.format(self.pcat.name)
+        scat_idcol = 'SRCID_{}'.format(self.scat.name)
+        drcol = 'Separation_{}_{}'.format(self.pcat.name, self.scat.name)
 
+        lr_all = Table()
+        lr_all[pcat_idcol] = self.pcat.ids[lr_data['pidx']]
+        lr_all[scat_idcol] = self.scat.ids[lr_data['sidx']]
+        lr_all[drcol] = lr_data['d2d'].to(u.arcsec)
+        lr_all['ncat'] = np.full(len(lr_all), 2)
+        lr_all['PEF'] = lr_data['PEF']
+
+        names = [name.decode('utf8') for name in lr_data['names']]
+        for i, col in enumerate(names):
+            lr_all['LR_' + col] = lr_data['LR'][:, i]
+
+        for i, col in enumerate(names):
+            lr_all['REL_' + col] = lr_data['REL'][:, i]
+            lr_all['p_any_' + col] = lr_data['p_any'][:, i]
+            lr_all['p_i_' + col] = lr_data['p_i'][:, i]
+
+        rows = np.arange(len(lr_all))
+        best = lr_data['best']
+        lr_all['LR_BEST'] = lr_data['LR'][rows, best]
+        lr_all['REL_BEST'] = lr_data['REL'][rows, best]
+        lr_all['LR_BEST_MAG'] = lr_data['names'][best]
+        lr_all['prob_has_match'] = lr_data['p_any'][rows, best]
+        lr_all['prob_this_match'] = lr_data['p_i'][rows, best]
+        lr_all.meta['QCAP'] = str(lr_data['QCAP'])
+
+        return lr_all
 
     def plot_stats(self, stats, ext):
         
@@ -665,35 +1281,75 @@ class LRMatch(BaseMatch):
 
     def _final_table(self, lr_table, prob_ratio_secondary):
         """
-        Join LR results with previous data, add match flag and sort.
+        Add a row with no counterpart for each primary source, sort as the
+        primary catalogue, add the match flags and the ids of the sources.
         """
         match = self._add_all_psources(lr_table)
         match = self._add_match_flags(match, prob_ratio_secondary)
-        match = self._sort(match)
+        match = self._add_srcids(match)
 
         return match
 
     ### methods for _final_table
     def _add_all_psources(self, lr_table):
+        # Final table with a row with no counterpart for each primary
+        # source, followed by its match candidates in decreasing order of
+        # prob_this_match, and the primary sources in the same order as
+        # the primary catalogue. Candidates are grouped by primary source
+        # (see self._segments), so the rows of the final table are found
+        # by index arithmetic over the groups, with no stacks, joins or
+        # sorts of tables.
         pcat_idcol = lr_table.colnames[0]
+        segments = self._segments
+        npsrcs = len(self.pcat)
+
+        # Number of candidates for each primary source. The row with no
+        # counterpart of a primary source goes after the candidates
+        # of all previous sources.
+        ncands = np.zeros(npsrcs, dtype=int)
+        ncands[segments.labels] = segments.sizes
+        psrc_rows = np.arange(npsrcs) + np.cumsum(ncands) - ncands
+
+        # Sort candidates within each group (NaNs at the end). Groups
+        # keep their positions, so the sorted candidates of a group follow
+        # the row with no counterpart of its primary source.
+        group = segments.broadcast(np.arange(len(segments)))
+        sorter = np.lexsort((-np.asarray(lr_table['prob_this_match']), group))
+        cand_rows = (
+            segments.broadcast(psrc_rows[segments.labels] + 1 - segments.offsets[:-1])
+            + np.arange(segments.nelements)
+        )
 
-        matched_psrcs = unique(lr_table, keys=pcat_idcol)
-        matched_psrcs.keep_columns([pcat_idcol, 'prob_has_match'])
+        # prob_has_match is the same for all candidates of a primary
+        # source, we use the first row of each segment.
+        prob_has_match = np.zeros(npsrcs)
+        prob_has_match[segments.labels] = (
+            lr_table['prob_has_match'][segments.offsets[:-1]]
+        )
 
-        all_psrcs = Table()
-        all_psrcs[pcat_idcol] = self.pcat.ids
-        all_psrcs['ncat'] = 1
-        all_psrcs['prob_this_match'] = 0.0
+        psrc_values = {
+            pcat_idcol: np.arange(npsrcs),
+            'ncat': 1,
+            'prob_this_match': 0.0,
+            'prob_has_match': prob_has_match,
+        }
+
+        # Columns not defined for the rows with no counterpart are masked
+        nrows = npsrcs + len(lr_table)
+        match = Table(meta=lr_table.meta)
+        for name, col in lr_table.columns.items():
+            data = np.zeros(nrows, dtype=col.dtype)
+            data[cand_rows] = np.asarray(col)[sorter]
+
+            if name in psrc_values:
+                data[psrc_rows] = psrc_values[name]
+                match[name] = Column(data, unit=col.unit)
+            else:
+                mask = np.ones(nrows, dtype=bool)
+                mask[cand_rows] = False
+                match[name] = MaskedColumn(data, mask=mask, unit=col.unit)
 
-        all_psrcs = join(all_psrcs, matched_psrcs, keys=pcat_idcol, join_type='left')
-        try:
-            mask = all_psrcs['prob_has_match'].mask
-            all_psrcs['prob_has_match'][mask] = 0.0
-        except AttributeError:
-            # This happens when all primary sources have counterparts
-            pass
-
-        return vstack([lr_table, all_psrcs])
+        return match
 
     def _add_match_flags(self, match, prob_ratio_secondary):
 
@@ -703,20 +1359,16 @@ class LRMatch(BaseMatch):
         col_flag = Column(name='match_flag', data=[0]*len(match))
         match.add_column(col_flag, index=idx_flag)
 
-        match = match.group_by(match.colnames[0])        
-        group_size = np.diff(match.groups.indices)
-        #print(match)
-
-        
         ## For each primary source, find the match with maximum p_i
-        pi_max = match['prob_this_match'].groups.aggregate(np.max)        
-        
-        # The previous array has a length equal to the number of groups.
-        # We need to rebuild the array having the same length as the
-        # original table for using element-wise operations. We repeat
-        # each element of sumlr as many times as the size of the
-        # corresponding group
-        pi_max = np.repeat(pi_max, group_size)
+        ## (p_i is zero for the rows with no counterpart). Rows are
+        ## grouped by primary source (see _add_all_psources).
+        segments = Segments(match[match.colnames[0]])
+        pi_max = segments.max(match['prob_this_match'])
+
+        # The previous array has a length equal to the number of primary
+        # sources. We need to rebuild the array having the same length as
+        # the match table for using element-wise operations.
+        pi_max = segments.broadcast(pi_max)
 
         mask = match['prob_this_match'] == pi_max
         match['match_flag'][mask] = 1
@@ -737,66 +1389,160 @@ class LRMatch(BaseMatch):
 
         return match
 
-    def _sort(self, match):
-        # Sort final table as the primary catalogue.
-        # We need to pass the column in pcat with the source ids.
-        return self._sort_as_pcat(match, match.colnames[0])
+    def _add_srcids(self, match):
+        # Sources are identified by their rows in the catalogues (see
+        # _likelihood_ratio). Replace these rows by the ids of the sources.
+        pcat_idcol, scat_idcol = match.colnames[:2]
+
+        for idcol, cat in zip([pcat_idcol, scat_idcol], [self.pcat, self.scat]):
+            match.replace_column(idcol, self._ids_column(cat, match[idcol], idcol))
+
+        return match
 
     ### ===
 
-    def _match_rndcat(self, **kwargs):
+    @profiled('random_match')
+    def _match_rndcat(self, seed=None, **kwargs):
         # Cross-match secondary catalogue with a randomized
         # version of the primary catalogue
-        original_pcat = deepcopy(self.pcat)
-        self.pcat = self.pcat.randomise(numrepeat=1)
+        original_pcat = self.pcat
+        self.pcat = self.pcat.randomise(numrepeat=1, seed=seed)
 
-        # Hide std ouput of lr match
-        with redirect_stdout(open(os.devnull, "w")):
-            mcat_pidx, mcat_sidx, mcat_d2d = self._candidates()
+        mcat_pidx, mcat_sidx, mcat_d2d = self._candidates()
 
-            lr, _ = self._likelihood_ratio(mcat_pidx, mcat_sidx, mcat_d2d)
+        lr, _ = self._likelihood_ratio(
+            mcat_pidx, mcat_sidx, mcat_d2d, self._source_terms()
+        )
 
-            # The value for prob_ratio_secondary doesn't matter here,
-            # because secondary matches are not used for the statistics
-            match_rnd = self._final_table(lr, prob_ratio_secondary=0.5)
+        # The value for prob_ratio_secondary doesn't matter here,
+        # because secondary matches are not used for the statistics
+        match_rnd = self._final_table(lr, prob_ratio_secondary=0.5)
 
         # Recover original pcat
         self.pcat = original_pcat
 
         return match_rnd
 
-    def _match_fake(self, candidates, **kwargs):
+    @profiled('fake_match')
+    def _match_fake(self, candidates, seed=None, **kwargs):
         # Cross-match a randomized version of the primary catalogue
         # with a secondary catalogue where fake counterparts for the primary
         # have been introduced. This is for calculating statistics using
         # the Broos et al. 2006 method.
-        original_pcat = deepcopy(self.pcat)
-        original_scat = deepcopy(self.scat)
+        original_pcat = self.pcat
+        original_scat = self.scat
 
-        self.pcat = self.pcat.randomise(numrepeat=1)
+        # The same generator is used for both random steps
+        rng = np.random.default_rng(seed)
+        self.pcat = self.pcat.randomise(numrepeat=1, seed=rng)
 
         # Create a set of fake counterparts for the primary catalogue
-        fakes = self.pcat.set_fake_counterparts(candidates)
-
-        # Remove candidates from the secondary catalogue
-        scat_nocandidates = self.scat.remove_by_id(candidates.ids)
+        fakes = self.pcat.set_fake_counterparts(candidates, seed=rng)
+
+        # The secondary catalogue is the union of the candidates-removed
+        # secondary catalogue with the catalogue of fake counterparts.
+        # Instead of building the index of this catalogue, counterparts
+        # are searched in the index of the original secondary catalogue
+        # (dropping the candidates) and in the index of the fakes.
+        removed = self._removed_candidates(candidates)
+        pidx, sidx, d2d = self._candidates()
+        keep = ~removed[sidx]
+
+        fake_pidx, fake_sidx, fake_d2d = fakes.index.search_around_sky(
+            self.pcat.coords, self._search_radius, max_memory=self._max_memory
+        )
+        fake_pidx, fake_sidx, fake_d2d = self._mahalanobis_cut(
+            self.pcat, fakes, fake_pidx, fake_sidx, fake_d2d
+        )
+        pidx = np.concatenate((pidx[keep], fake_pidx))
+        sidx = np.concatenate((sidx[keep], fake_sidx + len(original_scat)))
+        d2d = np.concatenate((d2d[keep], fake_d2d))
 
-        # Set as secondary catalogue the union of the candidates-removed
-        # secondary catalogue with the catalogue of fake counterparts
-        self.scats[0] = scat_nocandidates.join(fakes)
+        sorter = np.argsort(pidx, kind='stable')
+        pidx, sidx, d2d = pidx[sorter], sidx[sorter], d2d[sorter]
 
-        # Hide std ouput of lr match
-        with redirect_stdout(open(os.devnull, "w")):
-            mcat_pidx, mcat_sidx, mcat_d2d = self._candidates()
+        # Fake counterparts (and their terms) are appended to the original
+        # secondary catalogue. Removed candidates are kept, but they
+        # are not counterparts of any primary source.
+        terms = [
+            np.concatenate((term, fake_term))
+            for term, fake_term in zip(self._source_terms(), self._mag_terms(fakes.mags))
+        ]
+        self.scats[0] = self._append_sources(original_scat, fakes)
 
-            lr, _ = self._likelihood_ratio(mcat_pidx, mcat_sidx, mcat_d2d)
+        lr, _ = self._likelihood_ratio(pidx, sidx, d2d, terms)
 
-            # The value for prob_ratio_secondary doesn't matter here,
-            # because secondary matches are not used for the statistics
-            match_rnd = self._final_table(lr, prob_ratio_secondary=0.5)
+        # The value for prob_ratio_secondary doesn't matter here,
+        # because secondary matches are not used for the statistics
+        match_rnd = self._final_table(lr, prob_ratio_secondary=0.5)
 
         # Recover original catalogues
         self.pcat = original_pcat
         self.scats[0] = original_scat
 
         return match_rnd
+
+    def _removed_candidates(self, candidates):
+        # Mask of the candidates for fake counterparts in the secondary
+        # catalogue. The candidates are the same for all the realisations
+        # of stats_broos, so the mask is kept for the last candidates.
+        key = (self.scat, candidates)
+
+        if self._removed is None or any(a is not b for a, b in zip(self._removed[0], key)):
+            self._removed = (key, np.isin(self.scat.ids, candidates.ids))
+
+        return self._removed[1]
+
+    @staticmethod
+    def _append_sources(cat, other):
+        # New catalogue with the sources of other after those of cat.
+        # Unlike Catalogue.join, repeated sources are not removed and
+        # the metadata (name, area, MOC...) of cat is kept.
+        newcat = cat[:]
+        newcat.ids = np.concatenate((cat.ids, other.ids))
+        newcat.coords = concatenate((cat.coords, other.coords))
+        newcat.poserr = SkyCoordErr(
+            vstack([cat.poserr.components, other.poserr.components]),
+            errtype=cat.poserr.errtype,
+            check=False,
+        )
+
+        if cat.mags is not None:
+            newcat.mags = vstack([cat.mags, other.mags])
+
+        return newcat
+
+
+# Match object used by the processes of the pool in ``LRMatch._sharded_match``
+_shard_match = None
+
+
+def _init_shard_worker(match):
+    global _shard_match
+    _shard_match = match
+
+    # Stages run by the workers are not recorded
+    _shard_match.profile = StageProfile()
+
+
+def _run_shard(task):
+    method, args = task[0], task[1:]
+    return getattr(_shard_match, method)(*args)
+
+
+def _max_variance(poserr):
+    # Variance along the major axis of the positional errors
+    cov = poserr.covariance_array()
+    var_x, var_y, cov_xy = cov[:, 0], cov[:, 1], cov[:, 2]
+
+    return (var_x + var_y)/2 + np.sqrt(((var_x - var_y)/2)**2 + cov_xy**2)
+
+
+def _npositions(rndcat):
+    # Number of random positions used for the priors (none for the
+    # mask method). All blocks of RandomPositions have been generated
+    # at this point, so their sizes are already known.
+    if rndcat is False or rndcat is None:
+        return 0
+
+    return len(rndcat)
@@ -8,21 +8,31 @@ from __future__ import division
 from __future__ import print_function
 from six.moves import range
 
+import multiprocessing
 from inspect import signature
+from concurrent.futures import ProcessPoolExecutor
 
 from astropy import log
 from astropy import units as u
-from astropy.table import Table, join
+from astropy.table import Table, Column, MaskedColumn
 import numpy as np
 
 from . import broos
+from .profiling import StageProfile, profiled
+from .sweep import ThresholdSweep, cutoff_grid
 from .priors import Prior
 
 
 class BaseMatch(object):
     """
     Base class for Match classes.
+
+    The wall time, memory and row counts of the stages of ``run`` and of
+    the statistics methods are recorded in the ``profile`` attribute
+    (a ``StageProfile`` object).
     """
+    _profile = None
+
     def __init__(self, *args):
         self.catalogues = list(args)
 
@@ -45,7 +55,19 @@ class BaseMatch(object):
             except TypeError:
                 return self._priors
 
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._profile = StageProfile()
+
+        return self._profile
+
+    @profile.setter
+    def profile(self, value):
+        self._profile = value
+
     ### Public methods
+    @profiled()
     def stats(
         self,
         match,
@@ -58,6 +80,9 @@ class BaseMatch(object):
         Calculates and store match statistics (completness and reliability)
         for a range of thresholds. This can be used later to select the
         optimal threshold.
+
+        If `ncutoff` is 'unique', the thresholds are all the distinct
+        values of the cutoff column (see ``sweep.cutoff_grid``).
         """
         # parametrise common statistics/definitions that
         # quantify the reliability and completeness of
@@ -69,16 +94,17 @@ class BaseMatch(object):
 
         pdata = match[mask]
         reliability = self._reliability(pdata)
+        sweep = ThresholdSweep(pdata[self._cutoff_column])
 
         stats = Table()
-        stats['cutoff'] = np.linspace(mincutoff, maxcutoff, num=ncutoff)
-        stats['completeness'] = np.nan
-        stats['reliability'] = np.nan
+        stats['cutoff'] = cutoff_grid(
+            ncutoff, mincutoff, maxcutoff, pdata[self._cutoff_column]
+        )
+        ngood = sweep.above(stats['cutoff'])
 
-        for i, plim in enumerate(stats['cutoff']):
-            rel_good = reliability[pdata[self._cutoff_column] > plim]
-            stats['completeness'][i] = float(rel_good.size)/len(pdata) # AGE
-            stats['reliability'][i] = np.mean(rel_good)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['completeness'] = ngood/len(pdata) # AGE
+            stats['reliability'] = sweep.above(stats['cutoff'], reliability)/ngood
 
         stats['error_rate'] = 1.0 - stats['reliability']
         stats['CR'] = stats['completeness'] + stats['reliability']
@@ -88,6 +114,7 @@ class BaseMatch(object):
 
         return stats
 
+    @profiled()
     def stats_rndmatch(
         self,
         match,
@@ -109,12 +136,16 @@ class BaseMatch(object):
         mask = match_rnd['ncat'] == 1
         p_any0_offset = match_rnd['prob_has_match'][mask]
 
-        cutoffs = np.linspace(mincutoff, maxcutoff, num=ncutoff)
+        cutoffs = cutoff_grid(
+            ncutoff, mincutoff, maxcutoff, np.append(p_any0, p_any0_offset)
+        )
 
         stats = Table()
         stats['cutoff'] = cutoffs
-        stats['completeness'] = [(p_any0 > c).mean() for c in cutoffs]
-        stats['error_rate'] = [(p_any0_offset > c).mean() for c in cutoffs]
+        stats['completeness'] = ThresholdSweep(p_any0).above(cutoffs)/len(p_any0)
+        stats['error_rate'] = (
+            ThresholdSweep(p_any0_offset).above(cutoffs)/len(p_any0_offset)
+        )
         stats['reliability'] = 1 - stats['error_rate']
         stats['CR'] = stats['completeness'] + stats['reliability']
 
@@ -123,6 +154,7 @@ class BaseMatch(object):
 
         return stats
 
+    @profiled()
     def stats_broos(
         self,
         match,
@@ -131,6 +163,9 @@ class BaseMatch(object):
         mincutoff=0.0,
         maxcutoff=1.0,
         plot_to_file=None,
+        n_workers=1,
+        seed=None,
+        nboot=1000,
         **kwargs
     ):
         """
@@ -138,6 +173,14 @@ class BaseMatch(object):
         for a range of thresholds. We use here the Monte Carlo method
         presented in Broos et al. 2006, where isolated and associated populations
         of the primary catalogue are treated independently.
+
+        The `ntest` Monte Carlo iterations can run in a pool of `n_workers`
+        processes. Each iteration uses its own random stream, derived from
+        `seed` and the number of the iteration, so the results for a given
+        `seed` do not depend on `n_workers`. Uncertainties for the
+        statistics estimated with the iterations (columns ending in
+        ``_err``) are calculated by resampling the iterations `nboot`
+        times (see ``broos.stats_bootstrap``).
         """
         # TODO: incomplete implementation, only tested with LR method (two catalogues).
         if len(self.catalogues) > 2:
@@ -145,41 +188,29 @@ class BaseMatch(object):
                 'Broos method only implemented for two-catalogue cross-matchs'
             )
 
-        # TODO: estimate uncertainties in the final statistics using e.g. bootstraping
+        # Identify candidates for fake counterparts
+        mask_candidates = np.logical_and(
+            match["match_flag"] == 1, match["prob_has_match"] > 0.9
+        )
+        ids_candidates = match.columns[1][mask_candidates]
+        candidates = self.scats[0].select_by_id(ids_candidates)
+        self.profile.count(iterations=ntest, candidates=len(candidates))
+
+        # One independent random stream for each iteration, and another
+        # one for the bootstrap. The stream of the i-th iteration
+        # only depends on seed and i.
+        seeds = np.random.SeedSequence(seed).spawn(ntest + 1)
+        cutoffs = cutoff_grid(
+            ncutoff, mincutoff, maxcutoff, match[self._cutoff_column]
+        )
+        tasks = [(candidates, s, cutoffs, kwargs) for s in seeds[:ntest]]
+
+        # The statistics of each iteration are added up as they arrive.
+        # Only these tables (not the matches) are kept, for the bootstrap.
         fstats = None
-        for _ in range(ntest):
-            stats = broos.set_stats_table(
-                ncutoff=ncutoff, mincutoff=mincutoff, maxcutoff=maxcutoff
-            )
-
-            ## Isolated population
-            # We crossmatch with a randomized pcat (nway randomization),
-            # using priors calculated for the real match
-            match_rnd = self._match_rndcat(**kwargs)
-            stats = broos.stats_isolated_pop(match_rnd, stats, self._cutoff_column)
-
-            ## Associated population
-            # We crossmatch with a randomized pcat (nway randomization)
-            # and a scat with fake counterparts for the pcat,
-            # using priors calculated for the real match
-
-            # Identify candidates for fake counterparts
-            mask_candidates = np.logical_and(
-                match["match_flag"] == 1, match["prob_has_match"] > 0.9
-            )
-            ids_candidates = match.columns[1][mask_candidates]
-            candidates = self.scats[0].select_by_id(ids_candidates)
-
-            # Run match with fake counterparts and calculate stats.
-            # We use again the priors calculated for the real match
-            match_rnd = self._match_fake(candidates, **kwargs)
-            stats = broos.stats_associated_pop(
-                match_rnd,
-                stats,
-                self._cutoff_column,
-                match_rnd.colnames[0],
-                match_rnd.colnames[1],
-            )
+        iter_stats = []
+        for stats in self._map_broos(tasks, n_workers):
+            iter_stats.append(stats)
 
             if fstats is None:
                 fstats = stats.copy()
@@ -188,6 +219,7 @@ class BaseMatch(object):
                     fstats[col] += stats[col]
 
         fstats = broos.stats_global_pop(match, fstats, self._cutoff_column, ntest)
+        fstats = broos.stats_bootstrap(fstats, iter_stats, nboot, seeds[ntest])
 
         if plot_to_file is not None:
             self._plot_stats(fstats, plot_to_file)
@@ -259,17 +291,63 @@ class BaseMatch(object):
 
         return p_cutoff
 
+    def _stats_broos_iteration(self, candidates, seed, cutoffs, kwargs):
+        # Statistics of a single Monte Carlo iteration for stats_broos
+        seed_rnd, seed_fake = seed.spawn(2)
+        stats = broos.set_stats_table(cutoffs=cutoffs)
+
+        ## Isolated population
+        # We crossmatch with a randomized pcat (nway randomization),
+        # using priors calculated for the real match
+        match_rnd = self._match_rndcat(seed=seed_rnd, **kwargs)
+        stats = broos.stats_isolated_pop(match_rnd, stats, self._cutoff_column)
+
+        ## Associated population
+        # We crossmatch with a randomized pcat (nway randomization)
+        # and a scat with fake counterparts for the pcat,
+        # using priors calculated for the real match
+        match_rnd = self._match_fake(candidates, seed=seed_fake, **kwargs)
+        stats = broos.stats_associated_pop(
+            match_rnd,
+            stats,
+            self._cutoff_column,
+            match_rnd.colnames[0],
+            match_rnd.colnames[1],
+        )
+
+        return stats
+
+    def _map_broos(self, tasks, n_workers):
+        # Run the Monte Carlo iterations, yielding their statistics in order.
+        # Workers are forked, so they get the current state of the match
+        # (catalogues, priors...) without copying it. Only the (small)
+        # statistics tables are sent back. Where the fork start method is
+        # not available (e.g. Windows), iterations are run serially.
+        if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            log.warning('fork start method not available, running iterations serially')
+            n_workers = 1
+
+        if n_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_broos_worker,
+                initargs=(self,),
+            ) as executor:
+                for stats in executor.map(_run_broos_iteration, tasks):
+                    yield stats
+        else:
+            for task in tasks:
+                yield self._stats_broos_iteration(*task)
+
     def _sort_as_pcat(self, match, pcat_idcol):
         # Sort match table as in the primary catalogue,
         # as given by the pcat_idcol column.
-        pos_table = Table()
-        pos_table[pcat_idcol] = self.pcat.ids
-        pos_table['PORDER'] = list(range(len(self.pcat)))
+        prows = self.pcat.rows_by_id(match[pcat_idcol])
 
-        match = join(match, pos_table, keys=pcat_idcol, join_type='left')
-        match['temp'] = -match['prob_this_match']  # For sorting in decreasing order
-        match.sort(['PORDER', 'ncat', 'temp'])
-        match.remove_columns(['PORDER', 'temp'])
+        # Sources not in the primary catalogue go to the end
+        prows[prows < 0] = len(self.pcat)
+        match = self._sort_by_prows(match, prows)
 
         # Change SRCIDs of secondary sources for sources
         #  with no match from '0.0' to ''
@@ -283,6 +361,37 @@ class BaseMatch(object):
 
         return match
 
+    @staticmethod
+    def _sort_by_prows(match, prows):
+        # Sort match table by the rows of the primary sources in the
+        # primary catalogue (prows), the number of catalogues and
+        # decreasing prob_this_match. All keys are numbers, so no
+        # joins or string comparisons are needed.
+        sorter = np.lexsort(
+            (-np.asarray(match['prob_this_match']), match['ncat'], prows)
+        )
+
+        return match[sorter]
+
+    @staticmethod
+    def _ids_column(cat, rows, name):
+        # Column with the ids of the sources of cat in `rows` (the integer
+        # codes of the sources, see ``Catalogue.rows_by_id``). Masked or
+        # negative rows (no source) are masked in the new column.
+        rows = np.ma.filled(np.ma.asarray(rows), -1)
+        has_source = rows >= 0
+
+        ids = np.asarray(cat.ids)
+        if len(ids) > 0:
+            ids = ids[np.where(has_source, rows, 0)]
+        else:
+            ids = np.zeros(len(rows), dtype=ids.dtype)
+
+        if np.all(has_source):
+            return Column(ids, name=name)
+        else:
+            return MaskedColumn(ids, mask=~has_source, name=name)
+
     @staticmethod
     def _plot_stats(stats, plotfile):
         import matplotlib.pyplot as plt
@@ -303,3 +412,15 @@ class BaseMatch(object):
         plt.close()
 
         log.info('created plot "{}"'.format(plotfile))
+
+
+def _init_broos_worker(match):
+    global _broos_match
+    _broos_match = match
+
+    # Stages run by the workers are not recorded
+    _broos_match.profile = StageProfile()
+
+
+def _run_broos_iteration(task):
+    return _broos_match._stats_broos_iteration(*task)
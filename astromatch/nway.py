@@ -16,7 +16,8 @@ import os
 import warnings
 from inspect import signature
 
-from numpy import isfinite
+from numpy import array, isfinite
+from numpy.random import default_rng
 
 try:
     # python 3
@@ -33,11 +34,12 @@ except NameError:
     FileNotFoundError = IOError
 
 from astropy import units as u
-from astropy.table import Table, Column, join
+from astropy.table import Table, Column
 from nwaylib import nway_match
 
 from .priors import Prior
 from .match import BaseMatch
+from .profiling import profiled
 
 
 class NWMatch(BaseMatch):
@@ -47,6 +49,7 @@ class NWMatch(BaseMatch):
     _cutoff_column = 'prob_has_match'
 
     ### Public Methods
+    @profiled()
     def run(
         self,
         radius=6*u.arcsec,
@@ -106,9 +109,16 @@ class NWMatch(BaseMatch):
         self.radius = radius
         kwargs_prior, kwargs_run = self.parse_args(kwargs)
 
-        nwaycats_list, priors_dict = self._get_nwaycats(
-                use_mags, dist_post_min, **kwargs_prior
+        profile = self.profile
+        profile.count(
+            primary_sources=len(self.pcat),
+            secondary_sources=sum(len(cat) for cat in self.scats),
         )
+
+        with profile.stage('priors'):
+            nwaycats_list, priors_dict = self._get_nwaycats(
+                    use_mags, dist_post_min, **kwargs_prior
+            )
         # We need to store the magnitude histogram files generated by nway
         # when bayes_prior is used, in order to create a proper prior.
         if use_mags and not priors_dict:
@@ -116,14 +126,17 @@ class NWMatch(BaseMatch):
         else:
             store_mag_hists = False
 
-        match = self._nway_match(
-            nwaycats_list, store_mag_hists, dist_post_min, **kwargs_run
-        )
+        with profile.stage('nway_match') as counts:
+            match = self._nway_match(
+                nwaycats_list, store_mag_hists, dist_post_min, **kwargs_run
+            )
+            counts['rows'] = len(match)
 
         if use_mags:
             # define _priors attribute
             if not priors_dict:
-                self._priors = self._prior_from_nway_hist_files(match, dist_post_min)
+                with profile.stage('priors_from_match'):
+                    self._priors = self._prior_from_nway_hist_files(match, dist_post_min)
             else:
                 self._priors = priors_dict
 
@@ -172,10 +185,12 @@ class NWMatch(BaseMatch):
             )
 
         #match = self._add_total_bayes_factor(match)
-        match = self._add_srcids(match)
+        match = Table.from_pandas(match)
 
-        pcat_idcol = 'SRCID_{}'.format(self.pcat.name)
-        match = self._sort_as_pcat(match, pcat_idcol)
+        # NWAY identifies sources by their rows in the catalogues,
+        # so the table is sorted before adding the ids of the sources
+        match = self._sort_by_prows(match, match[self.pcat.name])
+        match = self._add_srcids(match)
 
         return match
 
@@ -197,20 +212,17 @@ class NWMatch(BaseMatch):
         return match
 
     def _add_srcids(self, match):
-        match = Table.from_pandas(match)
-        match['IDX'] = range(len(match))
-
+        # Replace the columns with the rows of the sources in each
+        # catalogue (-1 for no counterpart) by the ids of the sources,
+        # at the beginning of the table.
         catalogues = [self.pcat] + list(self.scats)
         for cat in catalogues[::-1]:
-            srcids = Table()
-            srcids['SRCID_' + cat.name] = cat.ids.data
-            srcids[cat.name] = range(len(cat))
-            match = join(srcids, match, keys=cat.name, join_type='right')
-            match.remove_column(cat.name)
+            rows = array(match[cat.name])
+            rows[rows >= len(cat)] = -1
 
-        # Recover original sorting
-        match.sort('IDX')
-        match.remove_column('IDX')
+            srcids = self._ids_column(cat, rows, 'SRCID_' + cat.name)
+            match.remove_column(cat.name)
+            match.add_column(srcids, index=0)
 
         return match
 
@@ -260,13 +272,15 @@ class NWMatch(BaseMatch):
                 except (FileNotFoundError, OSError):
                     pass
 
-    def _match_rndcat(self, **kwargs):
+    @profiled('random_match')
+    def _match_rndcat(self, seed=None, **kwargs):
         # Cross-match secondary catalogues with a randomized
         # version of the primary catalogue
         xm_rnd = NWMatch(
-            self.pcat.randomise(numrepeat=1),
+            self.pcat.randomise(numrepeat=1, seed=seed),
             *self.scats
         )
+        xm_rnd.profile = self.profile
 
         if self._priors:
             use_mags = True
@@ -282,15 +296,18 @@ class NWMatch(BaseMatch):
 
         return match_rnd
 
-    def _match_fake(self, candidates, **kwargs):
+    @profiled('fake_match')
+    def _match_fake(self, candidates, seed=None, **kwargs):
         # Cross-match a randomized version of the primary catalogue
         # with a secondary catalogue where fake counterparts for the primary
         # have been introduced. This is for calculating statistics using
         # the Broos et al. 2006 method.
-        rndpcat = self.pcat.randomise(numrepeat=1)
+        # The same generator is used for both random steps
+        rng = default_rng(seed)
+        rndpcat = self.pcat.randomise(numrepeat=1, seed=rng)
 
         # Create a set of fake counterparts for the primary catalogue
-        fakes = rndpcat.set_fake_counterparts(candidates)
+        fakes = rndpcat.set_fake_counterparts(candidates, seed=rng)
 
         # Remove candidates from the secondary catalogue
         # We assume that there is only one secondary catalogue!!!
@@ -301,6 +318,7 @@ class NWMatch(BaseMatch):
         scat_withfakes = scat_nocandidates.join(fakes)
 
         xm_rnd = NWMatch(rndpcat, scat_withfakes)
+        xm_rnd.profile = self.profile
 
         if self._priors:
             use_mags = True
@@ -0,0 +1,166 @@
+"""
+astromatch module for caching on disk the priors of LR cross-matches.
+
+Priors are stored as FITS files (see ``PriorND.to_table``), named after
+a key that is a fingerprint of the catalogue data used in the prior
+calculation (positions, positional errors, area and MOC of both
+catalogues, and the magnitudes of the secondary catalogue) and of the
+parameters of the calculation. Hence a repeated cross-match with the same catalogues and
+parameters reuses the priors, while any change in the data gives a
+different key.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+from astropy import log
+from astropy import units as u
+from astropy.utils.exceptions import AstropyUserWarning
+
+from .priorsND import PriorND
+
+
+class PriorCache(object):
+    """
+    Directory of ``PriorND`` objects, indexed by the fingerprint of the
+    catalogues and the parameters used to build them.
+
+    Parameters
+    ----------
+    path : ``str``
+        Directory of the cache. It is created if it does not exist.
+    max_size : Astropy ``Quantity``, ``int`` or ``None``, optional
+        Maximum size of the cache (bytes if an ``int`` is passed). When a
+        new entry is stored, the least recently used entries are removed
+        until the cache fits within this size (the new entry is always
+        kept). If ``None``, entries are never removed. Defaults to ``None``.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def __repr__(self):
+        return '<PriorCache: {} ({} entries)>'.format(self.path, len(self))
+
+    @property
+    def size(self):
+        """Total size in bytes of the entries of the cache."""
+        return sum(os.path.getsize(filename) for filename in self._entries())
+
+    def key(self, pcat, scat, **params):
+        """
+        Key of the priors estimated for catalogues `pcat` and `scat` with
+        parameters `params`. The values of `params` must be serialisable
+        as JSON or have a representation as string (e.g. Quantities).
+        """
+        digest = hashlib.sha1()
+        _update_fingerprint(digest, pcat, mags=False)
+        _update_fingerprint(digest, scat, mags=True)
+
+        params = json.dumps(params, sort_keys=True, default=str)
+        digest.update(params.encode('utf8'))
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return the priors stored with `key`, or ``None`` if there is no
+        such entry in the cache.
+        """
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            priors = PriorND.from_table(filename, include_bkg_priors=True)
+
+        except (OSError, ValueError, KeyError) as e:
+            message = 'Removing unreadable cache entry {}: {}'.format(filename, e)
+            warnings.warn(message, AstropyUserWarning)
+            os.remove(filename)
+            return None
+
+        # Modification time is used for evicting the least recently used
+        os.utime(filename, None)
+        log.info('Using priors from cache entry {}'.format(key))
+
+        return priors
+
+    def put(self, key, priors):
+        """
+        Store `priors` (a ``PriorND`` object) with `key`.
+        """
+        filename = self._filename(key)
+
+        # Written to a temporary file first, so concurrent runs never
+        # read an incomplete entry
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        priors.to_table(include_bkg_priors=True).writeto(tmpfile, overwrite=True)
+        os.replace(tmpfile, filename)
+
+        self._evict(keep=filename)
+
+    def clear(self):
+        """Remove all entries of the cache."""
+        for filename in self._entries():
+            os.remove(filename)
+
+    def _filename(self, key):
+        return os.path.join(self.path, '{}.fits'.format(key))
+
+    def _entries(self):
+        return glob.glob(os.path.join(self.path, '*.fits'))
+
+    def _evict(self, keep):
+        if self.max_size is None:
+            return
+
+        max_size = u.Quantity(self.max_size, u.byte).value
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        sizes = [os.path.getsize(filename) for filename in entries]
+
+        total = sum(sizes)
+        for filename, size in zip(entries, sizes):
+            if total <= max_size:
+                break
+
+            if filename != keep:
+                os.remove(filename)
+                total -= size
+
+
+def _update_fingerprint(digest, cat, mags=True):
+    # Add to digest the data of catalogue cat used for the priors
+    for values in [cat.coords.ra.deg, cat.coords.dec.deg]:
+        digest.update(np.ascontiguousarray(values, dtype=float))
+
+    # Positional errors set the search limits with radius='auto'
+    cov = cat.poserr.covariance_array().to_value(u.arcsec**2)
+    digest.update(np.ascontiguousarray(cov, dtype=float))
+
+    digest.update(str(cat.area).encode('utf8'))
+    if cat.moc is not None:
+        digest.update(np.ascontiguousarray(cat.moc.to_depth29_ranges))
+
+    if mags and cat.mags is not None:
+        for col in cat.mags.colnames:
+            digest.update(col.encode('utf8'))
+            digest.update(np.ascontiguousarray(cat.mags[col], dtype=float))
@@ -262,7 +262,7 @@ class Prior(object):
 
 
     def _get_match_mags(self, pcat, scat, radius):
-        _, idx_near, _, _ = scat.coords.search_around_sky(pcat.coords, radius)
+        _, idx_near, _ = scat.index.search_around_sky(pcat.coords, radius)
 
         return scat.mags[idx_near]
 
@@ -295,14 +295,10 @@ class Prior(object):
 
     def _field_sources(self, pcat, scat, mask_radius):
         # Find sources within the mask_radius
-        pcoords = pcat.coords
-        scoords = scat.coords
-        _, idx_near, _, _ = scoords.search_around_sky(pcoords, mask_radius)
+        near = scat.index.near_mask(pcat.coords, mask_radius)
 
         # Select all sources but those within the mask_radius
-        idx_all = range(len(scat))
-        idx_far = list(set(idx_all) - set(idx_near))
-        field_cat = scat[idx_far]
+        field_cat = scat[np.flatnonzero(~near)]
 
         # Area covered by the new catalogue
         field_cat.area = scat.area - len(pcat)*np.pi*mask_radius**2
@@ -315,8 +311,7 @@ class Prior(object):
 
         # Select sources from the secondary catalogue within radius of random sources
         pcoords = self.rndcat.coords
-        scoords = scat.coords
-        _, sidx, _, _ = scoords.search_around_sky(pcoords, radius)
+        _, sidx, _ = scat.index.search_around_sky(pcoords, radius)
         rnd_scat = scat[sidx]
 
         # Area covered by the new catalogue
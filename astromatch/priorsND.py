@@ -17,7 +17,8 @@ from itertools import count
 from scipy.ndimage import gaussian_filter
 from astropy.io import fits
 from astropy import log
-from .catalogues import Catalogue
+from .catalogues import Catalogue, RandomPositions
+from .kernels import grid_lookup, axis_bins, grid_bins, grid_take
 
 
 class PriorND(object):
@@ -25,6 +26,10 @@ class PriorND(object):
     Class for probability priors.
     """
 
+    # Sources of the secondary catalogue within this distance of the
+    # primary sources are excluded from the field in the mask method.
+    mask_radius = 1*u.arcmin
+
     def __init__(
         self,
         pcat=None,
@@ -36,7 +41,8 @@ class PriorND(object):
         magmax=None,
         magbinsize=None,
         match_mags=None,
-        prior_dict=None
+        prior_dict=None,
+        field_counts=None
     ):
         """
         class to Store/Estimate the N-dimensional prior probability 
@@ -136,10 +142,15 @@ class PriorND(object):
             positions away from the primary sources and searchs for all available
             counterparts in the secondary catalogue. The magnitude distribution
             of these sources corresponds to the probability distribution of a
-            spurious match.
+            spurious match. The random positions can also be passed as a
+            ``Catalogue`` or a ``RandomPositions`` object (the latter are
+            searched block by block, see ``random_field_counts``).
         radius : Astropy ``Quantity``, optional
             Distance limit used for searching counterparts in the secondary 
-            catalogue in angular units. Default to 5 arcsec.
+            catalogue in angular units. Default to 5 arcsec. It can also be
+            an array with a limit for each source of `pcat` (see the 'auto'
+            radius of ``LRMatch.run``); in that case, random positions must
+            be passed as a ``RandomPositions`` object.
         mags : python list that includes lists of strings, optional
             Columns or combinations of columns in the scat for which
             histograms will be build. Defaults to None. If None then
@@ -154,6 +165,13 @@ class PriorND(object):
         magbinsize :  python list that includes lists of `floats` or 'auto', optional
             Bin width of the histograms. Defaults to None.  If
             None or "auto" then it defauls to 0.5. 
+        field_counts : numpy ``ndarray`` or `None`, optional
+            Number of times that each source of `scat` is selected as a
+            field source by the method set in `rndcat` (for the mask method,
+            one for the sources away from the primary sources and zero for
+            the rest). If `None`, it is calculated from the catalogues.
+            This is used when the field sources are searched in parallel
+            (see ``LRMatch.run``). Defaults to `None`.
 
         """
 
@@ -164,7 +182,8 @@ class PriorND(object):
             self.magbinsize=magbinsize
             self.mags=mags
             self._from_catalogues(pcat, scat, match_mags, rndcat, 
-                                  radius, mags, magmin, magmax, magbinsize)
+                                  radius, mags, magmin, magmax, magbinsize,
+                                  field_counts)
             
         else:
             log.info('Using provided prior...')
@@ -176,14 +195,15 @@ class PriorND(object):
             self.mags=mags
 
     def _from_catalogues(self, pcat, scat, match_mags, rndcat,
-                              radius, mags, magmin, magmax, magbinsize):
+                              radius, mags, magmin, magmax, magbinsize,
+                              field_counts=None):
         if None in [pcat, scat]:
             raise ValueError('Two Catalogues must be passed!')
 
         if rndcat is True:
             self.rndcat = pcat.randomise()
             
-        elif isinstance(rndcat, Catalogue):
+        elif isinstance(rndcat, (Catalogue, RandomPositions)):
             self.rndcat = rndcat
             
         else:
@@ -191,11 +211,17 @@ class PriorND(object):
             warnings.warn(message, AstropyUserWarning)
             self.rndcat = None
 
+        if not radius.isscalar and isinstance(self.rndcat, Catalogue):
+            raise ValueError('Random positions must be passed as a '
+                             'RandomPositions object when using a radius '
+                             'for each primary source.')
+
         #if match_mags is None:
         #    match_mags = self._get_match_mags(pcat, scat, radius)
 
         self.prior_dict = self._calc_prior_dict(
-            pcat, scat, radius, match_mags, mags, magmin, magmax, magbinsize
+            pcat, scat, radius, match_mags, mags, magmin, magmax, magbinsize,
+            field_counts
         )
 
         #self.plot("prior0".upper())
@@ -204,7 +230,7 @@ class PriorND(object):
     def magnames(self):
         return list(self.prior_dict.keys())
 
-    def interp(self, mags, col):
+    def interp(self, mags, col, cache=None):
         """
         Return the prior at magnitude values `mags` for magnitude `magcol`.
 
@@ -219,30 +245,25 @@ class PriorND(object):
 
         Parameters
         ----------
+        mags : Astropy ``Table``
+            Magnitudes (columns as defined in the prior).
+        col : `str`
+            Name of the prior.
+        cache : ``MagBins`` or `None`, optional
+            Cache of the bins of `mags`, shared with other look-ups of
+            the same magnitudes. Defaults to `None`.
         """
         if col not in self.prior_dict:
             raise ValueError('Unknown col: {}'.format(col))
 
         prior =  self.prior_dict[col.upper()]
-        q=[]
-        for i, magcol in enumerate(prior['name']):
+        if cache is not None:
+            bins = cache.bins(prior['name'], prior['edges'], prior['good'].shape)
+            return grid_take(prior['good'], bins)
 
-            if(i==0):
-                flags = np.ones(len(mags[magcol]), dtype=bool)
-            
-            edges = prior['edges']
-            indeces = ((mags[magcol] - edges[i][0]) / (edges[i][1] - edges[i][0])).astype(int)
-            m = indeces < 0
-            indeces[m]=0
-            flags[m]=False
-            m = indeces>len(edges[i])-2
-            indeces[m]=len(edges[i])-2
-            flags[m]=False
-            q.append(indeces)
-        q=tuple(q)
-        pvals = prior['good'][q]
-        pvals[np.logical_not(flags)]=0.0
-        return pvals;
+        values = [mags[magcol] for magcol in prior['name']]
+
+        return grid_lookup(values, prior['edges'], prior['good'])
     
 
     def qcap(self, magcol):
@@ -445,7 +466,7 @@ class PriorND(object):
         
     
     def _get_match_mags(self, pcat, scat, radius):
-        _, idx_near, _, _ = scat.coords.search_around_sky(pcat.coords, radius)
+        _, idx_near, _ = scat.index.search_around_sky(pcat.coords, radius)
                                 
         return scat.mags[idx_near]
 
@@ -459,14 +480,35 @@ class PriorND(object):
         magmin,
         magmax,
         magbinsize,
-        mask_radius=1*u.arcmin
+        field_counts=None
     ):
+        mask_radius = self.mask_radius
+
         if self.rndcat is None:
-            field_cat = self._field_sources(pcat, scat, mask_radius)
+            if field_counts is None:
+                field_counts = self._field_sources(pcat, scat, mask_radius)
+
+            # Area covered by the field sources
+            field_area = scat.area - len(pcat)*np.pi*mask_radius**2
+        else:
+            if field_counts is None:
+                field_counts = self._random_sources(scat, radius)
+
+            field_area = self.rndcat.search_area(radius)
+
+        # Field sources are binned once, weighted by the number of times
+        # they were selected (i.e. the histograms are the same as those of
+        # the catalogue of field sources with repetitions).
+        field_rows = np.flatnonzero(field_counts)
+        field_mags = scat.mags[field_rows]
+        field_weights = field_counts[field_rows]
+
+        if radius.isscalar:
+            match_area = len(pcat) * np.pi*radius**2
         else:
-            field_cat = self._random_sources(scat, radius)
+            match_area = np.sum(np.pi*radius**2)
 
-        renorm_factor = len(pcat) * np.pi*radius**2 / field_cat.area  # area_match / area field
+        renorm_factor = match_area / field_area  # area_match / area field
 
         prior_dict = {}        
         
@@ -485,30 +527,30 @@ class PriorND(object):
             if(isinstance(col, list)):
             
                 sample=np.ndarray([len(match_mags[col[0]]), len(col)])
-                field_sample=np.ndarray([len(field_cat.mags[col[0]]), len(col)])                               
+                field_sample=np.ndarray([len(field_mags[col[0]]), len(col)])                               
                 for i, c, mn, mx, mb in zip(count(), col, mmin, mmax, mbin):
                     if( (mn is "auto")):
-                        mn = int(min(field_cat.mags[c])-0.5)
+                        mn = int(min(field_mags[c])-0.5)
                     if( (mx is "auto")):
-                        mx = int(max(field_cat.mags[c])+0.5)
+                        mx = int(max(field_mags[c])+0.5)
                     if( (mb is "auto")):
                         mb=0.5            
                     sample[:,i] = match_mags[c]
-                    field_sample[:,i] = field_cat.mags[c]                    
+                    field_sample[:,i] = field_mags[c]                    
                     edges.append(np.arange(mn, mx+mb/2.0, mb))
                     
-                prior_dict['PRIOR{}'.format(iprior)] = self._mag_hist(len(pcat), sample, field_sample, renorm_factor, edges, col)
+                prior_dict['PRIOR{}'.format(iprior)] = self._mag_hist(len(pcat), sample, field_sample, field_weights, renorm_factor, edges, col)
             else:
                 if( (mmin is "auto")):
-                    mmin = int(min(field_cat.mags[col])-0.5)
+                    mmin = int(min(field_mags[col])-0.5)
                 if( (mmax is "auto")):
-                    mmax = int(max(field_cat.mags[col])+0.5)
+                    mmax = int(max(field_mags[col])+0.5)
                 if( (mbin is "auto")):
                     mbin=0.5            
                 sample = match_mags[c]
-                field_sample = field_cat.mags[c]                    
+                field_sample = field_mags[c]                    
                 edges.append(np.arange(mmin, mmax+mbin/2.0, mbin))
-                prior_dict["PRIOR{}".format(iprior)]=self._mag_hist(len(pcat), sample, field_sample, renorm_factor, edges, col) 
+                prior_dict["PRIOR{}".format(iprior)]=self._mag_hist(len(pcat), sample, field_sample, field_weights, renorm_factor, edges, col) 
             
         #print(prior_dict['prior0'])
         #sys.exit()
@@ -519,13 +561,14 @@ class PriorND(object):
         pcat_nsources,
         good_mags,
         field_mags,
+        field_weights,
         renorm_factor,
         edges,
         col,
     ):
 
         good_counts, bins = np.histogramdd(good_mags, edges)
-        field_counts, _ = np.histogramdd(field_mags, edges)
+        field_counts, _ = np.histogramdd(field_mags, edges, weights=field_weights)
         vol=1.0
         for l in bins:
             vol=vol*(l[1:-1]-l[0:-2])[0]
@@ -557,7 +600,7 @@ class PriorND(object):
         maghist['edges'] = edges
         maghist['vol'] = vol
         maghist['good'] = good_prior / pcat_nsources / vol
-        maghist['field'] = 1.0*field_counts / len(field_mags) / vol
+        maghist['field'] = 1.0*field_counts / np.sum(field_weights) / vol
         maghist['name'] = col
         
         #print(len(edges[0]), len(edges[1]), vol, col, maghist['good'].shape)
@@ -569,35 +612,68 @@ class PriorND(object):
     
     def _field_sources(self, pcat, scat, mask_radius):
         # Find sources within the mask_radius
-        pcoords = pcat.coords
-        scoords = scat.coords
-        _, idx_near, _, _ = scoords.search_around_sky(pcoords, mask_radius)
+        near = scat.index.near_mask(pcat.coords, mask_radius)
 
         # Select all sources but those within the mask_radius
-        idx_all = range(len(scat))
-        idx_far = list(set(idx_all) - set(idx_near))
-        field_cat = scat[idx_far]
-
-        # Area covered by the new catalogue
-        field_cat.area = scat.area - len(pcat)*np.pi*mask_radius**2
-        field_cat.moc = None
-
-        return field_cat
+        return (~near).astype(int)
 
     def _random_sources(self, scat, radius):
         assert self.rndcat is not None
 
-        # Select sources from the secondary catalogue within radius of random sources
-        pcoords = self.rndcat.coords
-        scoords = scat.coords
-        _, sidx, _, _ = scoords.search_around_sky(pcoords, radius)
-        rnd_scat = scat[sidx]
+        if isinstance(self.rndcat, Catalogue):
+            positions = [self.rndcat.coords]
+        elif radius.isscalar:
+            positions = self.rndcat
+        else:
+            positions = (
+                self.rndcat.block(k, sources=True)
+                for k in range(self.rndcat.nblocks)
+            )
 
-        # Area covered by the new catalogue
-        rnd_scat.area = len(self.rndcat)*np.pi*radius**2
-        rnd_scat.moc = None
+        return self.random_field_counts(scat, positions, radius)
 
-        return rnd_scat
+    @staticmethod
+    def random_field_counts(scat, positions, radius, max_memory=None):
+        """
+        Number of random positions within `radius` of each source of the
+        secondary catalogue `scat` (i.e. the counts of field sources for
+        the random method).
+
+        Random positions are searched block by block, and the counts of
+        each block are added in place. Hence the memory needed does not
+        depend on the total number of random positions.
+
+        Parameters
+        ----------
+        scat : ``Catalogue``
+        positions : iterable of Astropy ``SkyCoord``
+            Blocks of random positions (e.g. a ``RandomPositions`` object).
+            Blocks can also be tuples of positions and the indexes of the
+            sources they were drawn around (see ``RandomPositions.block``),
+            if `radius` is an array with a limit for each source.
+        radius : Astropy ``Quantity``
+        max_memory : Astropy ``Quantity``, `int` or `None`, optional
+            See ``SpatialIndex.iter_search_around_sky``.
+
+        Returns
+        -------
+        counts : numpy ``ndarray``
+        """
+        counts = np.zeros(len(scat), dtype=int)
+        for coords in positions:
+            seplimit = radius
+            if isinstance(coords, tuple):
+                coords, src = coords
+                if not radius.isscalar:
+                    seplimit = radius[src]
+
+            batches = scat.index.iter_search_around_sky(
+                coords, seplimit, max_memory=max_memory
+            )
+            for _, sidx, _ in batches:
+                counts += np.bincount(sidx, minlength=len(scat))
+
+        return counts
 
 
     @staticmethod
@@ -734,7 +810,7 @@ class BKGpdf(object):
         return edges, vol, name, pmin, pmax, pbin;
 
     
-    def interp(self, mags, col):
+    def interp(self, mags, col, cache=None):
         """
         Return the prior at magnitude values `mags` for magnitude `magcol`.
 
@@ -749,31 +825,26 @@ class BKGpdf(object):
 
         Parameters
         ----------
+        mags : Astropy ``Table``
+            Magnitudes (columns as defined in the distribution).
+        col : `str`
+            Name of the distribution.
+        cache : ``MagBins`` or `None`, optional
+            Cache of the bins of `mags` (see ``PriorND.interp``).
+            Defaults to `None`.
         """
 
         if col not in self.pdf_dict:
             raise ValueError('Unknown col: {}'.format(col))
 
         prior =  self.pdf_dict[col]
-        q=[]
-        for i, magcol in enumerate(prior['name']):
+        if cache is not None:
+            bins = cache.bins(prior['name'], prior['edges'], prior['pdf'].shape)
+            return grid_take(prior['pdf'], bins)
 
-            if(i==0):
-                flags = np.ones(len(mags[magcol]), dtype=bool)
-            
-            edges = prior['edges']
-            indeces = ((mags[magcol] - edges[i][0]) / (edges[i][1] - edges[i][0])).astype(int)
-            m = indeces < 0
-            indeces[m]=0
-            flags[m]=False
-            m = indeces>len(edges[i])-2
-            indeces[m]=len(edges[i])-2
-            flags[m]=False
-            q.append(indeces)
-        q=tuple(q)
-        pvals = prior['pdf'][q]
-        pvals[np.logical_not(flags)]=0.0
-        return pvals;
+        values = [mags[magcol] for magcol in prior['name']]
+
+        return grid_lookup(values, prior['edges'], prior['pdf'])
     
 
     
@@ -995,3 +1066,53 @@ def _define_magbins(magmin, magmax, magbinsize):
     limits = (magmin, magmax)
     
     return bins, limits
+
+
+class MagBins(object):
+    """
+    Cache of the bins containing a set of magnitudes in the grids of
+    ``PriorND`` and ``BKGpdf`` distributions.
+
+    The bins of each magnitude column are calculated once for each
+    binning (start, width and number of bins of the grid), and the
+    flattened N-dimensional bins once for each combination of columns
+    and binnings. Hence look-ups in grids with the same binning (e.g. a
+    prior and the corresponding background distribution) use the same
+    bins, and priors for combinations of columns reuse the bins of
+    each column.
+
+    Parameters
+    ----------
+    mags : Astropy ``Table``
+        Magnitudes.
+    """
+    def __init__(self, mags):
+        self.mags = mags
+        self._axes = {}
+        self._grids = {}
+
+    def bins(self, names, edges, shape):
+        """
+        Flat indexes (see ``kernels.grid_bins``) of the bins containing the
+        magnitudes in columns `names`, for a grid with bin `edges` and
+        `shape`.
+        """
+        keys = tuple(self._axis_key(name, e) for name, e in zip(names, edges))
+        key = (keys, tuple(shape))
+
+        if key not in self._grids:
+            axes = [self._axis(axis_key, e) for axis_key, e in zip(keys, edges)]
+            self._grids[key] = grid_bins(axes, shape)
+
+        return self._grids[key]
+
+    def _axis(self, key, edges):
+        if key not in self._axes:
+            self._axes[key] = axis_bins(self.mags[key[0]], edges)
+
+        return self._axes[key]
+
+    @staticmethod
+    def _axis_key(name, edges):
+        # The bins depend only on the start, width and number of bins
+        return (name, edges[0], edges[1] - edges[0], len(edges))
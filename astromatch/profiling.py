@@ -0,0 +1,168 @@
+"""
+astromatch module for profiling the stages of a cross-match.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available in Windows
+    resource = None
+
+
+class StageProfile(object):
+    """
+    Wall time, peak memory and row counts of the stages of a cross-match.
+
+    A record is stored when each stage ends, with the following keys:
+
+    ``stage``: name of the stage.
+
+    ``depth``: number of enclosing stages (e.g. the stages of ``run``
+    have depth 1, and ``run`` has depth 0).
+
+    ``wall_time``: duration of the stage, in seconds.
+
+    ``peak_rss``: peak resident memory of the process at the end of the
+    stage, in bytes (``None`` if it cannot be measured in this platform).
+
+    ``peak_rss_children``: peak resident memory of the largest finished
+    child process (e.g. the workers of parallel matches), in bytes.
+
+    ``counts``: number of rows processed in the stage (e.g. candidate
+    pairs, groups of candidates, random positions...).
+
+    Parameters
+    ----------
+    callback : callable or ``None``, optional
+        Function called with each record when its stage ends (e.g. for
+        sending the records to a monitoring system). Defaults to ``None``.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+        self._open_counts = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __repr__(self):
+        return '<StageProfile: {} stages>'.format(len(self))
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Context manager recording a stage called `name`, with initial
+        `counts`. It yields the dictionary of counts of the stage, which
+        can be updated within the context (see also ``count``).
+        """
+        counts = dict(counts)
+        depth = len(self._open_counts)
+        self._open_counts.append(counts)
+        start = time.perf_counter()
+
+        try:
+            yield counts
+
+        finally:
+            wall_time = time.perf_counter() - start
+            self._open_counts.pop()
+
+            record = {
+                'stage': name,
+                'depth': depth,
+                'wall_time': wall_time,
+                'peak_rss': peak_rss(),
+                'peak_rss_children': peak_rss(children=True),
+                'counts': counts,
+            }
+            self.records.append(record)
+
+            if self.callback is not None:
+                self.callback(record)
+
+    def count(self, **counts):
+        """
+        Add `counts` to the innermost stage in progress. Counts are
+        ignored if there is no stage in progress.
+        """
+        if self._open_counts:
+            self._open_counts[-1].update(counts)
+
+    def clear(self):
+        """Remove all records."""
+        self.records = []
+
+    def to_json(self, filename=None):
+        """
+        Records as a JSON string, also written to `filename` if it is
+        not ``None``.
+        """
+        data = json.dumps({'stages': self.records}, indent=2, default=_to_builtin)
+
+        if filename is not None:
+            with open(filename, 'w') as fp:
+                fp.write(data)
+
+        return data
+
+
+def profiled(name=None):
+    """
+    Decorator for methods of Match objects, recording each call as a
+    stage of the ``profile`` of the object. The stage is called `name`,
+    or as the method if `name` is ``None``.
+    """
+    def decorator(method):
+        stage_name = method.__name__ if name is None else name
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profile.stage(stage_name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def peak_rss(children=False):
+    """
+    Peak resident memory (in bytes) of the current process or, if
+    `children` is ``True``, of its largest finished child process.
+    It returns ``None`` if this cannot be measured.
+    """
+    if resource is None:
+        return None
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is given in bytes in macOS, and in kilobytes elsewhere
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+
+    return maxrss
+
+
+def _to_builtin(value):
+    # JSON serialisation of numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError('{!r} is not JSON serializable'.format(value))
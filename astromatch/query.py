@@ -0,0 +1,259 @@
+"""
+astromatch module for low-latency LR queries of a few primary sources
+against a secondary catalogue kept in memory.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import json
+import threading
+
+import numpy as np
+from astropy import log
+from astropy import units as u
+from astropy.table import Table
+
+from .catalogues import Catalogue
+from .lr import LRMatch
+from .priorsND import PriorND, BKGpdf
+
+
+class LRQueryEngine(object):
+    """
+    Likelihood ratio cross-match of small sets of primary sources (e.g.
+    new detections) with a secondary catalogue that stays loaded.
+
+    The secondary catalogue, its spatial index, the priors, the background
+    distribution and the prior and background terms of all secondary
+    sources (see ``LRMatch._source_terms``) are set up once, when the
+    engine is created. Hence each query only needs a neighbour search
+    around the new positions and the LR of their few candidates.
+
+    Parameters
+    ----------
+    scat : ``Catalogue``
+        Secondary catalogue. It must contain auxiliary data (e.g. magnitudes).
+    priors : ``PriorND`` or ``str``
+        Priors of the cross-match, or the path to a file with the priors
+        (see ``PriorND.to_table``).
+    bkg : ``BKGpdf`` or ``None``, optional
+        Magnitude distribution of the secondary sources. If ``None``, it
+        is calculated from `scat` with the magnitudes and bins of `priors`.
+        Defaults to ``None``.
+    radius : Astropy ``Quantity`` or 'auto', optional
+        Distance limit for searching counterparts (see ``LRMatch.run``).
+        Defaults to 6 arcsec.
+    poserr_dist : ``str``, optional
+        Distribution of the positional errors, 'rayleigh' or 'normal'.
+        Defaults to 'rayleigh'.
+    prob_ratio_secondary : `float`, optional
+        See ``LRMatch.run``. Defaults to 0.5.
+    radius_nsigma : `float`, optional
+        See ``LRMatch.run``. Defaults to 5.
+    max_mahalanobis : `float` or `None`, optional
+        See ``LRMatch.run``. Defaults to `None`.
+    name : ``str``, optional
+        Name of the catalogue of queried sources, used in the names of
+        the columns of the results. Defaults to 'pcat'.
+    """
+    # Largest body (in bytes) accepted in HTTP queries (see ``serve``)
+    max_body_size = 2**20
+
+    def __init__(self, scat, priors, bkg=None, radius=6*u.arcsec,
+                 poserr_dist='rayleigh', prob_ratio_secondary=0.5,
+                 radius_nsigma=5.0, max_mahalanobis=None, name='pcat'):
+
+        if scat.mags is None:
+            raise ValueError('Secondary catalogue must contain '
+                             'auxiliary data (e.g. magnitudes).')
+
+        if isinstance(priors, str):
+            priors = PriorND.from_table(priors)
+
+        if bkg is None:
+            bkg = BKGpdf(scat, priors.mags, priors.magmin,
+                         priors.magmax, priors.magbinsize)
+
+        self.radius = radius
+        self.radius_nsigma = radius_nsigma
+        self.prob_ratio_secondary = prob_ratio_secondary
+        self.name = name
+        self._lock = threading.Lock()
+
+        # The primary catalogue of the match is set for each query
+        self._match = LRMatch(None, scat)
+        self._match.poserr_dist = poserr_dist
+        self._match._priors = priors
+        self._match._bkg = bkg
+        self._match._max_mahalanobis = max_mahalanobis
+
+        # Resident data: spatial index and terms of all secondary sources
+        log.info('Setting up secondary catalogue for queries...')
+        scat.index
+        self._match._source_terms()
+
+    def __repr__(self):
+        return '<LRQueryEngine: {} ({} sources)>'.format(self.scat.name, len(self.scat))
+
+    @classmethod
+    def from_match(cls, match, **kwargs):
+        """
+        Engine with the secondary catalogue, priors, background and
+        parameters of a completed ``LRMatch`` (`kwargs` override the
+        parameters of the match).
+        """
+        params = dict(
+            bkg=match.bkg,
+            radius=match.radius,
+            poserr_dist=match.poserr_dist,
+            max_mahalanobis=match._max_mahalanobis,
+        )
+        params.update(kwargs)
+
+        return cls(match.scat, match._priors, **params)
+
+    @property
+    def scat(self):
+        return self._match.scat
+
+    @property
+    def priors(self):
+        return self._match._priors
+
+    def match(self, ra, dec, err, ids=None):
+        """
+        Counterparts in the secondary catalogue of the sources at `ra`,
+        `dec`, with circular positional errors `err`.
+
+        Parameters
+        ----------
+        ra, dec : array-like or Astropy ``Quantity``
+            Coordinates (ICRS) of the sources, in degrees if they have
+            no units.
+        err : array-like or Astropy ``Quantity``
+            1-sigma positional errors, in arcsec if they have no units.
+        ids : array-like or ``None``, optional
+            Identification labels of the sources. If ``None``, sources
+            are labelled by their position in the query. Defaults to
+            ``None``.
+
+        Returns
+        -------
+        match : Astropy ``Table``
+            Table with the same columns as the results of ``LRMatch.run``.
+        """
+        pcat = self._query_catalogue(ra, dec, err, ids)
+
+        # The state of the current query is kept in the match object,
+        # so queries from different threads are run one at a time
+        with self._lock:
+            xm = self._match
+            xm.pcat = pcat
+            xm._search_radius = xm._auto_radius(self.radius, self.radius_nsigma)
+
+            pidx, sidx, d2d = xm._candidates()
+
+            lr, xm._lr_data = xm._likelihood_ratio(
+                pidx, sidx, d2d, xm._source_terms()
+            )
+
+            return xm._final_table(lr, self.prob_ratio_secondary)
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """
+        Serve queries over HTTP until cancelled.
+
+        Clients send a POST request to /match with a JSON object with
+        lists 'ra', 'dec' (degrees) and 'err' (arcsec), and optionally
+        'ids'. The response is a JSON object with a list for each column
+        of the results of ``match`` (``null`` for masked values). Requests
+        with a body larger than ``max_body_size`` bytes are rejected.
+
+        Queries are matched in the default executor of the event loop,
+        so the server keeps accepting connections while a query is
+        running. Matches are run one at a time (see ``match``), so
+        several clients can share the engine safely.
+        """
+        server = await asyncio.start_server(self._handle_request, host, port)
+        log.info('Serving LR queries on http://{}:{}/match'.format(host, port))
+
+        async with server:
+            await server.serve_forever()
+
+    def _query_catalogue(self, ra, dec, err, ids=None):
+        # Catalogue of the queried sources. The area is only needed
+        # by the Catalogue constructor: it is not used by the queries.
+        ra = u.Quantity(ra, u.deg, ndmin=1)
+        dec = u.Quantity(dec, u.deg, ndmin=1)
+        err = u.Quantity(err, u.arcsec, ndmin=1)
+        if ids is None:
+            ids = np.arange(len(ra))
+
+        data = Table([ids, ra, dec, err], names=['SRCID', 'RA', 'DEC', 'RADEC_ERR'])
+
+        return Catalogue(data, area=self.scat.area, name=self.name)
+
+    async def _handle_request(self, reader, writer):
+        try:
+            status, body = await self._response(reader)
+        except (ValueError, KeyError, TypeError) as e:
+            status, body = '400 Bad Request', {'error': str(e)}
+
+        content = json.dumps(body).encode('utf8')
+        header = (
+            'HTTP/1.1 {}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: close\r\n\r\n'
+        ).format(status, len(content))
+
+        writer.write(header.encode('latin1') + content)
+        await writer.drain()
+        writer.close()
+
+    async def _response(self, reader):
+        request_line = (await reader.readline()).decode('latin1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin1').strip()
+            if not line:
+                break
+
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if len(request_line) < 2 or request_line[:2] != ['POST', '/match']:
+            return '404 Not Found', {'error': 'Use POST /match'}
+
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body_size:
+            message = 'Body larger than {} bytes'.format(self.max_body_size)
+            return '413 Payload Too Large', {'error': message}
+
+        query = json.loads((await reader.readexactly(length)).decode('utf8'))
+
+        loop = asyncio.get_running_loop()
+        match = await loop.run_in_executor(
+            None, self.match, query['ra'], query['dec'], query['err'], query.get('ids')
+        )
+
+        return '200 OK', _table_to_json(match)
+
+
+def _table_to_json(table):
+    # Columns of the table as lists of JSON values (masked values as None)
+    data = {}
+    for name in table.colnames:
+        col = table[name]
+        values = np.ma.asarray(col)
+        if values.dtype.kind == 'S':
+            values = np.ma.asarray(np.char.decode(values.filled(b''), 'utf8'), dtype=object)
+            values.mask = np.ma.getmaskarray(col)
+
+        data[name] = values.tolist()
+
+    return data
@@ -0,0 +1,594 @@
+"""
+astromatch module for writing match results to disk in chunks of rows,
+and for reading them lazily.
+
+Match tables are written incrementally, one chunk of rows at a time, so
+the results of a cross-match never need to be held in memory as a whole
+(see the `output` parameter of ``Match.run``). Supported formats are
+FITS, HDF5 (needs h5py) and Parquet (needs pyarrow), selected by the
+extension of the file or explicitly.
+
+Masked values are stored as NaN (float columns) or empty strings (string
+columns). The masks of other columns (e.g. integers or booleans) are
+stored in companion boolean columns, named after the masked column with
+a '_MASK' suffix. The columns that were masked in the original table are
+masked again when the file is read. The layout of the table (units,
+masked and unicode columns and the metadata of the table) is stored as
+a JSON string in the file: a header keyword for FITS files, an attribute
+of the dataset for HDF5 and the schema metadata for Parquet.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, Column, MaskedColumn
+
+
+FORMATS = {
+    '.fits': 'fits',
+    '.fit': 'fits',
+    '.fts': 'fits',
+    '.h5': 'hdf5',
+    '.hdf5': 'hdf5',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+}
+
+MATCH_TYPES = ['all', 'primary_all', 'primary', 'best']
+
+_LAYOUT_KEY = 'LAYOUT'
+_MASK_COLUMN = '{}_MASK'
+_FITS_BLOCK = 2880
+_HDF5_DATASET = 'match'
+
+
+class MatchWriter(object):
+    """
+    Writes a match table to `path`, chunk by chunk.
+
+    All chunks must have the same columns, with the same data types. The
+    file is complete only after calling ``close``, which returns a
+    ``MatchFile`` for reading the results. The writer can be used as a
+    context manager.
+
+    Parameters
+    ----------
+    path : ``str``
+        Output file. Existing files are overwritten.
+    format : 'fits', 'hdf5', 'parquet' or `None`, optional
+        Format of the file. If `None`, it is guessed from the extension
+        of `path`. Defaults to `None`.
+    """
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = _guess_format(path, format)
+        self.nrows = 0
+
+        self._backend = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, chunk):
+        """
+        Append the rows of the Astropy ``Table`` `chunk` to the file.
+        """
+        if self._backend is None:
+            layout = _table_layout(chunk)
+            self._backend = _WRITERS[self.format](self.path, chunk, layout)
+
+        self._backend.write(_filled(chunk))
+        self.nrows += len(chunk)
+
+    def close(self):
+        """
+        Finish writing the file.
+
+        Returns
+        -------
+        results : ``MatchFile``
+        """
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+
+        return MatchFile(self.path, self.format)
+
+
+class MatchFile(object):
+    """
+    Match results stored in a file (see ``MatchWriter``).
+
+    Data are read from disk only when requested: ``get_matchs`` reads
+    first the columns needed for the selection, and then only the
+    selected rows.
+
+    Parameters
+    ----------
+    path : ``str``
+        Match file.
+    format : 'fits', 'hdf5', 'parquet' or `None`, optional
+        Format of the file. If `None`, it is guessed from the extension
+        of `path`. Defaults to `None`.
+    """
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = _guess_format(path, format)
+
+        self._reader = _READERS[self.format](path)
+
+    def __len__(self):
+        return self._reader.nrows
+
+    def __repr__(self):
+        return '<MatchFile: {} ({} rows)>'.format(self.path, len(self))
+
+    @property
+    def colnames(self):
+        return list(self._reader.layout['names'])
+
+    @property
+    def meta(self):
+        return dict(self._reader.layout['meta'])
+
+    def read(self, columns=None, mask=None):
+        """
+        Read the results as an Astropy ``Table``.
+
+        Parameters
+        ----------
+        columns : ``list`` or `None`, optional
+            Names of the columns to be read. If `None`, all columns are
+            read. Defaults to `None`.
+        mask : boolean ``ndarray`` or `None`, optional
+            Rows to be read. If `None`, all rows are read.
+            Defaults to `None`.
+        """
+        if columns is None:
+            columns = self.colnames
+
+        columns = list(columns)
+        layout = self._reader.layout
+        columns += [
+            _MASK_COLUMN.format(name)
+            for name in columns if name in layout.get('mask_columns', [])
+        ]
+        data = self._reader.read(columns, mask)
+
+        return _restore_table(data, self._reader.layout)
+
+    def get_matchs(self, match_type='all'):
+        """
+        Returns an Astropy Table with matches for the primary catalogue.
+        See ``Match.get_matchs`` for the available `match_type`.
+        """
+        mask = matchs_mask(self._reader.column, match_type)
+
+        return self.read(mask=mask)
+
+
+def write_table(table, path, chunk_rows=100000, format=None):
+    """
+    Write the match `table` to `path` in chunks of `chunk_rows` rows.
+
+    Returns
+    -------
+    results : ``MatchFile``
+    """
+    with MatchWriter(path, format) as writer:
+        for start in range(0, max(len(table), 1), chunk_rows):
+            writer.write(table[start:start + chunk_rows])
+
+    return MatchFile(writer.path, writer.format)
+
+
+def matchs_mask(get_column, match_type='all'):
+    """
+    Rows of a match table of a given `match_type` (see ``Match.get_matchs``).
+
+    Parameters
+    ----------
+    get_column : callable
+        Function returning a column of the match table given its name.
+        It must raise ``KeyError`` for unknown columns.
+    match_type : 'all', 'primary_all', 'primary' or 'best', optional
+        Defaults to 'all'.
+
+    Returns
+    -------
+    mask : boolean ``ndarray``
+    """
+    if match_type not in MATCH_TYPES:
+        raise ValueError('Unknown match type: {}'.format(match_type))
+
+    if match_type == 'primary_all':
+        return np.asarray(get_column('match_flag') == 1)
+
+    mask = np.asarray(get_column('ncat') > 1)
+
+    if match_type == 'primary':
+        mask &= np.asarray(get_column('match_flag') == 1)
+
+    elif match_type == 'best':
+        try:
+            mask &= np.asarray(get_column('best_match_flag') == 1)
+        except KeyError:
+            raise ValueError('Best matchs not identified yet!')
+
+    return mask
+
+
+def _guess_format(path, format=None):
+    if format is None:
+        ext = os.path.splitext(path)[1].lower()
+        try:
+            format = FORMATS[ext]
+        except KeyError:
+            raise ValueError('Unknown format for file: {}'.format(path))
+
+    if format not in _WRITERS:
+        raise ValueError('Unknown format: {}'.format(format))
+
+    return format
+
+
+def _table_layout(table):
+    # Description of the table not kept by all formats
+    columns = table.columns.values()
+
+    return {
+        'names': table.colnames,
+        'units': {col.name: str(col.unit) for col in columns if col.unit is not None},
+        'masked': [col.name for col in columns if isinstance(col, MaskedColumn)],
+        'mask_columns': [
+            col.name for col in columns
+            if isinstance(col, MaskedColumn) and col.dtype.kind not in 'fSU'
+        ],
+        'unicode': [col.name for col in columns if col.dtype.kind == 'U'],
+        'meta': {key: str(value) for key, value in table.meta.items()},
+    }
+
+
+def _filled(table):
+    # Table with no masked values, with masked floats set to NaN and
+    # masked strings set to empty strings. The masks of other columns
+    # are added as companion columns (see _restore_table)
+    filled = Table(meta=table.meta)
+    for name, col in table.columns.items():
+        mask = None
+        if isinstance(col, MaskedColumn):
+            if col.dtype.kind == 'f':
+                col = col.filled(np.nan)
+            elif col.dtype.kind in 'SU':
+                col = col.filled('')
+            else:
+                mask = np.ma.getmaskarray(col)
+                col = col.filled()
+
+        filled[name] = col
+        if mask is not None:
+            filled[_MASK_COLUMN.format(name)] = mask
+
+    return filled
+
+
+def _restore_table(data, layout):
+    # Astropy Table from the arrays in `data` read from a match file
+    table = Table(meta=layout['meta'])
+    mask_columns = layout.get('mask_columns', [])
+    companions = {_MASK_COLUMN.format(name) for name in mask_columns}
+
+    for name, values in data.items():
+        if name in companions:
+            continue
+
+        values = np.asarray(values)
+        if not values.dtype.isnative:
+            values = values.astype(values.dtype.newbyteorder('='))
+
+        if name in layout['unicode'] and values.dtype.kind != 'U':
+            values = _to_str(values.astype(bytes))
+        elif name not in layout['unicode'] and values.dtype.kind == 'U':
+            values = _to_bytes(values)
+
+        if name in layout['masked']:
+            if name in mask_columns:
+                mask = np.asarray(data[_MASK_COLUMN.format(name)], dtype=bool)
+            elif values.dtype.kind == 'f':
+                mask = np.isnan(values)
+            elif values.dtype.kind in 'SU':
+                mask = np.char.str_len(values) == 0
+            else:
+                mask = np.zeros(len(values), dtype=bool)
+
+            table[name] = MaskedColumn(values, mask=mask)
+        else:
+            table[name] = Column(values)
+
+        table[name].unit = layout['units'].get(name)
+
+    return table
+
+
+def _strings_to_bytes(table):
+    # Structured array with unicode columns encoded as bytes (for HDF5)
+    columns = [
+        _to_bytes(col) if col.dtype.kind == 'U' else np.asarray(col)
+        for col in table.columns.values()
+    ]
+
+    return np.rec.fromarrays(columns, names=table.colnames)
+
+
+def _to_bytes(values):
+    # UTF-8 encoding of a unicode array (numpy casting for ASCII is faster)
+    try:
+        return np.asarray(values).astype(bytes)
+    except UnicodeEncodeError:
+        return np.char.encode(values, 'utf-8')
+
+
+def _to_str(values):
+    try:
+        return values.astype(str)
+    except UnicodeDecodeError:
+        return np.char.decode(values, 'utf-8')
+
+
+class _FITSWriter(object):
+    # Single binary table, whose rows are written as they arrive. The
+    # header is written again when the file is closed, with the final
+    # number of rows (the size of the header does not change). Rows are
+    # packed directly into FITS records when all columns have a native
+    # FITS type, otherwise they are converted by Astropy.
+    def __init__(self, path, table, layout):
+        self._header = fits.table_to_hdu(_filled(table[:1])).header
+        self._header[_LAYOUT_KEY] = json.dumps(layout)
+
+        self._dtype = self._record_dtype(table)
+        if self._dtype is not None and self._dtype.itemsize != self._header['NAXIS1']:
+            self._dtype = None
+
+        self._file = open(path, 'wb')
+        self._file.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        self._header_start = self._file.tell()
+        self._file.write(self._header.tostring().encode('ascii'))
+        self._nrows = 0
+
+    def write(self, table):
+        if self._dtype is None:
+            header, data = self._to_fits(table)
+
+            keys = ['NAXIS1', 'TFIELDS']
+            keys += ['TFORM{}'.format(i + 1) for i in range(header['TFIELDS'])]
+            if any(header.get(key) != self._header.get(key) for key in keys):
+                raise ValueError('Chunk not compatible with the previous rows!')
+        else:
+            data = self._records(table).tobytes()
+
+        self._file.write(data)
+        self._nrows += len(table)
+
+    def close(self):
+        # Pad the data unit to a multiple of the FITS block size
+        nbytes = self._header['NAXIS1'] * self._nrows
+        self._file.write(b'\0' * (-nbytes % _FITS_BLOCK))
+
+        self._header['NAXIS2'] = self._nrows
+        self._file.seek(self._header_start)
+        self._file.write(self._header.tostring().encode('ascii'))
+        self._file.close()
+
+    @staticmethod
+    def _record_dtype(table):
+        # Dtype of the FITS records (big-endian) for the rows of `table`,
+        # or None if some columns have no native FITS type (e.g. unsigned
+        # or single-byte integers, stored with an offset).
+        fields = []
+        for name, col in table.columns.items():
+            kind, size = col.dtype.kind, col.dtype.itemsize
+
+            if col.ndim > 1:
+                return None
+            elif kind == 'U':
+                fields.append((name, 'S{}'.format(size // 4)))
+            elif kind == 'S':
+                fields.append((name, 'S{}'.format(size)))
+            elif kind == 'b':
+                fields.append((name, 'i1'))
+            elif kind == 'f' or (kind == 'i' and size > 1):
+                fields.append((name, '>{}{}'.format(kind, size)))
+            else:
+                return None
+
+        return np.dtype(fields)
+
+    def _records(self, table):
+        records = np.zeros(len(table), dtype=self._dtype)
+
+        for name, col in table.columns.items():
+            values = np.asarray(col)
+            width = records.dtype[name].itemsize
+
+            if values.dtype.kind == 'b':
+                values = np.where(values, ord('T'), ord('F'))
+            elif values.dtype.kind in 'SU':
+                if values.dtype.itemsize // (4 if values.dtype.kind == 'U' else 1) > width:
+                    raise ValueError('Chunk not compatible with the previous rows!')
+
+            records[name] = values
+
+        return records
+
+    @staticmethod
+    def _to_fits(table):
+        # Header and the bytes of the data (no padding) of the
+        # binary table for `table`, as written by Astropy.
+        hdu = fits.table_to_hdu(table)
+
+        buffer = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer)
+
+        start = len(fits.PrimaryHDU().header.tostring()) + len(hdu.header.tostring())
+        nbytes = hdu.header['NAXIS1'] * hdu.header['NAXIS2']
+
+        return hdu.header, buffer.getvalue()[start:start + nbytes]
+
+
+class _FITSReader(object):
+    def __init__(self, path):
+        self.path = path
+
+        header = fits.getheader(path, 1)
+        self.nrows = header['NAXIS2']
+        self.layout = json.loads(header[_LAYOUT_KEY])
+
+    def column(self, name):
+        if name not in self.layout['names']:
+            raise KeyError(name)
+
+        with fits.open(self.path, memmap=True) as hdul:
+            return np.array(hdul[1].data[name])
+
+    def read(self, names, mask):
+        with fits.open(self.path, memmap=True) as hdul:
+            data = hdul[1].data
+            if mask is not None:
+                data = data[mask]
+
+            return {name: np.array(data[name]) for name in names}
+
+
+class _HDF5Writer(object):
+    def __init__(self, path, table, layout):
+        import h5py
+
+        self._file = h5py.File(path, 'w')
+        data = _strings_to_bytes(_filled(table))
+        self._dset = self._file.create_dataset(
+            _HDF5_DATASET, shape=(0,), dtype=data.dtype, maxshape=(None,), chunks=True
+        )
+        self._dset.attrs[_LAYOUT_KEY] = json.dumps(layout)
+
+    def write(self, table):
+        data = _strings_to_bytes(table)
+
+        nrows = len(self._dset)
+        self._dset.resize((nrows + len(data),))
+        self._dset[nrows:] = data
+
+    def close(self):
+        self._file.close()
+
+
+class _HDF5Reader(object):
+    def __init__(self, path):
+        import h5py
+
+        self._h5py = h5py
+        self.path = path
+
+        with h5py.File(path, 'r') as f:
+            dset = f[_HDF5_DATASET]
+            self.nrows = len(dset)
+            self.layout = json.loads(dset.attrs[_LAYOUT_KEY])
+
+    def column(self, name):
+        if name not in self.layout['names']:
+            raise KeyError(name)
+
+        with self._h5py.File(self.path, 'r') as f:
+            return f[_HDF5_DATASET].fields(name)[:]
+
+    def read(self, names, mask):
+        with self._h5py.File(self.path, 'r') as f:
+            fields = f[_HDF5_DATASET].fields(names)
+            data = fields[:] if mask is None else fields[np.asarray(mask)]
+
+        return {name: data[name] for name in names}
+
+
+class _ParquetWriter(object):
+    def __init__(self, path, table, layout):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        schema = self._to_arrow(_filled(table)).schema
+        schema = schema.with_metadata({_LAYOUT_KEY: json.dumps(layout)})
+
+        self._writer = pq.ParquetWriter(path, schema)
+
+    def write(self, table):
+        self._writer.write_table(self._to_arrow(table))
+
+    def close(self):
+        self._writer.close()
+
+    def _to_arrow(self, table):
+        return self._pa.table(
+            [self._pa.array(np.asarray(col)) for col in table.columns.values()],
+            names=table.colnames,
+        )
+
+
+class _ParquetReader(object):
+    # Rows are read by row groups (the chunks written to the file),
+    # so only one of them is held in memory at a time
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+        self.path = path
+
+        pfile = pq.ParquetFile(path)
+        self.nrows = pfile.metadata.num_rows
+        self.layout = json.loads(pfile.schema_arrow.metadata[_LAYOUT_KEY.encode()])
+
+    def column(self, name):
+        if name not in self.layout['names']:
+            raise KeyError(name)
+
+        pfile = self._pq.ParquetFile(self.path)
+        return pfile.read(columns=[name]).column(name).to_numpy()
+
+    def read(self, names, mask):
+        pfile = self._pq.ParquetFile(self.path)
+
+        chunks, start = [], 0
+        for i in range(pfile.num_row_groups):
+            group = pfile.read_row_group(i, columns=names)
+            if mask is not None:
+                group = group.filter(self._pa.array(mask[start:start + group.num_rows]))
+
+            start += pfile.metadata.row_group(i).num_rows
+            chunks.append(group)
+
+        data = {}
+        for name in names:
+            values = [chunk.column(name).to_numpy(zero_copy_only=False) for chunk in chunks]
+            values = np.concatenate(values) if values else np.array([])
+
+            if values.dtype.kind == 'O':
+                values = values.astype(bytes if name not in self.layout['unicode'] else str)
+
+            data[name] = values
+
+        return data
+
+
+_WRITERS = {'fits': _FITSWriter, 'hdf5': _HDF5Writer, 'parquet': _ParquetWriter}
+_READERS = {'fits': _FITSReader, 'hdf5': _HDF5Reader, 'parquet': _ParquetReader}
@@ -0,0 +1,105 @@
+"""
+astromatch module for reductions over groups of contiguous rows.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from .kernels import segment_reduce
+
+
+class Segments(object):
+    """
+    Groups of contiguous elements with equal labels in an array, stored
+    as segment offsets (like the row pointers of a CSR sparse matrix).
+
+    Reductions over the segments (sum, max, ...) are done with numpy
+    ``reduceat`` kernels (or their Numba equivalents, see ``kernels``),
+    and the results can be broadcast back to the elements of each segment.
+    Hence grouped operations over tables already ordered by group do not
+    need any sorting or Python-level grouping. Segments are built once
+    and can be reused for any number of columns or tables with the same
+    row order.
+
+    Parameters
+    ----------
+    labels : array-like
+        Labels of the elements. Equal labels must be contiguous.
+    """
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        if len(labels) == 0:
+            starts = starts[:0]
+
+        self.labels = labels[starts]
+        self.offsets = np.append(starts, len(labels))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return '<Segments: {} segments, {} elements>'.format(len(self), self.nelements)
+
+    @classmethod
+    def group(cls, labels):
+        """
+        Build the segments for unsorted `labels`.
+
+        Returns
+        -------
+        sorter : numpy ``ndarray``
+            Indexes that sort `labels` (stable sort). Arrays reordered with
+            these indexes are grouped as the returned segments.
+        segments : ``Segments``
+        """
+        labels = np.asarray(labels)
+        sorter = np.argsort(labels, kind='stable')
+
+        return sorter, cls(labels[sorter])
+
+    @property
+    def nelements(self):
+        return self.offsets[-1]
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def sum(self, values):
+        """
+        Sum of `values` within each segment.
+        """
+        return self._reduce(np.add, values)
+
+    def prod(self, values):
+        """
+        Product of `values` within each segment.
+        """
+        return self._reduce(np.multiply, values)
+
+    def max(self, values):
+        """
+        Maximum of `values` within each segment (NaN values propagate).
+        """
+        return self._reduce(np.maximum, values)
+
+    def broadcast(self, values):
+        """
+        Repeat each element of `values` (with a value per segment)
+        as many times as the size of the corresponding segment.
+        """
+        return np.repeat(values, self.sizes, axis=0)
+
+    def _reduce(self, ufunc, values):
+        values = np.asarray(values)
+
+        if len(self) == 0:
+            return np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+
+        return segment_reduce(ufunc, values, self.offsets[:-1])
@@ -0,0 +1,844 @@
+"""
+astromatch module with a HEALPix-partitioned spatial index for
+fast neighbour searches around catalogue positions.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import time
+import warnings
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+from astropy.io import fits
+from astropy.table import Table
+from astropy_healpix import HEALPix, level_to_nside
+
+
+class SpatialIndex(object):
+    """
+    Spatial index for the positions of a catalogue.
+
+    Sources are sorted by their HEALPix (nested scheme) pixel at order
+    `order`. Since in the nested scheme every pixel at a lower order
+    corresponds to a contiguous range of pixels at higher orders, the index
+    can be queried at any order lower or equal than `order` without
+    rebuilding it. Neighbour searches only visit the pixels overlapping
+    with the search radius around each position (the pixel containing the
+    position and, at most, ``MAX_RINGS`` rings of neighbouring pixels), at
+    an order with pixels of size similar to the search radius.
+
+    The index is built once and can be saved into a FITS file, that can be
+    later memory-mapped, so it can be reused between different runs with
+    the same catalogue. The index stores a fingerprint of the indexed
+    coordinates (see ``coords_fingerprint``), so the catalogue using a
+    saved index can be checked.
+
+    Parameters
+    ----------
+    coords : Astropy ``SkyCoord`` or ``None``
+        Positions to be indexed. They are transformed to ICRS.
+    order : ``int``, optional
+        HEALPix order of the finest partition of the index. Defaults to 20
+        (pixels of ~0.2 arcsec).
+    """
+    # Fraction of the HEALPix pixel resolution used as the largest radius
+    # that can be safely searched within a pixel and its eight neighbours
+    # (i.e. the minimum width of a ring of neighbouring pixels).
+    SAFE_FRACTION = 0.5
+
+    # Maximum number of rings of neighbouring pixels visited in a search,
+    # and minimum mean number of indexed sources per pixel for using more
+    # than one ring (otherwise it is faster to visit less, larger pixels).
+    MAX_RINGS = 4
+    MIN_PIXEL_SOURCES = 16
+
+    # Upper limit for the circumradius of HEALPix pixels at order 0, that
+    # scales as 2**-order (at high orders it converges to ~61.3 deg).
+    PIXEL_RADIUS = 64 * u.deg
+
+    # HEALPix order used for estimating the density of indexed sources.
+    DENSITY_ORDER = 10
+
+    # For memory-mapped indexes, step of the sample of HEALPix pixels
+    # kept in memory for the binary searches.
+    SAMPLE_STEP = 1024
+
+    # Default memory limit for the temporary arrays of a search, and
+    # memory used by these arrays per pixel visited by each search position
+    # and per candidate pair (measured with tracemalloc, plus a margin).
+    MAX_MEMORY = 512 * u.MB
+    BYTES_PER_CELL = 96
+    BYTES_PER_CANDIDATE = 128
+
+    def __init__(self, coords=None, order=20, _data=None, _fingerprint=None):
+        self.order = order
+
+        if _data is None:
+            if coords is None:
+                raise ValueError('Coordinates for the index must be passed!')
+
+            _data = self._build(coords.icrs, order)
+            _fingerprint = coords_fingerprint(coords)
+
+        self.fingerprint = _fingerprint
+
+        self._sorter = _data['IDX']
+        self._pix = _data['HPX']
+        self._lon = _data['RA']
+        self._lat = _data['DEC']
+        self._xyz = _data['XYZ']
+
+        self._pix_sample = None
+        if not (self._pix.dtype.isnative and self._pix.flags.c_contiguous):
+            # np.searchsorted would copy the whole (memory-mapped)
+            # array in every search, so we keep a sample in memory.
+            self._pix_sample = np.array(self._pix[::self.SAMPLE_STEP], dtype=np.int64)
+
+        self._density = self._source_density()
+
+    def __len__(self):
+        return len(self._sorter)
+
+    def __repr__(self):
+        return '<SpatialIndex: {} sources, HEALPix order {}>'.format(
+            len(self), self.order
+        )
+
+    def __deepcopy__(self, memo):
+        # The index is never modified after being built,
+        # so copies can safely share the same data.
+        return self
+
+    @classmethod
+    def load(cls, filename, memmap=True):
+        """
+        Load a ``SpatialIndex`` previously saved into a FITS file.
+
+        Parameters
+        ----------
+        filename : ``str``
+            Path of the index file.
+        memmap : ``bolean``, optional
+            If ``True``, the data are memory-mapped instead of read into
+            memory. Only the regions of the index around the search
+            positions are read from disk. Defaults to ``True``.
+        """
+        hdul = fits.open(filename, memmap=memmap)
+        hdu = hdul['HPXINDEX']
+
+        data = {}
+        for col in ['IDX', 'HPX', 'RA', 'DEC', 'XYZ']:
+            data[col] = hdu.data[col]
+            if not memmap:
+                data[col] = data[col].astype(data[col].dtype.newbyteorder('='))
+
+        if not memmap:
+            hdul.close()
+
+        return cls(
+            order=hdu.header['HPXORDER'],
+            _data=data,
+            _fingerprint=hdu.header.get('CATHASH'),
+        )
+
+    def save(self, filename):
+        """
+        Save the index into a FITS file.
+
+        Parameters
+        ----------
+        filename : ``str``
+            Path of the index file.
+        """
+        cols = [
+            fits.Column(name='IDX', array=self._sorter, format='K'),
+            fits.Column(name='HPX', array=self._pix, format='K'),
+            fits.Column(name='RA', array=self._lon, format='D', unit='deg'),
+            fits.Column(name='DEC', array=self._lat, format='D', unit='deg'),
+            fits.Column(name='XYZ', array=self._xyz, format='3D'),
+        ]
+        hdr = fits.Header()
+        hdr.set('HPXORDER', self.order, 'HEALPix order of the index')
+        hdr.set('ORDERING', 'NESTED', 'HEALPix ordering scheme')
+        if self.fingerprint is not None:
+            hdr.set('CATHASH', self.fingerprint, 'SHA-1 of the coordinates')
+
+        hdu = fits.BinTableHDU.from_columns(cols, header=hdr, name='HPXINDEX')
+        hdu.writeto(filename, overwrite=True)
+
+    def search_around_sky(self, coords, seplimit, max_memory=None):
+        """
+        Search for all indexed sources within `seplimit` of `coords`.
+
+        Parameters
+        ----------
+        coords : Astropy ``SkyCoord``
+            Search positions.
+        seplimit : Astropy ``Quantity``
+            Search radius in angular units. It can be a scalar or an array
+            with a radius for each position in `coords`.
+        max_memory : Astropy ``Quantity``, ``int`` or ``None``, optional
+            Approximate limit for the memory used by the temporary arrays
+            of the search, in information units (bytes if an ``int`` is
+            passed). If ``None``, ``SpatialIndex.MAX_MEMORY`` is used.
+            See ``iter_search_around_sky``.
+
+        Returns
+        -------
+        idxsearch : numpy ``ndarray``
+            Indexes of `coords` with a counterpart in the index.
+        idxself : numpy ``ndarray``
+            Indexes of the counterparts in the indexed catalogue.
+        sep2d : Astropy ``Angle``
+            Angular separation between the pairs.
+
+        Pairs are sorted by `idxsearch` and, for each search position,
+        by `idxself`. Note that `max_memory` does not include the memory
+        used by the output arrays (~24 bytes per pair), which are
+        temporarily duplicated while the batches are merged.
+        """
+        batches = list(self.iter_search_around_sky(coords, seplimit, max_memory))
+
+        # Pairs of each search position are all in the same batch (unless the
+        # position has too many candidates, see iter_search_around_sky) and
+        # sorted by idxself, so we just move them to their final positions.
+        counts = np.zeros(len(coords), dtype=int)
+        for i, _, _ in batches:
+            counts += np.bincount(i, minlength=len(coords))
+
+        offsets = np.cumsum(counts) - counts
+        filled = np.zeros(len(coords), dtype=int)
+        split = np.zeros(len(coords), dtype=bool)
+
+        idxsearch = np.repeat(np.arange(len(coords)), counts)
+        idxself = np.empty(counts.sum(), dtype=int)
+        sep2d = np.empty(counts.sum())
+
+        while batches:
+            i, j, d = batches.pop(0)
+            if len(i) == 0:
+                continue
+
+            # Runs of pairs with the same search position
+            starts = np.flatnonzero(np.r_[True, i[1:] != i[:-1]])
+            sizes = np.diff(np.r_[starts, len(i)])
+            rank = np.arange(len(i)) - np.repeat(starts, sizes)
+
+            pos = offsets[i] + filled[i] + rank
+            idxself[pos] = j
+            sep2d[pos] = d.deg
+
+            split[i[starts]] |= filled[i[starts]] > 0
+            filled[i[starts]] += sizes
+
+        if split.any():
+            sorter = np.lexsort((idxself, idxsearch))
+            idxself, sep2d = idxself[sorter], sep2d[sorter]
+
+        return idxsearch, idxself, Angle(sep2d, u.deg)
+
+    def iter_search_around_sky(self, coords, seplimit, max_memory=None):
+        """
+        Search for all indexed sources within `seplimit` of `coords`,
+        walking the sky tile by tile.
+
+        Search positions are grouped in HEALPix tiles at the query order
+        (see ``query_order``). Each tile is searched together with its
+        neighbouring tiles, which act as overlap margins at least as wide
+        as the search radius, so no counterparts are lost at the tile
+        borders. Tiles are processed in batches such that the temporary
+        arrays of each batch fit in `max_memory`, and the results are
+        yielded batch by batch. Hence the peak memory of the search does
+        not depend on the total number of pairs (if the output is consumed
+        as it is produced) and, for memory-mapped indexes, only the regions
+        of the index around the current batch have to be read from disk.
+        Search positions with more candidates than allowed by `max_memory`
+        are searched in several batches.
+
+        The memory limit covers the temporary arrays of the search, but
+        not the arrays with an element per search position (~50 bytes per
+        position, including the input coordinates), nor the index itself
+        (unless it is memory-mapped).
+
+        Parameters
+        ----------
+        coords : Astropy ``SkyCoord``
+            Search positions.
+        seplimit : Astropy ``Quantity``
+            Search radius in angular units. It can be a scalar or an array
+            with a radius for each position in `coords`.
+        max_memory : Astropy ``Quantity``, ``int`` or ``None``, optional
+            Approximate limit for the memory used by the temporary arrays
+            of each batch, in information units (bytes if an ``int`` is
+            passed). If ``None``, ``SpatialIndex.MAX_MEMORY`` is used.
+
+        Yields
+        ------
+        idxsearch, idxself, sep2d :
+            Same as ``search_around_sky``, for the pairs in each batch.
+            Within a batch, pairs are sorted by `idxsearch` and `idxself`.
+            Pairs of a position are all in the same batch, unless the position
+            has too many candidates.
+        """
+        lon, lat, seplimit = self._search_positions(coords, seplimit)
+
+        for batch, lo, hi in self._batches(lon, lat, seplimit, max_memory):
+            i, j, d = self._search(
+                lon[batch], lat[batch], seplimit[batch], lo, hi
+            )
+            i = batch[i]
+            sorter = np.argsort(i * len(self) + j)
+
+            yield i[sorter], j[sorter], Angle(d[sorter], u.deg)
+
+    def near_mask(self, coords, seplimit, max_memory=None):
+        """
+        Flag the indexed sources within `seplimit` of any position in
+        `coords`. This is faster than ``search_around_sky`` when only the
+        sources, and not the pairs, are needed.
+
+        Parameters
+        ----------
+        coords : Astropy ``SkyCoord``
+            Search positions.
+        seplimit : Astropy ``Quantity``
+            Search radius in angular units. It can be a scalar or an array
+            with a radius for each position in `coords`.
+        max_memory : Astropy ``Quantity``, ``int`` or ``None``, optional
+            See ``iter_search_around_sky``.
+
+        Returns
+        -------
+        mask : numpy ``ndarray``
+            Boolean array, with an element for each indexed source (in the
+            same order as the indexed coordinates).
+        """
+        mask = np.zeros(len(self), dtype=bool)
+
+        lon, lat, seplimit = self._search_positions(coords, seplimit)
+        for batch, lo, hi in self._batches(lon, lat, seplimit, max_memory):
+            _, j, _ = self._search(
+                lon[batch], lat[batch], seplimit[batch], lo, hi, separations=False
+            )
+            mask[j] = True
+
+        return mask
+
+    def query_order(self, seplimit):
+        """
+        HEALPix order (not larger than the order of the index) for searching
+        sources within `seplimit`. All sources within `seplimit` of a position
+        are contained in the pixel of the position or in its first
+        ``MAX_RINGS`` rings of neighbouring pixels. The highest such order is
+        selected, unless pixels contain less than ``MIN_PIXEL_SOURCES``
+        sources in average. In that case the highest order where a single ring
+        of neighbours is enough is used. It returns ``None`` if there is no
+        such order.
+        """
+        seplimit = Angle(seplimit).max()
+        density = self._density
+
+        for order in range(self.order, -1, -1):
+            nrings = self._nrings(seplimit, order)
+            if nrings == 1:
+                return order
+
+            npix = 12 * level_to_nside(order)**2
+            populated = density * 4 * np.pi / npix >= self.MIN_PIXEL_SOURCES
+            if nrings <= self.MAX_RINGS and populated:
+                return order
+
+        return None
+
+    def _search_positions(self, coords, seplimit):
+        # Coordinates (in deg) and search radii (in rad) for each position
+        coords = coords.icrs
+        lon = coords.ra.deg
+        lat = coords.dec.deg
+
+        seplimit = Angle(seplimit)
+        if seplimit.isscalar:
+            seplimit = np.full(len(coords), seplimit.rad)
+        else:
+            seplimit = seplimit.rad
+
+        return lon, lat, seplimit
+
+    def _batches(self, lon, lat, seplimit, max_memory):
+        # Batches of search positions (walking the sky tile by tile) and
+        # the ranges of their candidates, with a bounded memory usage.
+        if len(lon) == 0:
+            return
+
+        if max_memory is None:
+            max_memory = self.MAX_MEMORY
+        max_memory = u.Quantity(max_memory, u.byte).value
+
+        order = self.query_order(seplimit * u.rad)
+        tiles = self._tile_sorter(lon, lat, order)
+
+        # Pixels visited per search position (before
+        # discarding those too far from the position)
+        ncells = 1
+        if order is not None:
+            ncells = (2 * self._nrings(seplimit.max() * u.rad, order) + 1)**2
+        max_positions = max(1, int(max_memory // (ncells * self.BYTES_PER_CELL)))
+
+        for start in range(0, len(tiles), max_positions):
+            block = tiles[start:start + max_positions]
+            lo, hi = self._candidate_ranges(
+                lon[block], lat[block], seplimit[block], order
+            )
+
+            # The ranges of the block are kept while it is searched
+            max_candidates = max_memory - lo.nbytes - hi.nbytes
+            max_candidates = max(1, int(max_candidates // self.BYTES_PER_CANDIDATE))
+
+            # Split the block in batches with a bounded number of candidates.
+            # Positions with too many candidates are searched in several
+            # batches, splitting their ranges.
+            ncand = np.cumsum((hi - lo).sum(axis=1))
+            first, nbase = 0, 0
+            while first < len(block):
+                last = np.searchsorted(ncand, nbase + max_candidates, side='right')
+
+                if last > first:
+                    yield block[first:last], lo[first:last], hi[first:last]
+                else:
+                    last = first + 1
+                    for batch_lo, batch_hi in _split_ranges(
+                        lo[first], hi[first], max_candidates
+                    ):
+                        yield block[first:last], batch_lo, batch_hi
+
+                nbase = ncand[last - 1]
+                first = last
+
+    def _search(self, lon, lat, seplimit, lo, hi, separations=True):
+        # Expand the ranges of candidate sources for each search position
+        counts = hi - lo
+        ncand = counts.sum(axis=1)
+        qidx = np.repeat(np.arange(len(lon)), ncand)
+
+        counts = counts.ravel()
+        offsets = np.repeat(lo.ravel() - np.cumsum(counts) + counts, counts)
+        cidx = offsets + np.arange(counts.sum())
+
+        # Chord distance between points in the unit sphere
+        r = 2 * np.sin(seplimit / 2)
+        d = self._xyz[cidx] - self._unit_vectors(lon, lat)[qidx]
+        mask = np.einsum('ij,ij->i', d, d) <= r[qidx]**2
+
+        qidx = qidx[mask]
+        cidx = cidx[mask]
+        sidx = np.asarray(self._sorter[cidx], dtype=int)
+
+        if not separations:
+            return qidx, sidx, None
+
+        sep2d = _angular_separation_deg(
+            lon[qidx], lat[qidx], self._lon[cidx], self._lat[cidx]
+        )
+
+        return qidx, sidx, sep2d
+
+    def _tile_sorter(self, lon, lat, order):
+        # Order of the search positions when the sky
+        # is walked following HEALPix tiles at `order`.
+        if order is None:
+            return np.arange(len(lon))
+
+        hp = HEALPix(nside=level_to_nside(order), order='nested')
+        pix = hp.lonlat_to_healpix(lon * u.deg, lat * u.deg)
+
+        return np.argsort(pix, kind='stable')
+
+    def _candidate_ranges(self, lon, lat, seplimit, order):
+        # Ranges of indexed sources (in the sorted arrays) contained in
+        # the pixels around each search position overlapping with the
+        # search radius. Ranges are calculated once for each pixel
+        # containing search positions.
+        if order is None:
+            # The search radius is too large even for the lowest
+            # order, so we check all sources.
+            lo = np.zeros((len(lon), 1), dtype=int)
+            hi = np.full((len(lon), 1), len(self), dtype=int)
+
+            return lo, hi
+
+        hp = HEALPix(nside=level_to_nside(order), order='nested')
+        pix = hp.lonlat_to_healpix(lon * u.deg, lat * u.deg)
+        pix, inverse = np.unique(pix, return_inverse=True)
+        inverse = inverse.ravel()
+
+        radius = np.zeros(len(pix))
+        np.maximum.at(radius, inverse, seplimit)
+
+        cells = self._cover(hp, pix, radius, order)
+
+        shift = 2 * (self.order - order)
+        lo = self._searchsorted(cells << shift)
+        hi = self._searchsorted((cells + 1) << shift)
+        hi[cells < 0] = lo[cells < 0]
+
+        lo, hi = lo[inverse], hi[inverse]
+
+        if cells.shape[1] > 9:
+            # Skip pixels too far from each search position
+            ucells, cinverse = np.unique(cells, return_inverse=True)
+            centres = self._pixel_centres(hp, ucells)[cinverse.reshape(cells.shape)]
+            dist = self._chord_to_angle(np.linalg.norm(
+                centres[inverse] - self._unit_vectors(lon, lat)[:, np.newaxis, :],
+                axis=2,
+            ))
+            pixrad = self.PIXEL_RADIUS.to_value(u.rad) / 2**order
+            with np.errstate(invalid='ignore'):
+                far = ~(dist <= seplimit[:, np.newaxis] + pixrad)
+            hi[far] = lo[far]
+
+        return lo, hi
+
+    def _cover(self, hp, pix, radius, order):
+        # Pixels at `order` containing all points within `radius` (in rad)
+        # of any point in `pix`, one row for each pixel in `pix`. Rows are
+        # padded with -1. Pixels are selected between the rings of
+        # neighbours of `pix`, checking the distances between pixel centres.
+        nrings = self._nrings(radius.max() * u.rad, order)
+
+        cells = pix[:, np.newaxis]
+        for _ in range(nrings):
+            with warnings.catch_warnings():
+                # Some pixels have only seven neighbours, and
+                # astropy_healpix warns about the missing one.
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                neighbours = hp.neighbours(cells.ravel())
+
+            neighbours = neighbours.T.reshape(len(pix), -1)
+            cells = _unique_rows(np.hstack([cells, neighbours]))
+
+        if nrings == 1:
+            return cells
+
+        # Points of two pixels with centres c1, c2 are at least
+        # at a distance d(c1, c2) - 2 * (pixel circumradius).
+        ucells, cinverse = np.unique(cells, return_inverse=True)
+        ucentres = self._pixel_centres(hp, ucells)
+        centres = self._pixel_centres(hp, pix)
+
+        cinverse = cinverse.reshape(cells.shape)
+        dist = self._chord_to_angle(
+            np.linalg.norm(ucentres[cinverse] - centres[:, np.newaxis, :], axis=2)
+        )
+        pixrad = self.PIXEL_RADIUS.to_value(u.rad) / 2**order
+        with np.errstate(invalid='ignore'):
+            near = dist <= radius[:, np.newaxis] + 2 * pixrad
+
+        cells[~near] = -1
+
+        return _unique_rows(cells)
+
+    def _nrings(self, seplimit, order):
+        # Rings of neighbouring pixels at `order` containing
+        # all points within `seplimit` of the central pixel.
+        # Pixel resolution (square root of the pixel area) in radians,
+        # without Quantities: this is called for each search
+        npix = 12 * level_to_nside(order)**2
+        ring_width = self.SAFE_FRACTION * np.sqrt(4 * np.pi / npix)
+
+        return max(int(np.ceil(Angle(seplimit).rad / ring_width)), 1)
+
+    def _source_density(self):
+        # Mean number of indexed sources per steradian in the
+        # area of the sky (pixels at DENSITY_ORDER) covered by the index.
+        pix, weight = self._pix, 1
+        if self._pix_sample is not None:
+            pix, weight = self._pix_sample, self.SAMPLE_STEP
+
+        order = min(self.DENSITY_ORDER, self.order)
+        pix = pix >> 2 * (self.order - order)
+        noccupied = 1 + np.count_nonzero(np.diff(pix)) if len(pix) else 1
+        npix = 12 * level_to_nside(order)**2
+
+        return len(pix) * weight / (noccupied * 4 * np.pi / npix)
+
+    def _pixel_centres(self, hp, pix):
+        # Centres of pixels (unit vectors). Invalid pixels (-1) are NaNs.
+        valid = pix >= 0
+        centres = np.full((len(pix), 3), np.nan)
+
+        lon, lat = hp.healpix_to_lonlat(pix[valid])
+        centres[valid] = self._unit_vectors(lon.deg, lat.deg)
+
+        return centres
+
+    def _searchsorted(self, values):
+        # Binary searches are much faster (fewer cache misses)
+        # for sorted values, so we sort them first.
+        flat = values.ravel()
+        sorter = np.argsort(flat)
+
+        idx = np.empty_like(sorter)
+        idx[sorter] = self._searchsorted_left(flat[sorter])
+
+        return idx.reshape(values.shape)
+
+    def _searchsorted_left(self, values):
+        if self._pix_sample is None:
+            return np.searchsorted(self._pix, values, side='left')
+
+        # Search first in the sample kept in memory, and then between
+        # the corresponding elements of the memory-mapped array.
+        k = np.searchsorted(self._pix_sample, values, side='left')
+        lo = np.where(k > 0, (k - 1) * self.SAMPLE_STEP + 1, 0)
+        hi = np.minimum(k * self.SAMPLE_STEP, len(self))
+
+        active = np.flatnonzero(lo < hi)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            right = self._pix[mid] < values[active]
+            lo[active] = np.where(right, mid + 1, lo[active])
+            hi[active] = np.where(right, hi[active], mid)
+            active = active[lo[active] < hi[active]]
+
+        return lo
+
+    @staticmethod
+    def _unit_vectors(lon, lat):
+        lon = np.radians(lon)
+        lat = np.radians(lat)
+        cos_lat = np.cos(lat)
+
+        return np.column_stack(
+            [cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)]
+        )
+
+    @staticmethod
+    def _chord_to_angle(chord):
+        return 2 * np.arcsin(np.minimum(chord / 2, 1))
+
+    @classmethod
+    def _build(cls, coords, order):
+        hp = HEALPix(nside=level_to_nside(order), order='nested')
+        pix = hp.lonlat_to_healpix(coords.ra, coords.dec)
+        sorter = np.argsort(pix, kind='stable')
+
+        lon = coords.ra.deg[sorter]
+        lat = coords.dec.deg[sorter]
+        xyz = cls._unit_vectors(lon, lat)
+
+        data = {}
+        data['IDX'] = sorter
+        data['HPX'] = pix[sorter].astype(np.int64)
+        data['RA'] = lon
+        data['DEC'] = lat
+        data['XYZ'] = xyz
+
+        return data
+
+
+def coords_fingerprint(coords):
+    """
+    Fingerprint (SHA-1 hash of the ICRS coordinates, in the same order) of a
+    set of positions. It identifies the positions of a ``SpatialIndex``.
+
+    Parameters
+    ----------
+    coords : Astropy ``SkyCoord``
+
+    Returns
+    -------
+    fingerprint : ``str``
+    """
+    coords = coords.icrs
+
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(coords.ra.deg, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(coords.dec.deg, dtype=np.float64).tobytes())
+
+    return sha.hexdigest()
+
+
+def tile_partition(coords, nparts, order=6):
+    """
+    Split a set of positions in `nparts` groups of contiguous HEALPix tiles.
+
+    Positions are sorted following the (nested) HEALPix tiles at `order`
+    and the sorted sequence is divided in groups with similar number of
+    positions, without splitting tiles between groups (i.e. a group can
+    contain more than one tile, but a tile is always in a single group).
+
+    Parameters
+    ----------
+    coords : Astropy ``SkyCoord``
+        Positions to be partitioned.
+    nparts : ``int``
+        Maximum number of groups. Groups can be less than `nparts` if
+        there are not enough tiles.
+    order : ``int``, optional
+        HEALPix order of the tiles. Defaults to 6 (tiles of ~0.9 deg).
+
+    Returns
+    -------
+    parts : ``list`` of numpy ``ndarray``
+        Indexes of `coords` in each group, in increasing order.
+    """
+    if len(coords) == 0:
+        return []
+
+    coords = coords.icrs
+    hp = HEALPix(nside=level_to_nside(order), order='nested')
+    pix = hp.lonlat_to_healpix(coords.ra, coords.dec)
+
+    sorter = np.argsort(pix, kind='stable')
+    pix = pix[sorter]
+
+    # Move the ideal group limits to the start of the tile
+    limits = np.linspace(0, len(pix), nparts + 1).astype(int)[1:-1]
+    limits = np.searchsorted(pix, pix[np.minimum(limits, len(pix) - 1)])
+    limits = np.unique(np.concatenate([[0], limits, [len(pix)]]))
+
+    return [
+        np.sort(sorter[start:stop]) for start, stop in zip(limits[:-1], limits[1:])
+    ]
+
+
+def benchmark(
+    nsources=1000000,
+    nsearch=50000,
+    radii=[6*u.arcsec, 1*u.arcmin],
+    area=10*u.deg**2,
+    seed=None,
+):
+    """
+    Compare the execution times of neighbour searches using a
+    ``SpatialIndex`` and the KD-tree of Astropy, for random positions.
+
+    Parameters
+    ----------
+    nsources : ``int``, optional
+        Number of indexed positions.
+    nsearch : ``int``, optional
+        Number of search positions.
+    radii : ``list`` of Astropy ``Quantity``, optional
+        Search radii. By default, the radii used for selecting match
+        candidates and for masking field sources in the priors.
+    area : Astropy ``Quantity``, optional
+        Area of the square region containing the positions.
+    seed : ``int`` or ``None``, optional
+        Seed for the random positions.
+
+    Returns
+    -------
+    bench : Astropy ``Table``
+        Execution times (in seconds) for each radius, including the time
+        for building the index or the KD-tree, and number of pairs found.
+    """
+    from astropy.coordinates import SkyCoord
+
+    rng = np.random.RandomState(seed)
+    side = np.sqrt(area.to_value(u.deg**2))
+
+    def random_coords(n):
+        return SkyCoord(
+            rng.uniform(150, 150 + side, n), rng.uniform(0, side, n), unit='deg'
+        )
+
+    coords = random_coords(nsources)
+    search = random_coords(nsearch)
+
+    start = time.time()
+    index = SpatialIndex(coords)
+    tbuild = time.time() - start
+
+    bench = Table(names=['radius', 'astropy', 'index', 'speedup', 'npairs'],
+                  dtype=[float, float, float, float, int])
+    for radius in radii:
+        start = time.time()
+        pairs = coords.search_around_sky(search, radius)
+        tkdtree = time.time() - start
+
+        start = time.time()
+        pairs_index = index.search_around_sky(search, radius)
+        tindex = time.time() - start + tbuild
+
+        if len(pairs[0]) != len(pairs_index[0]):
+            raise RuntimeError('Different number of pairs for {}!'.format(radius))
+
+        bench.add_row([
+            radius.to_value(u.arcsec), tkdtree, tindex, tkdtree / tindex, len(pairs[0])
+        ])
+
+    bench['radius'].unit = u.arcsec
+    for col in ['astropy', 'index']:
+        bench[col].format = '.2f'
+    bench['speedup'].format = '.2f'
+
+    return bench
+
+
+def _angular_separation_deg(lon1, lat1, lon2, lat2):
+    # Same as astropy.coordinates.angular_separation (with the same
+    # results, bit by bit), for angles in degrees without Quantities.
+    dlon = np.radians(lon2 - lon1)
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+
+    sdlon = np.sin(dlon)
+    cdlon = np.cos(dlon)
+    slat1 = np.sin(lat1)
+    slat2 = np.sin(lat2)
+    clat1 = np.cos(lat1)
+    clat2 = np.cos(lat2)
+
+    num1 = clat2 * sdlon
+    num2 = clat1 * slat2 - slat1 * clat2 * cdlon
+    denominator = slat1 * slat2 + clat1 * clat2 * cdlon
+
+    return np.arctan2(np.hypot(num1, num2), denominator) * u.rad.to(u.deg)
+
+
+def _split_ranges(lo, hi, max_size):
+    # Split the ranges lo[i]:hi[i] in pieces, and group them in sets
+    # containing at most max_size elements (as arrays with a single row).
+    pieces = []
+    for start, stop in zip(lo, hi):
+        for piece_start in range(start, stop, max_size):
+            pieces.append((piece_start, min(piece_start + max_size, stop)))
+
+    batch, size = [], 0
+    for piece in pieces:
+        if batch and size + piece[1] - piece[0] > max_size:
+            batch = np.array(batch).T
+            yield batch[:1], batch[1:]
+            batch, size = [], 0
+
+        batch.append(piece)
+        size += piece[1] - piece[0]
+
+    if batch:
+        batch = np.array(batch).T
+        yield batch[:1], batch[1:]
+
+
+def _unique_rows(cells):
+    # Remove repeated elements in each row of `cells` (replacing them with -1)
+    # and the columns with no valid elements. Rows are sorted.
+    cells = np.sort(cells, axis=1)
+    repeated = np.zeros(cells.shape, dtype=bool)
+    repeated[:, 1:] = cells[:, 1:] == cells[:, :-1]
+    cells[repeated] = -1
+
+    cells = np.sort(cells, axis=1)
+    nmissing = np.min(np.sum(cells < 0, axis=1))
+
+    return cells[:, nmissing:]
+
+
+if __name__ == '__main__':
+    print(benchmark())
@@ -0,0 +1,107 @@
+"""
+astromatch module for statistics over a range of thresholds.
+
+@author: A.Ruiz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class ThresholdSweep(object):
+    """
+    Counts (or sums of weights) of the values above or below a set of
+    thresholds.
+
+    Values are sorted once, and the counts for any number of thresholds
+    are obtained from cumulative sums and a binary search of the
+    thresholds. Hence the cost for a grid of M thresholds is
+    O((N + M) log N), instead of the O(N·M) of building a mask over the
+    N values for each threshold, and the grid can be as dense as needed
+    (e.g. all the distinct values, see ``cutoff_grid``).
+
+    Comparisons follow numpy: a value is above a threshold ``c`` if
+    ``value > c`` and below it if ``value <= c``. NaN and masked values
+    are neither above nor below any threshold.
+
+    Parameters
+    ----------
+    values : array-like
+        Values compared with the thresholds.
+    """
+    def __init__(self, values):
+        values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+
+        # NaNs are sorted at the end
+        self._sorter = np.argsort(values, kind='stable')
+        self._values = values[self._sorter]
+        self._nvalid = np.count_nonzero(~np.isnan(values))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '<ThresholdSweep: {} values>'.format(len(self))
+
+    def above(self, cutoffs, weights=None):
+        """
+        Number of values above each of the `cutoffs` or, if `weights`
+        is not ``None``, the sum of the weights of these values.
+        """
+        cumsum, pos = self._cumsum(cutoffs, weights)
+
+        return cumsum[self._nvalid] - cumsum[pos]
+
+    def below(self, cutoffs, weights=None):
+        """
+        Number of values below (or equal to) each of the `cutoffs` or,
+        if `weights` is not ``None``, the sum of the weights of these values.
+        """
+        cumsum, pos = self._cumsum(cutoffs, weights)
+
+        return cumsum[pos]
+
+    def _cumsum(self, cutoffs, weights):
+        if weights is None:
+            cumsum = np.arange(len(self) + 1)
+        else:
+            weights = np.ma.filled(np.ma.asarray(weights), 0)[self._sorter]
+            cumsum = np.concatenate(([0], np.cumsum(weights[:self._nvalid])))
+
+        # Number of valid values <= each cutoff
+        pos = np.searchsorted(
+            self._values[:self._nvalid], np.asarray(cutoffs), side='right'
+        )
+
+        return cumsum, pos
+
+
+def cutoff_grid(ncutoff=101, mincutoff=0.0, maxcutoff=1.0, values=None):
+    """
+    Thresholds for the statistics of a match.
+
+    Parameters
+    ----------
+    ncutoff : ``int`` or ``str``, optional
+        Number of thresholds, evenly spaced between `mincutoff` and
+        `maxcutoff`. If 'unique', the thresholds are `mincutoff` and
+        the distinct `values` between `mincutoff` and `maxcutoff`, i.e.
+        all thresholds where the statistics change. Defaults to 101.
+    mincutoff, maxcutoff : ``float``, optional
+        Range of the thresholds. Default to 0 and 1.
+    values : array-like or ``None``, optional
+        Values of the column used for the thresholds. Only needed if
+        `ncutoff` is 'unique'.
+    """
+    if isinstance(ncutoff, str):
+        if ncutoff != 'unique':
+            raise ValueError('Unknown ncutoff: {}'.format(ncutoff))
+
+        values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+        mask = np.logical_and(values > mincutoff, values <= maxcutoff)
+
+        return np.unique(np.append(mincutoff, values[mask]))
+
+    return np.linspace(mincutoff, maxcutoff, num=ncutoff)
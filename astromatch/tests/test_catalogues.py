@@ -249,6 +249,55 @@ def test_set_fromtable_areafromquantity_mags():
     assert len(cat.mags) == len(data)
     assert len(cat.mags.colnames) == len(mag_cols)
 
+def test_set_fromfile_lazy_mags():
+    import numpy as np
+    from astropy import units as u
+    from astropy.table import Table
+
+    datafile = get_pkg_data_filename('data/testcat_moc_2.fits')
+    data = Table.read(datafile)
+
+    kwargs = dict(area=0.8393*u.deg**2, coord_cols=['RA', 'DEC'],
+                  poserr_cols=['raErr', 'decErr'], poserr_type='rcd_dec_ellipse',
+                  mag_cols=['uMag', 'gMag'])
+    cat = Catalogue(datafile, **kwargs)
+    cat_table = Catalogue(data, **kwargs)
+
+    # Magnitudes are not loaded until used
+    subcat = cat[10:100:3]
+    assert cat._mags is None
+    assert subcat._mags is None
+
+    subcat_table = cat_table[10:100:3]
+    assert all(subcat.ids == subcat_table.ids)
+    assert np.array_equal(subcat.coords.ra, subcat_table.coords.ra)
+    for col in subcat_table.mags.colnames:
+        assert np.array_equal(subcat.mags[col], subcat_table.mags[col])
+
+def test_set_fromparquet(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    import numpy as np
+    from astropy import units as u
+    from astropy.table import Table
+
+    datafile = get_pkg_data_filename('data/testcat_moc_2.fits')
+    data = Table.read(datafile)
+    data['SRCID'] = data['SRCID'].astype(str)
+
+    parquetfile = str(tmp_path / 'testcat_moc_2.parquet')
+    data.write(parquetfile, overwrite=True)
+
+    kwargs = dict(area=0.8393*u.deg**2, coord_cols=['RA', 'DEC'],
+                  poserr_cols=['raErr', 'decErr'], poserr_type='rcd_dec_ellipse',
+                  mag_cols=['uMag', 'gMag'])
+    cat = Catalogue(parquetfile, **kwargs)
+    cat_table = Catalogue(data, **kwargs)
+
+    assert all(cat.ids == cat_table.ids)
+    assert np.array_equal(cat.coords.dec, cat_table.coords.dec)
+    assert np.array_equal(cat.mags['uMag'], cat_table.mags['uMag'])
+
 def test_set_badarea():
     datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
     
@@ -268,6 +317,26 @@ def test_getitem():
     
     assert len(cat[items]) == nitems
 
+def test_getitem_withmoc():
+    from numpy.random import choice
+
+    mocfile = get_pkg_data_filename('data/testcat_moc_1.moc')
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=mocfile, name='test')
+    cat.index
+
+    items = choice(len(cat), 10, replace=False)
+    subcat = cat[items]
+
+    # Metadata are shared, data and index are not
+    assert subcat.moc is cat.moc
+    assert subcat.area == cat.area
+    assert subcat.name == cat.name
+    assert all(subcat.ids == cat.ids[items])
+    assert subcat._index is None
+    assert len(subcat.index) == 10
+    assert len(cat.index) == len(cat)
+
 def test_select_by_id():
     from astropy import units as u
     from numpy.random import choice
@@ -283,6 +352,58 @@ def test_select_by_id():
 
     assert len(subcat) == nitems
 
+def test_select_by_id_order():
+    import numpy as np
+    from astropy import units as u
+
+    area = 0.8393*u.deg**2
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=area, name='test')
+
+    ids = cat.ids[[5, 3, 100, 0]]
+    subcat = cat.select_by_id(ids.astype('S'))
+    assert all(subcat.ids == ids)
+    assert all(subcat.coords.ra == cat.coords.ra[[5, 3, 100, 0]])
+
+    with pytest.raises(ValueError):
+        cat.select_by_id(['NOTANID'])
+
+    # The index of the ids is rebuilt when the ids change
+    index = cat._id_index
+    assert index is not None
+    cat.ids = np.char.add(cat.ids, 'x')
+    assert cat._id_index is None
+    assert len(cat.select_by_id([cat.ids[7]])) == 1
+
+def test_remove_by_id():
+    from astropy import units as u
+
+    area = 0.8393*u.deg**2
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=area, name='test')
+
+    ids = list(cat.ids[[10, 2, 30]]) + ['NOTANID']
+    subcat = cat.remove_by_id(ids)
+
+    assert len(subcat) == len(cat) - 3
+    assert not any(i in subcat.ids for i in ids)
+    assert all(subcat.ids == [i for i in cat.ids if i not in ids])
+
+def test_rows_by_id():
+    from astropy import units as u
+    from astropy.table import MaskedColumn
+
+    area = 0.8393*u.deg**2
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=area, name='test')
+
+    ids = MaskedColumn(list(cat.ids[[10, 2, 30, 2]]) + ['NOTANID', ''],
+                       mask=[False, False, False, False, False, True])
+    rows = cat.rows_by_id(ids)
+
+    assert all(rows == [10, 2, 30, 2, -1, -1])
+    assert all(cat.ids[rows[:4]] == ids[:4])
+
 def test_save():
     from astropy import units as u
     from astropy.table import Table
@@ -320,16 +441,103 @@ def test_randomise_withmoc():
     assert len(rndcat) > len(cat)
     assert all(moc.contains(rndcat.coords.ra, rndcat.coords.dec))
 
-def test_randomise_nway():
+def test_randomise_fake():
+    import numpy as np
     from astropy import units as u
+    from mocpy import MOC
+
+    mocfile = get_pkg_data_filename('data/testcat_moc_1.moc')
+    moc = MOC.from_fits(mocfile)
 
-    area = 0.8393*u.deg**2    
     datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
-    cat = Catalogue(datafile, area=area, name='test')
+    cat = Catalogue(datafile, area=moc, name='test')
 
-    rndcat = cat.randomise(numrepeat=1)
+    rndcat = cat.randomise(r_min=20*u.arcsec, numrepeat=1, seed=7)
 
     assert len(rndcat) == len(cat)
+    assert all(rndcat.ids == cat.ids)
+    assert all(moc.contains(rndcat.coords.ra, rndcat.coords.dec))
+
+    _, d2d, _ = rndcat.coords.match_to_catalog_sky(cat.coords)
+    assert np.all(d2d >= 20*u.arcsec)
+
+    rndcat2 = cat.randomise(r_min=20*u.arcsec, numrepeat=1, seed=7)
+    assert np.all(rndcat.coords.ra == rndcat2.coords.ra)
+    assert np.all(rndcat.coords.dec == rndcat2.coords.dec)
+
+def test_random_positions():
+    import numpy as np
+    from astropy import units as u
+    from astropy.coordinates import concatenate
+    from mocpy import MOC
+    from ..catalogues import RandomPositions
+    from ..priorsND import PriorND
+
+    mocfile = get_pkg_data_filename('data/testcat_moc_1.moc')
+    moc = MOC.from_fits(mocfile)
+
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=moc, name='test')
+
+    rnd = RandomPositions(cat, numrepeat=3, seed=1)
+    rnd.BLOCK_SIZE = 100
+    blocks = list(rnd)
+    coords = concatenate(blocks)
+
+    assert rnd.nblocks == len(blocks) == 7
+    assert len(rnd) == len(coords)
+    assert len(coords) > len(cat)
+    assert all(moc.contains_lonlat(coords.ra, coords.dec))
+
+    # Blocks are reproducible
+    assert np.all(rnd.block(3).ra == blocks[3].ra)
+    rnd2 = RandomPositions(cat, numrepeat=3, seed=1)
+    rnd2.BLOCK_SIZE = 100
+    assert np.all(rnd2.block(0).dec == blocks[0].dec)
+
+    _, d2d, _ = coords.match_to_catalog_sky(cat.coords)
+    assert np.all(d2d < 120*u.arcsec)
+
+    # Field counts are accumulated block by block
+    counts = PriorND.random_field_counts(cat, rnd, 2*u.arcmin)
+    _, idx, _ = cat.index.search_around_sky(coords, 2*u.arcmin)
+    assert np.all(counts == np.bincount(idx, minlength=len(cat)))
+
+def test_random_positions_search_area():
+    import numpy as np
+    from astropy import units as u
+    from ..catalogues import RandomPositions
+    from ..priorsND import PriorND
+
+    mocfile = get_pkg_data_filename('data/testcat_moc_1.moc')
+    datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    cat = Catalogue(datafile, area=mocfile, name='test')
+
+    rnd = RandomPositions(cat, numrepeat=3, seed=1)
+    rnd.BLOCK_SIZE = 100
+
+    # Radius for each source
+    radius = np.full(len(cat), 30.0)*u.arcsec
+    area = rnd.search_area(radius)
+    assert u.isclose(area, rnd.search_area(30*u.arcsec))
+
+    radius[::2] = 10*u.arcsec
+    area = rnd.search_area(radius)
+    assert area < rnd.search_area(30*u.arcsec)
+
+    blocks = [rnd.block(k, sources=True) for k in range(rnd.nblocks)]
+    src = np.concatenate([block_src for _, block_src in blocks])
+    assert u.isclose(area, np.sum(np.pi*radius[src]**2))
+
+    # Field counts using the radius of the source of each position
+    counts = PriorND.random_field_counts(cat, blocks, radius)
+    expected = np.zeros(len(cat), dtype=int)
+    for coords, block_src in blocks:
+        for i, coord in enumerate(coords):
+            near = coord.separation(cat.coords) <= radius[block_src[i]]
+            expected += near
+
+    assert np.all(counts == expected)
 
 def test_apply_moc():
     from mocpy import MOC
@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+from astropy import units as u
+
+from .. import kernels
+from ..priorsND import MagBins
+from ..segments import Segments
+
+
+def set_data(npairs=10000, seed=1):
+    rng = np.random.RandomState(seed)
+
+    nsrcs = npairs // 5
+    data = {}
+    data['dist'] = rng.uniform(0, 6, npairs) * u.arcsec
+    data['ppos_error'] = rng.uniform(0.5, 3, nsrcs) * u.arcsec
+    data['spos_error'] = rng.uniform(0.05, 0.5, nsrcs) * u.arcsec
+    data['pidx'] = np.sort(rng.randint(0, nsrcs, npairs))
+    data['sidx'] = rng.randint(0, nsrcs, npairs)
+
+    mags = [rng.uniform(8, 32, npairs), rng.uniform(8, 32, npairs)]
+    mags[0][:10] = np.nan
+    mags[1][10:20] = np.inf
+    data['mags'] = mags
+    data['edges'] = [np.arange(10, 30.5, 0.5), np.arange(15, 25.5, 0.5)]
+    data['grid'] = rng.uniform(0, 1, (40, 20))
+    data['values'] = rng.uniform(0, 1, (npairs, 3))
+
+    return data
+
+def run_kernels(data):
+    results = {}
+    for dist in ['rayleigh', 'normal']:
+        results[dist] = kernels.pos_err_function(
+            data['dist'], data['ppos_error'], data['spos_error'],
+            data['pidx'], data['sidx'], dist
+        )
+    results['grid_lookup'] = kernels.grid_lookup(
+        data['mags'], data['edges'], data['grid']
+    )
+
+    segments = Segments(data['pidx'])
+    results['sum'] = segments.sum(data['values'])
+    results['max'] = segments.max(data['values'])
+
+    return results
+
+def test_set_backend():
+    with pytest.raises(ValueError):
+        kernels.set_backend('fortran')
+
+    assert kernels.set_backend('numpy') == 'numpy'
+    assert kernels.get_backend() == 'numpy'
+
+def test_numba_backend():
+    pytest.importorskip('numba')
+
+    data = set_data()
+    try:
+        kernels.set_backend('numpy')
+        results_numpy = run_kernels(data)
+
+        assert kernels.set_backend('numba') == 'numba'
+        results_numba = run_kernels(data)
+    finally:
+        kernels.set_backend('numpy')
+
+    for key in ['rayleigh', 'normal']:
+        assert results_numba[key].unit == results_numpy[key].unit
+        assert np.allclose(results_numba[key], results_numpy[key], rtol=1e-15, atol=0)
+
+    assert np.all(results_numba['grid_lookup'] == results_numpy['grid_lookup'])
+    assert np.all(results_numba['max'] == results_numpy['max'])
+    assert np.allclose(results_numba['sum'], results_numpy['sum'], rtol=1e-14, atol=0)
+
+def test_grid_bins():
+    data = set_data()
+    mags, edges, grid = data['mags'], data['edges'], data['grid']
+
+    # Look-up with the indexes of each dimension
+    q, inside = [], np.ones(len(mags[0]), dtype=bool)
+    for val, e in zip(mags, edges):
+        with np.errstate(invalid='ignore'):
+            idx = ((val - e[0]) / (e[1] - e[0])).astype(int)
+        outside = np.logical_or(idx < 0, idx > len(e) - 2)
+        inside[outside] = False
+        q.append(np.where(outside, 0, idx))
+
+    expected = grid[tuple(q)]
+    expected[~inside] = 0.0
+
+    with np.errstate(invalid='ignore'):
+        axes = [kernels.axis_bins(val, e) for val, e in zip(mags, edges)]
+    bins = kernels.grid_bins(axes, grid.shape)
+
+    assert np.all((bins == -1) == ~inside)
+    assert np.all(kernels.grid_take(grid, bins) == expected)
+    assert np.all(kernels.grid_take(grid[:, 0], axes[0]) == grid[q[0], 0] * (axes[0] >= 0))
+
+def test_magbins():
+    data = set_data()
+    mags = {'mag0': data['mags'][0], 'mag1': data['mags'][1]}
+    edges, grid = data['edges'], data['grid']
+    cache = MagBins(mags)
+
+    with np.errstate(invalid='ignore'):
+        bins = cache.bins(['mag0', 'mag1'], edges, grid.shape)
+        bins0 = cache.bins(['mag0'], edges[:1], grid.shape[:1])
+
+    # Bins of the 1D grid are reused from the 2D grid
+    assert len(cache._axes) == 2
+    assert cache.bins(['mag0', 'mag1'], edges, grid.shape) is bins
+    assert np.all(bins0[bins >= 0] == bins[bins >= 0] // grid.shape[1])
+
+    with np.errstate(invalid='ignore'):
+        kernels.set_backend('numpy')
+        gvals = kernels.grid_lookup(data['mags'], edges, grid)
+
+    assert np.all(kernels.grid_take(grid, bins) == gvals)
+
+def test_pos_err_function_cov():
+    from scipy.stats import multivariate_normal
+
+    data = set_data(npairs=200)
+    rng = np.random.RandomState(2)
+    pa = rng.uniform(-np.pi, np.pi, len(data['dist']))
+
+    # Circular errors
+    pcov = np.zeros((len(data['ppos_error']), 3))
+    pcov[:, 0] = pcov[:, 1] = data['ppos_error'].value**2
+    scov = np.zeros((len(data['spos_error']), 3))
+    scov[:, 0] = scov[:, 1] = data['spos_error'].value**2
+    cov = kernels.pair_covariance(
+        pcov*u.arcsec**2, scov*u.arcsec**2, data['pidx'], data['sidx']
+    )
+    for dist in ['rayleigh', 'normal']:
+        pef = kernels.pos_err_function_cov(data['dist'], pa, cov, dist)
+        pef_circle = kernels.pos_err_function(
+            data['dist'], data['ppos_error'], data['spos_error'],
+            data['pidx'], data['sidx'], dist
+        )
+        assert pef.unit == pef_circle.unit
+        assert np.allclose(pef.value, pef_circle.value, rtol=1e-12, atol=0)
+
+    # Elliptical errors
+    cov[:, 2] = 0.5*np.sqrt(cov[:, 0]*cov[:, 1])
+    pef = kernels.pos_err_function_cov(data['dist'], pa, cov, 'normal')
+
+    dx = data['dist'].value*np.sin(pa)
+    dy = data['dist'].value*np.cos(pa)
+    expected = [
+        multivariate_normal.pdf([x, y], cov=[[c[0], c[2]], [c[2], c[1]]])
+        for x, y, c in zip(dx, dy, cov.value)
+    ]
+    assert np.allclose(pef.value, expected, rtol=1e-12, atol=0)
+
+    m = kernels.mahalanobis(data['dist'], pa, cov)
+    assert np.allclose(np.exp(-m**2/2)/expected, 2*np.pi*np.sqrt(cov.value[:, 0]*cov.value[:, 1] - cov.value[:, 2]**2))
+
+def test_position_angle():
+    from astropy.coordinates import SkyCoord
+
+    rng = np.random.RandomState(3)
+    coords = SkyCoord(rng.uniform(0, 360, 100), rng.uniform(-85, 85, 100), unit='deg')
+    pa = rng.uniform(0, 2*np.pi, 100)
+    offsets = coords.directional_offset_by(pa*u.rad, 3*u.arcsec)
+
+    pa_offsets = kernels.position_angle(
+        coords.ra.rad, coords.dec.rad, offsets.ra.rad, offsets.dec.rad
+    )
+    assert np.allclose(np.cos(pa_offsets - pa), 1)
@@ -1,8 +1,24 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+from astropy.table import Table
 from astropy.utils.data import get_pkg_data_filename
 
 from ..catalogues import Catalogue
+from .. import kernels
 from ..lr import LRMatch
+from ..priorcache import PriorCache
+
 
+# Parameters of the LR matches of the test catalogues
+MASK_KWARGS = dict(
+    prior_method='mask',
+    mags=[['uMag'], ['gMag']],
+    magmin=[[10.0], [10.0]],
+    magmax=[[30.0], [30.0]],
+    magbinsize=[[0.5], [0.5]],
+)
 
 def set_catalogues():
     mocfile = get_pkg_data_filename('data/testcat_moc_1.moc')
@@ -51,3 +67,279 @@ def test_lr_maskprior():
     match_mask = ~match['LR_BEST'].mask 
     assert all(match['LR_BEST'][match_mask] >= 0)
     assert all(match['Separation_pcat_scat'][match_mask] >= 0)
+
+def test_lr_n_workers():
+    pcat, scat = set_catalogues()
+
+    match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+    match_parallel = LRMatch(pcat, scat).run(n_workers=2, **MASK_KWARGS)
+
+    assert match.colnames == match_parallel.colnames
+    assert len(match) == len(match_parallel)
+    for col in match.colnames:
+        assert np.all(match[col] == match_parallel[col])
+        assert np.all(
+            np.ma.getmaskarray(match[col]) == np.ma.getmaskarray(match_parallel[col])
+        )
+
+def test_lr_n_workers_no_fork(monkeypatch):
+    # Shards are matched serially where workers cannot be forked
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    pcat, scat = set_catalogues()
+
+    match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+    match_parallel = LRMatch(pcat, scat).run(n_workers=2, **MASK_KWARGS)
+
+    assert len(match) == len(match_parallel)
+    for col in match.colnames:
+        assert np.all(match[col] == match_parallel[col])
+
+def test_lr_n_workers_uncovered_tile():
+    # Shards of primary sources with no match candidates
+    pcat, scat = set_catalogues()
+
+    data = Table.read(get_pkg_data_filename('data/testcat_moc_1.fits'))[:55]
+    data['RA'][50:] = 200.0
+    pcat = Catalogue(data, area=pcat.area, name='pcat')
+
+    match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+    match_parallel = LRMatch(pcat, scat).run(n_workers=2, **MASK_KWARGS)
+
+    assert len(match) == len(match_parallel)
+    for col in ['SRCID_pcat', 'ncat', 'match_flag', 'prob_has_match']:
+        assert np.all(match[col] == match_parallel[col])
+
+    uncovered = np.isin(match_parallel['SRCID_pcat'], pcat.ids[50:])
+    assert uncovered.sum() == 5
+    assert np.all(match_parallel['ncat'][uncovered] == 1)
+
+def test_lr_n_workers_numba():
+    # Worker processes are forked after the Numba kernels have been used
+    pytest.importorskip('numba')
+    pcat, scat = set_catalogues()
+
+    try:
+        kernels.set_backend('numba')
+        match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+        match_parallel = LRMatch(pcat, scat).run(n_workers=2, **MASK_KWARGS)
+    finally:
+        kernels.set_backend('numpy')
+
+    assert len(match) == len(match_parallel)
+    for col in ['prob_has_match', 'prob_this_match']:
+        assert np.allclose(match[col], match_parallel[col], rtol=1e-12)
+
+def test_lr_all_priors():
+    pcat, scat = set_catalogues()
+
+    xm = LRMatch(pcat, scat)
+    match = xm.run(**MASK_KWARGS)
+    lr = xm.lr
+
+    assert xm.lr is lr
+    assert len(lr) == sum(match['ncat'] == 2)
+    for col in ['PRIOR0', 'PRIOR1']:
+        for prefix in ['LR_', 'REL_', 'p_any_', 'p_i_']:
+            assert prefix + col in lr.colnames
+
+    pmax = np.maximum(lr['p_any_PRIOR0'], lr['p_any_PRIOR1'])
+    assert np.all(lr['prob_has_match'] == pmax)
+
+def test_lr_stats_broos(monkeypatch):
+    pcat, scat = set_catalogues()
+
+    xm = LRMatch(pcat, scat)
+    match = xm.run(**MASK_KWARGS)
+
+    # Use the best matches as candidates for fake counterparts
+    best = np.logical_and(match['match_flag'] == 1, match['ncat'] == 2)
+    match['prob_has_match'][best] = 1.0
+
+    stats = xm.stats_broos(match, ntest=3, ncutoff=11, seed=42)
+    stats_parallel = xm.stats_broos(match, ntest=3, ncutoff=11, seed=42, n_workers=2)
+
+    assert len(stats) == 11
+    assert stats.colnames == stats_parallel.colnames
+    for col in stats.colnames:
+        assert np.allclose(stats[col], stats_parallel[col], equal_nan=True)
+
+    # Iterations are run serially where workers cannot be forked
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    stats_no_fork = xm.stats_broos(match, ntest=3, ncutoff=11, seed=42, n_workers=2)
+    for col in stats.colnames:
+        assert np.allclose(stats[col], stats_no_fork[col], equal_nan=True)
+
+    for col in ['frac_assoc_pop_err', 'error_rate_err', 'reliability_err']:
+        values = stats[col][np.isfinite(stats[col])]
+        assert np.all(values >= 0)
+
+def test_lr_source_terms():
+    pcat, scat = set_catalogues()
+
+    xm = LRMatch(pcat, scat)
+    xm.run(**MASK_KWARGS)
+    pidx, sidx, d2d = xm._candidates()
+
+    terms = xm._source_terms()
+    assert xm._source_terms() is terms
+    assert terms[0].shape == (len(scat), len(xm._priors.prior_dict))
+
+    lr, _ = xm._likelihood_ratio(pidx, sidx, d2d)
+    lr_cached, _ = xm._likelihood_ratio(pidx, sidx, d2d, terms)
+
+    for col in ['LR_BEST', 'REL_BEST', 'prob_has_match', 'prob_this_match']:
+        assert np.all(lr[col] == lr_cached[col])
+
+    # Terms are recalculated for new priors
+    xm._priors = xm._calc_priors(sidx, [['uMag'], ['gMag']], [[10.0], [10.0]],
+                                 [[30.0], [30.0]], [[0.5], [0.5]], False)
+    assert xm._source_terms() is not terms
+
+def test_lr_final_table_layout():
+    pcat, scat = set_catalogues()
+
+    xm = LRMatch(pcat, scat)
+    match = xm.run(**MASK_KWARGS)
+    pcat_idcol, scat_idcol = match.colnames[:2]
+
+    # A row with no counterpart for each primary source, at the beginning
+    # of its group, and the groups sorted as in the primary catalogue
+    first = match['ncat'] == 1
+    assert np.all(match[pcat_idcol][first] == pcat.ids)
+    assert np.all(match[scat_idcol].mask == first)
+    assert np.all(match['LR_BEST'].mask == first)
+
+    rows = pcat.rows_by_id(match[pcat_idcol])
+    assert np.all(np.diff(rows) >= 0)
+
+    # Candidates in decreasing order of prob_this_match
+    cands = ~first[1:] & ~first[:-1]
+    prob = np.asarray(match['prob_this_match'])
+    assert not np.any(prob[1:][cands] > prob[:-1][cands])
+
+def test_lr_output(tmp_path):
+    pcat, scat = set_catalogues()
+    match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+
+    xm = LRMatch(pcat, scat)
+    results = xm.run(output=str(tmp_path / 'match.fits'), chunk_rows=10, **MASK_KWARGS)
+    match_file = results.read()
+
+    assert len(results) == len(match)
+    assert match_file.colnames == match.colnames
+    for col in match.colnames:
+        assert np.all(np.ma.getmaskarray(match_file[col]) == np.ma.getmaskarray(match[col]))
+        assert np.all(match_file[col] == match[col])
+
+    primary = results.get_matchs('primary')
+    assert len(primary) == np.sum((match['ncat'] > 1) & (match['match_flag'] == 1))
+
+    with pytest.raises(AttributeError):
+        xm.lr
+
+    with pytest.raises(ValueError):
+        xm.run(output=str(tmp_path / 'match.fits'), n_workers=2, **MASK_KWARGS)
+
+def test_lr_prior_cache(tmp_path, monkeypatch):
+    pcat, scat = set_catalogues()
+    cache = PriorCache(str(tmp_path / 'priors'))
+    match = LRMatch(pcat, scat).run(prior_cache=cache, **MASK_KWARGS)
+    assert len(cache) == 1
+
+    # The Mahalanobis cut changes the candidates used for the priors
+    LRMatch(pcat, scat).run(prior_cache=cache, max_mahalanobis=1.0, **MASK_KWARGS)
+    assert len(cache) == 2
+
+    # Priors are not calculated again
+    def fail(*args, **MASK_KWARGS):
+        raise AssertionError('Priors calculated')
+
+    monkeypatch.setattr(LRMatch, '_calc_priors', fail)
+    match_cached = LRMatch(pcat, scat).run(prior_cache=cache.path, **MASK_KWARGS)
+
+    assert len(cache) == 2
+    for col in match.colnames:
+        assert np.all(match_cached[col] == match[col])
+
+def test_lr_ellipse_poserr():
+    pcat, scat = set_catalogues()
+    scat_datafile = get_pkg_data_filename('data/testcat_3.fits')
+    scat = Catalogue(scat_datafile, area=scat.moc, name='scat',
+                     coord_cols=['RA', 'DEC'], poserr_cols=['raErr', 'decErr'],
+                     poserr_type='rcd_dec_ellipse', mag_cols=['uMag', 'gMag'])
+    match = LRMatch(pcat, scat).run(**MASK_KWARGS)
+    match_cut = LRMatch(pcat, scat).run(max_mahalanobis=2.8, **MASK_KWARGS)
+    match_parallel = LRMatch(pcat, scat).run(max_mahalanobis=2.8, n_workers=2, **MASK_KWARGS)
+
+    ncand = np.sum(match['ncat'] == 2)
+    ncand_cut = np.sum(match_cut['ncat'] == 2)
+    assert 0 < ncand_cut < ncand
+    assert all(match_cut['prob_this_match'] >= 0)
+    assert all(match_cut['prob_this_match'] <= 1)
+
+    assert len(match_cut) == len(match_parallel)
+    for col in match_cut.colnames:
+        assert np.all(match_cut[col] == match_parallel[col])
+
+def test_lr_auto_radius():
+    pcat, scat = set_catalogues()
+    kwargs = dict(MASK_KWARGS, prior_method='random', random_numrepeat=20, seed=1)
+    xm = LRMatch(pcat, scat)
+    match = xm.run(radius='auto', radius_nsigma=3, **kwargs)
+    radius = xm._search_radius
+
+    assert len(radius) == len(pcat)
+    assert radius.min() < radius.max()
+    assert all(match['prob_this_match'] >= 0)
+    assert all(match['prob_this_match'] <= 1)
+
+    # Candidates are those within the limit of each primary source
+    pidx, sidx, d2d = xm._candidates()
+    pidx_max, _, d2d_max = scat.index.search_around_sky(pcat.coords, radius.max())
+    assert np.all(d2d <= radius[pidx])
+    assert np.sum(d2d_max <= radius[pidx_max]) == len(pidx)
+
+    match_parallel = LRMatch(pcat, scat).run(
+        radius='auto', radius_nsigma=3, n_workers=2, **kwargs
+    )
+    assert len(match) == len(match_parallel)
+    for col in match.colnames:
+        assert np.all(match[col] == match_parallel[col])
+
+    with pytest.raises(ValueError):
+        LRMatch(pcat, scat).run(radius='large', **kwargs)
+
+def test_lr_update():
+    pcat, scat = set_catalogues()
+    nsources = len(pcat) // 2
+
+    # Frozen priors: same results as a match of all sources with these priors
+    xm = LRMatch(pcat[:nsources], scat)
+    xm.run(**MASK_KWARGS)
+    priors = xm._priors
+    match = xm.update(pcat[nsources:], max_qcap_drift=1.0)
+    expected = LRMatch(pcat, scat).run(priors=priors, **MASK_KWARGS)
+
+    assert xm._priors is priors
+    assert len(xm.pcat) == len(pcat)
+    assert len(match) == len(expected)
+    for col in expected.colnames:
+        assert np.all(match[col] == expected[col])
+        assert np.all(
+            np.ma.getmaskarray(match[col]) == np.ma.getmaskarray(expected[col])
+        )
+
+    assert len(xm.lr) == np.sum(expected['ncat'] == 2)
+
+    # Drift larger than allowed
+    xm = LRMatch(pcat[:nsources], scat)
+    xm.run(**MASK_KWARGS)
+    with pytest.raises(ValueError):
+        xm.update(pcat[nsources:], max_qcap_drift=0.0, on_drift='raise')
+
+    match = xm.update(pcat[nsources:], max_qcap_drift=0.0)
+    expected = LRMatch(pcat, scat).run(**MASK_KWARGS)
+
+    assert xm._priors is not priors
+    for col in expected.colnames:
+        assert np.all(match[col] == expected[col])
@@ -985,3 +985,29 @@ def test_offset():
     assert all(dra >= 0)
     assert all(ddec >= 0)
 
+
+def test_match_output(tmp_path):
+    from ..results import MatchFile
+
+    pcat, scat = set_catalogues_moc()
+
+    xm = Match(pcat, scat)
+    xm.run(
+        method='lr',
+        output=str(tmp_path / 'match.fits'),
+        chunk_rows=50,
+        prior_method='mask',
+        mags=[['uMag'], ['gMag']],
+        magmin=[[10.0], [10.0]],
+        magmax=[[30.0], [30.0]],
+        magbinsize=[[0.5], [0.5]],
+    )
+    assert isinstance(xm.results, MatchFile)
+    assert len(xm.results) >= len(xm._match.pcat)
+
+    matchs = xm.get_matchs(match_type='primary')
+    assert all(matchs['ncat'] > 1)
+    assert all(matchs['match_flag'] == 1)
+
+    with pytest.raises(ValueError):
+        xm.stats()
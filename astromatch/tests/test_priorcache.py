@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+from astropy import units as u
+
+from ..priorcache import PriorCache
+from ..priorsND import PriorND
+from .test_lr import set_catalogues
+
+
+def set_priors():
+    edges = [np.arange(10.0, 30.5, 0.5)]
+    good = np.linspace(0, 1, len(edges[0]) - 1)
+    prior_dict = {
+        'PRIOR0': {'good': good, 'field': good[::-1], 'edges': edges,
+                   'vol': 0.5, 'name': ['uMag']}
+    }
+
+    return PriorND(prior_dict=prior_dict, magmin=[[10.0]], magmax=[[30.0]],
+                   magbinsize=[[0.5]], mags=[['uMag']])
+
+def test_priorcache_key(tmp_path):
+    pcat, scat = set_catalogues()
+    cache = PriorCache(str(tmp_path))
+
+    key = cache.key(pcat, scat, radius=6*u.arcsec, mags=[['uMag']])
+
+    assert key == cache.key(pcat, scat, radius=6*u.arcsec, mags=[['uMag']])
+    assert key != cache.key(pcat, scat, radius=5*u.arcsec, mags=[['uMag']])
+    assert key != cache.key(pcat[1:], scat, radius=6*u.arcsec, mags=[['uMag']])
+    assert key != cache.key(pcat, scat[1:], radius=6*u.arcsec, mags=[['uMag']])
+
+    scat.poserr.add_syserr(1*u.arcsec)
+    assert key != cache.key(pcat, scat, radius=6*u.arcsec, mags=[['uMag']])
+
+def test_priorcache_get_put(tmp_path):
+    cache = PriorCache(str(tmp_path))
+    priors = set_priors()
+
+    assert cache.get('a') is None
+
+    cache.put('a', priors)
+    cached = cache.get('a')
+
+    assert 'a' in cache
+    assert cached.magnames == priors.magnames
+    for key in ['good', 'field']:
+        assert np.all(cached.prior_dict['PRIOR0'][key] == priors.prior_dict['PRIOR0'][key])
+    assert np.all(cached.prior_dict['PRIOR0']['edges'][0] == priors.prior_dict['PRIOR0']['edges'][0])
+
+    cache.clear()
+    assert len(cache) == 0
+
+def test_priorcache_evict(tmp_path):
+    cache = PriorCache(str(tmp_path))
+    priors = set_priors()
+
+    cache.put('a', priors)
+    cache.max_size = 2.5*cache.size
+    cache.put('b', priors)
+
+    # 'a' is used after 'b' was stored, so 'b' is evicted first
+    os.utime(cache._filename('b'), (0, 0))
+    cache.get('a')
+    cache.put('c', priors)
+
+    assert len(cache) == 2
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+    # The last entry is kept even if it does not fit
+    cache.max_size = 1*u.byte
+    cache.put('d', priors)
+
+    assert len(cache) == 1
+    assert 'd' in cache
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+from ..core import Match
+from ..profiling import StageProfile
+from .test_lr import MASK_KWARGS, set_catalogues
+
+
+def test_stage_profile(tmp_path):
+    records = []
+    profile = StageProfile(callback=records.append)
+
+    with profile.stage('outer', rows=np.int64(10)) as counts:
+        with profile.stage('inner'):
+            profile.count(pairs=3)
+
+        counts['groups'] = 2
+
+    profile.count(ignored=1)
+
+    assert len(profile) == 2
+    assert records == profile.records
+
+    inner, outer = profile.records
+    assert inner['stage'] == 'inner'
+    assert inner['depth'] == 1
+    assert inner['counts'] == {'pairs': 3}
+    assert outer['stage'] == 'outer'
+    assert outer['depth'] == 0
+    assert outer['counts'] == {'rows': 10, 'groups': 2}
+    assert outer['wall_time'] >= inner['wall_time'] >= 0
+
+    filename = str(tmp_path / 'profile.json')
+    profile.to_json(filename)
+    with open(filename) as fp:
+        data = json.load(fp)
+
+    assert [stage['stage'] for stage in data['stages']] == ['inner', 'outer']
+    assert data['stages'][1]['counts']['rows'] == 10
+
+    profile.clear()
+    assert len(profile) == 0
+
+def test_match_profile():
+    pcat, scat = set_catalogues()
+    kwargs = dict(MASK_KWARGS, prior_method='random', random_numrepeat=20)
+    xm = Match(pcat, scat)
+    match = xm.run(method='lr', **kwargs)
+    xm.stats()
+
+    stages = {record['stage']: record for record in xm.profile}
+    assert list(stages) == [
+        'apply_moc', 'candidates', 'priors', 'background',
+        'likelihood_ratio', 'final_table', 'run', 'stats',
+    ]
+
+    assert stages['run']['counts']['primary_sources'] == len(xm.catalogues[0])
+    assert stages['candidates']['counts']['pairs'] == np.sum(match['ncat'] == 2)
+    assert stages['priors']['counts']['random_positions'] > 0
+    assert stages['final_table']['counts']['rows'] == len(match)
+    assert stages['run']['wall_time'] >= stages['priors']['wall_time']
+
+    stages = json.loads(xm.profile.to_json())['stages']
+    assert len(stages) == len(xm.profile)
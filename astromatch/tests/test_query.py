@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import numpy as np
+from astropy import units as u
+
+from ..lr import LRMatch
+from ..query import LRQueryEngine
+from .test_lr import MASK_KWARGS, set_catalogues
+
+
+def run_match():
+    pcat, scat = set_catalogues()
+    xm = LRMatch(pcat, scat)
+    match = xm.run(**MASK_KWARGS)
+
+    return xm, match
+
+def query_args(pcat):
+    return (
+        pcat.coords.ra.deg,
+        pcat.coords.dec.deg,
+        pcat.poserr.as_array().to(u.arcsec),
+    )
+
+def test_query_match():
+    xm, match = run_match()
+    engine = LRQueryEngine.from_match(xm)
+
+    ra, dec, err = query_args(xm.pcat)
+    result = engine.match(ra, dec, err, ids=xm.pcat.ids)
+
+    assert result.colnames == match.colnames
+    assert len(result) == len(match)
+    for col in match.colnames:
+        assert np.all(result[col] == match[col])
+        assert np.all(
+            np.ma.getmaskarray(result[col]) == np.ma.getmaskarray(match[col])
+        )
+
+    # A single source
+    result = engine.match(ra[0], dec[0], err[0])
+    assert result['SRCID_pcat'][0] == '0'
+    assert len(result) == np.sum(match['SRCID_pcat'] == xm.pcat.ids[0])
+
+def test_query_priors_file(tmp_path):
+    xm, _ = run_match()
+    filename = str(tmp_path / 'priors.fits')
+    xm.priors.to_table().writeto(filename)
+
+    engine = LRQueryEngine(xm.scat, filename)
+    engine_match = LRQueryEngine.from_match(xm)
+
+    ra, dec, err = query_args(xm.pcat)
+    result = engine.match(ra, dec, err)
+    expected = engine_match.match(ra, dec, err)
+    for col in expected.colnames:
+        assert np.all(result[col] == expected[col])
+
+def test_query_serve():
+    xm, _ = run_match()
+    engine = LRQueryEngine.from_match(xm)
+    ra, dec, err = query_args(xm.pcat[:10])
+    expected = engine.match(ra, dec, err)
+
+    async def request(port, path, query, length=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = json.dumps(query).encode('utf8')
+        if length is None:
+            length = len(body)
+        else:
+            # Only the headers are sent
+            body = b''
+
+        writer.write(
+            'POST {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(path, length).encode('latin1')
+            + body
+        )
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+
+        header, _, content = response.partition(b'\r\n\r\n')
+        return header.split()[1], json.loads(content.decode('utf8'))
+
+    async def queries():
+        server = await asyncio.start_server(engine._handle_request, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        query = {'ra': list(ra), 'dec': list(dec), 'err': list(err.value)}
+        async with server:
+            return await asyncio.gather(
+                request(port, '/match', query),
+                request(port, '/match', query),
+                request(port, '/match', {'ra': [0.0]}),
+                request(port, '/other', query),
+                request(port, '/match', query, length=engine.max_body_size + 1),
+            )
+
+    responses = asyncio.run(queries())
+
+    for status, data in responses[:2]:
+        assert status == b'200'
+        assert list(data.keys()) == expected.colnames
+        assert np.allclose(
+            np.array(data['prob_this_match'], dtype=float),
+            expected['prob_this_match']
+        )
+        masked = np.ma.getmaskarray(expected['LR_BEST'])
+        assert all((value is None) == mask for value, mask in zip(data['LR_BEST'], masked))
+
+    assert responses[2][0] == b'400'
+    assert responses[3][0] == b'404'
+    assert responses[4][0] == b'413'
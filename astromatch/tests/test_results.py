@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from astropy.table import Table, Column, MaskedColumn
+
+from ..results import MatchFile, MatchWriter, write_table
+
+
+def set_match_table():
+    match = Table()
+    match['SRCID_pcat'] = Column(['a', 'b', 'b', 'c', 'c', 'c'], dtype='U4')
+    match['SRCID_scat'] = MaskedColumn(['', '', 'x1', '', 'x2', 'x3'],
+                                       mask=[True, True, False, True, False, False])
+    match['Separation_pcat_scat'] = MaskedColumn([0, 0, 1.5, 0, 2.0, 3.0], unit='arcsec',
+                                                 mask=[True, True, False, True, False, False])
+    match['ncat'] = [1, 1, 2, 1, 2, 2]
+    match['LR_BEST_MAG'] = MaskedColumn([b'', b'', b'P0', b'', b'P1', b'P0'],
+                                        mask=[True, True, False, True, False, False])
+    match['match_flag'] = [1, 0, 1, 0, 1, 2]
+    match['prob_this_match'] = [0.0, 0.0, 1.0, 0.0, np.nan, 0.4]
+    match.meta['QCAP'] = '[1.0, 0.5]'
+
+    return match
+
+def assert_tables_equal(table, other):
+    assert table.colnames == other.colnames
+    assert table.meta == other.meta
+
+    for name in table.colnames:
+        col, other_col = table[name], other[name]
+        assert type(col) is type(other_col)
+        assert col.dtype == other_col.dtype
+        assert col.unit == other_col.unit
+        assert np.all(np.ma.getmaskarray(col) == np.ma.getmaskarray(other_col))
+
+        mask = ~np.ma.getmaskarray(col)
+        assert np.array_equal(np.asarray(col)[mask], np.asarray(other_col)[mask],
+                              equal_nan=col.dtype.kind == 'f')
+
+@pytest.mark.parametrize('ext', ['fits', 'h5', 'parquet'])
+def test_match_writer(tmp_path, ext):
+    if ext == 'h5':
+        pytest.importorskip('h5py')
+    elif ext == 'parquet':
+        pytest.importorskip('pyarrow')
+
+    match = set_match_table()
+    path = str(tmp_path / 'match.{}'.format(ext))
+
+    with MatchWriter(path) as writer:
+        for start in range(0, len(match), 4):
+            writer.write(match[start:start + 4])
+
+    results = writer.close()
+
+    assert isinstance(results, MatchFile)
+    assert len(results) == len(match)
+    assert_tables_equal(results.read(), match)
+    assert_tables_equal(results.read(columns=['ncat', 'SRCID_scat']),
+                        match['ncat', 'SRCID_scat'])
+
+    for match_type in ['all', 'primary', 'primary_all']:
+        matchs = results.get_matchs(match_type)
+
+        if match_type == 'primary_all':
+            mask = match['match_flag'] == 1
+        else:
+            mask = match['ncat'] > 1
+            if match_type == 'primary':
+                mask &= match['match_flag'] == 1
+
+        assert_tables_equal(matchs, match[mask])
+
+    with pytest.raises(ValueError):
+        results.get_matchs('best')
+
+@pytest.mark.parametrize('ext', ['fits', 'h5', 'parquet'])
+def test_match_writer_masked_int(tmp_path, ext):
+    if ext == 'h5':
+        pytest.importorskip('h5py')
+    elif ext == 'parquet':
+        pytest.importorskip('pyarrow')
+
+    match = set_match_table()
+    mask = np.ma.getmaskarray(match['SRCID_scat'])
+    match['nfake'] = MaskedColumn([0, 0, 3, 0, 0, 1], mask=mask)
+    match['is_fake'] = MaskedColumn([False, False, True, False, False, True], mask=mask)
+
+    path = str(tmp_path / 'match.{}'.format(ext))
+    results = write_table(match, path, chunk_rows=4)
+
+    assert results.colnames == match.colnames
+    assert_tables_equal(results.read(), match)
+    assert_tables_equal(results.read(columns=['is_fake', 'ncat']),
+                        match['is_fake', 'ncat'])
+
+def test_match_writer_fits_astropy(tmp_path):
+    match = set_match_table()
+    path = str(tmp_path / 'match.fits')
+    write_table(match, path, chunk_rows=4)
+
+    # The file is a standard FITS table
+    table = Table.read(path)
+    assert len(table) == len(match)
+    assert all(table['ncat'] == match['ncat'])
+    assert all(table['SRCID_scat'][2:3] == ['x1'])
+
+def test_match_writer_errors(tmp_path):
+    match = set_match_table()
+
+    with pytest.raises(ValueError):
+        MatchWriter(str(tmp_path / 'match.txt'))
+
+    with pytest.raises(ValueError):
+        with MatchWriter(str(tmp_path / 'match.fits')) as writer:
+            writer.write(match[:2])
+
+            # Wider strings than in the first chunk
+            other = match[2:]
+            other['SRCID_pcat'] = other['SRCID_pcat'].astype('U10')
+            other['SRCID_pcat'][0] = 'longsrcid'
+            writer.write(other)
@@ -0,0 +1,39 @@
+import numpy as np
+from astropy.table import Table
+
+from ..segments import Segments
+
+
+def test_segments():
+    labels = np.array([3, 3, 0, 5, 5, 5, 1])
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+
+    segments = Segments(labels)
+
+    assert len(segments) == 4
+    assert all(segments.labels == [3, 0, 5, 1])
+    assert all(segments.sizes == [2, 1, 3, 1])
+    assert all(segments.sum(values) == [3.0, 3.0, 15.0, 7.0])
+    assert all(segments.max(values) == [2.0, 3.0, 6.0, 7.0])
+    assert all(segments.prod(values) == [2.0, 3.0, 120.0, 7.0])
+    assert all(segments.broadcast(segments.sum(values)) == [3, 3, 3, 15, 15, 15, 7])
+
+def test_segments_group():
+    table = Table()
+    table['id'] = ['b', 'a', 'c', 'a', 'b']
+    table['value'] = [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    sorter, segments = Segments.group(table['id'])
+    grouped = table.group_by('id')
+
+    assert all(table[sorter]['value'] == grouped['value'])
+    assert all(segments.offsets == grouped.groups.indices)
+    assert all(segments.sum(table['value'][sorter]) ==
+               grouped['value'].groups.aggregate(np.sum))
+
+def test_segments_empty():
+    segments = Segments([])
+
+    assert len(segments) == 0
+    assert segments.sum(np.array([])).shape == (0,)
+    assert segments.broadcast(np.array([])).shape == (0,)
@@ -441,4 +441,68 @@ def test_transform_to_bad():
     with pytest.raises(ValueError):
         errs.transform_to(errtype='foo')
     
-    
\ No newline at end of file
+    
+def test_getitem():
+    n = 10
+    errdata = Table()
+    errdata['ERRA'] = np.arange(1, n + 1) * u.arcsec
+    errdata['ERRB'] = np.arange(1, n + 1) * u.arcmin
+    errdata['PA'] = np.linspace(0, 90, n) * u.deg
+
+    errs = SkyCoordErr(errdata, errtype='ellipse')
+    cov = errs.covariance_matrix()
+    values = errs.as_array()
+
+    for key in [3, -1, slice(2, 8, 2), [4, 1, 1], errdata['ERRA'] > 5*u.arcsec]:
+        item = errs[key]
+        rows = np.arange(n)[key]
+
+        assert len(item) == np.size(rows)
+        assert item.errtype == errs.errtype
+        assert item.components.colnames == errs.components.colnames
+        assert np.all(item.as_array() == values[:, rows].reshape(3, -1))
+        assert np.all(item.covariance_matrix() == cov[rows].reshape(-1, 2, 2))
+
+def test_components_units():
+    n = 10
+    errdata = Table()
+    errdata['ERRA'] = np.array([0.1]*n) * u.deg
+    errdata['ERRB'] = np.array([0.1]*n) * u.deg
+    errdata['COV'] = np.array([2.0]*n) * u.arcmin**2
+
+    errs = SkyCoordErr(errdata, errtype='cov_ellipse')
+    components = errs.components
+
+    assert np.allclose(components['ERRA'], 360.0)
+    assert np.allclose(components['COV'], 7200.0)
+
+def test_add_syserr():
+    n = 10
+    errdata = Table()
+    errdata['RADECERR'] = np.array([3.0]*n) * u.arcsec
+
+    errs = SkyCoordErr(errdata, errtype='circle')
+    first = errs[:5]
+    errs.covariance_matrix()
+    errs.add_syserr(4*u.arcsec)
+
+    assert np.allclose(errs.as_array(), 5*u.arcsec)
+    assert np.allclose(errs.covariance_matrix()[:, 0, 0], 25)
+    assert np.allclose(first.as_array(), 3*u.arcsec)
+
+def test_covariance_array():
+    n = 10
+    errdata = Table()
+    errdata['ERRA'] = np.array([0.1]*n) * u.arcsec
+    errdata['ERRB'] = np.array([0.3]*n) * u.arcsec
+    errdata['PA'] = np.linspace(0, 90, n) * u.deg
+
+    errs = SkyCoordErr(errdata, errtype='ellipse')
+    cov = errs.covariance_array()
+    V = errs.covariance_matrix()
+
+    assert cov.shape == (n, 3)
+    assert cov.unit == u.arcsec**2
+    assert np.allclose(cov[:, 0].value, V[:, 0, 0])
+    assert np.allclose(cov[:, 1].value, V[:, 1, 1])
+    assert np.allclose(cov[:, 2].value, V[:, 0, 1])
@@ -0,0 +1,197 @@
+import tracemalloc
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io.fits.verify import VerifyWarning
+from astropy.utils.data import get_pkg_data_filename
+
+from ..catalogues import Catalogue
+from ..spatial import SpatialIndex
+
+
+def set_catalogues():
+    area = 0.8393 * u.deg**2
+
+    pcat_datafile = get_pkg_data_filename('data/testcat_moc_1.fits')
+    pcat = Catalogue(pcat_datafile, area=area, name='pcat')
+
+    scat_datafile = get_pkg_data_filename('data/testcat_3.fits')
+    scat = Catalogue(scat_datafile, area=area, name='scat',
+                     coord_cols=['RA', 'DEC'], poserr_cols=['raErr', 'decErr'],
+                     poserr_type='rcd_dec_ellipse', mag_cols=['uMag', 'gMag'])
+
+    return pcat, scat
+
+def test_search_around_sky():
+    pcat, scat = set_catalogues()
+
+    for radius in [1*u.arcsec, 6*u.arcsec, 1*u.arcmin]:
+        pidx, sidx, d2d, _ = scat.coords.search_around_sky(pcat.coords, radius)
+        pidx_idx, sidx_idx, d2d_idx = scat.index.search_around_sky(pcat.coords, radius)
+
+        assert set(zip(pidx, sidx)) == set(zip(pidx_idx, sidx_idx))
+        assert all(np.diff(pidx_idx) >= 0)
+
+        sorter = np.lexsort((sidx, pidx))
+        assert np.allclose(d2d[sorter].arcsec, d2d_idx.arcsec)
+
+def test_search_around_sky_rings():
+    pcat, scat = set_catalogues()
+
+    # Force searches in several rings of neighbouring pixels
+    index = scat.index
+    index.MIN_PIXEL_SOURCES = 0
+
+    for radius in [10*u.arcsec, 1*u.arcmin, 5*u.arcmin]:
+        assert index._nrings(radius, index.query_order(radius)) > 1
+
+        pidx, sidx, _, _ = scat.coords.search_around_sky(pcat.coords, radius)
+        pidx_idx, sidx_idx, _ = index.search_around_sky(pcat.coords, radius)
+
+        assert set(zip(pidx, sidx)) == set(zip(pidx_idx, sidx_idx))
+
+def test_search_around_sky_empty():
+    pcat, scat = set_catalogues()
+
+    pidx, sidx, d2d = scat.index.search_around_sky(pcat.coords[:0], 5*u.arcsec)
+
+    assert len(pidx) == len(sidx) == len(d2d) == 0
+    assert not scat.index.near_mask(pcat.coords[:0], 5*u.arcsec).any()
+
+def test_near_mask():
+    pcat, scat = set_catalogues()
+
+    for radius in [6*u.arcsec, 1*u.arcmin]:
+        _, sidx, _ = scat.index.search_around_sky(pcat.coords, radius)
+        mask = scat.index.near_mask(pcat.coords, radius)
+
+        assert np.all(np.flatnonzero(mask) == np.unique(sidx))
+
+def test_search_around_sky_radius_array():
+    pcat, scat = set_catalogues()
+
+    radius = np.linspace(1, 20, len(pcat)) * u.arcsec
+    pidx, sidx, d2d = scat.index.search_around_sky(pcat.coords, radius)
+
+    assert all(d2d <= radius[pidx])
+
+def test_save_load(tmpdir):
+    _, scat = set_catalogues()
+
+    filename = str(tmpdir.join('index.fits'))
+    with warnings.catch_warnings():
+        # Header cards must fit in FITS records
+        warnings.simplefilter('error', VerifyWarning)
+        index = scat.build_index(filename=filename, order=16)
+
+    for memmap in [True, False]:
+        newindex = SpatialIndex.load(filename, memmap=memmap)
+
+        assert len(newindex) == len(index)
+        assert newindex.order == index.order
+        assert newindex.fingerprint == index.fingerprint
+
+    scat.set_index(filename)
+    pidx, sidx, _ = scat.index.search_around_sky(scat.coords[:10], 5*u.arcsec)
+
+    assert all(np.isin(np.arange(10), pidx))
+
+def test_memmap(tmpdir, monkeypatch):
+    pcat, scat = set_catalogues()
+
+    filename = str(tmpdir.join('index.fits'))
+    scat.build_index(filename=filename)
+
+    # Binary searches within the memory-mapped index
+    # between the elements of the in-memory sample
+    monkeypatch.setattr(SpatialIndex, 'SAMPLE_STEP', 7)
+    index = SpatialIndex.load(filename, memmap=True)
+    assert index._pix_sample is not None
+    assert not index._xyz.flags.owndata
+
+    for radius in [6*u.arcsec, 1*u.arcmin]:
+        pairs = scat.index.search_around_sky(pcat.coords, radius)
+        pairs_memmap = index.search_around_sky(pcat.coords, radius)
+
+        for x, y in zip(pairs, pairs_memmap):
+            assert np.all(x == y)
+
+def test_set_index_fingerprint(tmpdir):
+    _, scat = set_catalogues()
+
+    filename = str(tmpdir.join('index.fits'))
+    scat.build_index(filename=filename)
+
+    # Same number of sources, different positions
+    _, other = set_catalogues()
+    other.coords = SkyCoord(other.coords.ra, other.coords.dec + 1*u.arcsec)
+
+    with pytest.raises(ValueError):
+        other.set_index(filename)
+
+def test_index_reset():
+    _, scat = set_catalogues()
+
+    index = scat.index
+    assert scat.index is index
+
+    subcat = scat[:10]
+    assert len(subcat.index) == 10
+
+def test_search_around_sky_max_memory():
+    pcat, scat = set_catalogues()
+
+    pidx, sidx, d2d = scat.index.search_around_sky(pcat.coords, 6*u.arcsec)
+    pidx_tiled, sidx_tiled, d2d_tiled = scat.index.search_around_sky(
+        pcat.coords, 6*u.arcsec, max_memory=10*u.kB
+    )
+
+    assert np.all(pidx == pidx_tiled)
+    assert np.all(sidx == sidx_tiled)
+    assert np.all(d2d == d2d_tiled)
+
+    nbatches = len(list(scat.index.iter_search_around_sky(
+        pcat.coords, 6*u.arcsec, max_memory=10*u.kB
+    )))
+    assert nbatches > 1
+
+def test_search_around_sky_split_positions():
+    pcat, scat = set_catalogues()
+
+    # Radius too large for any HEALPix order: all sources are candidates
+    # and each position is searched in several batches
+    radius = 150*u.deg
+    assert scat.index.query_order(radius) is None
+
+    pairs = scat.index.search_around_sky(pcat.coords[:5], radius)
+    pairs_split = scat.index.search_around_sky(
+        pcat.coords[:5], radius, max_memory=2*u.kB
+    )
+    for x, y in zip(pairs, pairs_split):
+        assert np.all(x == y)
+
+    nbatches = len(list(scat.index.iter_search_around_sky(
+        pcat.coords[:5], radius, max_memory=2*u.kB
+    )))
+    assert nbatches > 5*len(scat)*SpatialIndex.BYTES_PER_CANDIDATE // 2000
+
+def test_search_around_sky_peak_memory():
+    rng = np.random.RandomState(5)
+    coords = SkyCoord(rng.uniform(0, 0.5, 100000), rng.uniform(0, 0.5, 100000), unit='deg')
+    search = SkyCoord(rng.uniform(0, 0.5, 5000), rng.uniform(0, 0.5, 5000), unit='deg')
+    index = SpatialIndex(coords)
+
+    for radius in [6*u.arcsec, 1*u.arcmin]:
+        for max_memory in [1*u.MB, 4*u.MB]:
+            tracemalloc.start()
+            for i, j, d in index.iter_search_around_sky(search, radius, max_memory):
+                del i, j, d
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # Temporary arrays plus arrays with an element per position
+            assert peak < 1.25 * max_memory.to_value(u.byte) + 64*len(search)
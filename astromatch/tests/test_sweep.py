@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from ..sweep import ThresholdSweep, cutoff_grid
+
+
+def test_threshold_sweep():
+    rng = np.random.default_rng(0)
+    values = np.round(rng.random(500), 2)
+    values[::50] = np.nan
+    weights = rng.random(500)
+    cutoffs = np.linspace(-0.1, 1.1, 25)
+
+    sweep = ThresholdSweep(values)
+
+    above = [np.count_nonzero(values > c) for c in cutoffs]
+    below = [np.count_nonzero(values <= c) for c in cutoffs]
+    assert all(sweep.above(cutoffs) == above)
+    assert all(sweep.below(cutoffs) == below)
+
+    above = [np.sum(weights[values > c]) for c in cutoffs]
+    below = [np.sum(weights[values <= c]) for c in cutoffs]
+    assert np.allclose(sweep.above(cutoffs, weights), above)
+    assert np.allclose(sweep.below(cutoffs, weights), below)
+
+def test_threshold_sweep_masked():
+    values = np.ma.masked_array([0.5, 2.0, 1.0, 3.0], mask=[False, True, False, False])
+    sweep = ThresholdSweep(values)
+
+    assert all(sweep.above([0.0, 1.0, 2.5]) == [3, 1, 1])
+    assert all(sweep.below([0.0, 1.0, 2.5]) == [0, 2, 2])
+    assert all(sweep.above([0.0, 1.0], [True, True, False, True]) == [2, 1])
+
+def test_cutoff_grid():
+    assert np.allclose(cutoff_grid(5, 0, 1), [0, 0.25, 0.5, 0.75, 1])
+
+    values = np.array([0.3, 0.1, 0.3, 5.0, np.nan, -1.0])
+    assert all(cutoff_grid('unique', 0.0, 1.0, values) == [0.0, 0.1, 0.3])
+
+    with pytest.raises(ValueError):
+        cutoff_grid('all', 0.0, 1.0, values)
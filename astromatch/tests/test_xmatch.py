@@ -1,5 +1,8 @@
-import pytest
+import warnings
 
+import numpy as np
+import pytest
+from astropy.table import Table
 from astropy.utils.data import get_pkg_data_filename
 
 from ..catalogues import Catalogue
@@ -49,3 +52,47 @@ def test_xmatch_mags():
     assert all(match['p_single'] >= 0)
     assert all(match['p_single'] <= 1)
     assert any(match['p_single'] != match['dist_post'])
+
+def _group_by_pi_flags(match, prob_ratio_secondary):
+    # Relative probabilities and match flags using Table.group_by
+    match = match.group_by('SRCID_pcat')
+    group_size = np.diff(match.groups.indices)
+
+    psum = np.repeat(match['p_single'].groups.aggregate(np.sum), group_size)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        match['prob_this_match'] = match['p_single']/psum
+    match['prob_this_match'][match['ncat'] == 1] = 0
+
+    match['match_flag'] = 0
+    pi_max = match['prob_this_match'].groups.aggregate(np.max)
+    pi_max = np.repeat(pi_max, group_size)
+
+    mask = match['prob_this_match'] == pi_max
+    match['match_flag'][mask] = 1
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mask2 = match['prob_this_match']/pi_max > prob_ratio_secondary
+    match['match_flag'][np.logical_and(~mask, mask2)] = 2
+
+    return match
+
+def test_xmatch_pi_flags():
+    pcat, scat = set_catalogues()
+    xm = XMatch(pcat, scat)
+
+    match = Table()
+    match['SRCID_pcat'] = ['b', 'a', 'b', 'c', 'a', 'b', 'c', 'd', 'b']
+    match['ncat'] = [2, 2, 1, 2, 1, 2, 1, 1, 2]
+    match['p_single'] = [0.3, 0.6, 0.1, 0.2, 0.0, 0.25, 0.05, 0.0, 0.3]
+
+    expected = _group_by_pi_flags(match.copy(), prob_ratio_secondary=0.5)
+
+    match, segments = xm._calc_pi(match)
+    match = xm._add_match_flags(match, segments, prob_ratio_secondary=0.5)
+
+    assert len(segments) == 4
+    assert np.all(match['SRCID_pcat'] == expected['SRCID_pcat'])
+    assert np.all(match['p_single'] == expected['p_single'])
+    assert np.allclose(match['prob_this_match'], expected['prob_this_match'])
+    assert np.all(match['match_flag'] == expected['match_flag'])
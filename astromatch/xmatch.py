@@ -44,11 +44,13 @@ import numpy as np
 import requests
 from astropy import log
 from astropy import units as u
-from astropy.table import Table, Column, join, unique, vstack
+from astropy.table import Table, Column, unique, vstack
 from nwaylib.magnitudeweights import fitfunc_histogram
 
 from .priors import Prior
 from .match import BaseMatch
+from .profiling import profiled
+from .segments import Segments
 
 # dictionary for storing xmatch user/passwd used during the session
 _passwd_dict_xms = {}
@@ -267,6 +269,7 @@ class XMatch(BaseMatch):
             return self._match_raw
 
     ### Public Methods
+    @profiled()
     def run(self, use_mags=False, xmatchserver_user=None, **kwargs):
         """
         Perform the cross-matching between the defined catalogues.
@@ -293,15 +296,28 @@ class XMatch(BaseMatch):
         prob_ratio_secondary = kwargs.pop('prob_ratio_secondary', 0.5)
         kwargs_prior, kwargs_run = self.parse_args(kwargs)
 
-        self._match_raw = self._xmatch(xmatchserver_user, **kwargs_run)
+        profile = self.profile
+        profile.count(
+            primary_sources=len(self.pcat),
+            secondary_sources=sum(len(cat) for cat in self.scats),
+        )
+
+        with profile.stage('xmatch') as counts:
+            self._match_raw = self._xmatch(xmatchserver_user, **kwargs_run)
+            counts['rows'] = len(self._match_raw)
 
         # match_file = 'tmp_match.fits'
         # self._match_raw = Table.read(match_file)
 
         if use_mags:
-            self._priors = self._calc_priors(**kwargs_prior)
+            with profile.stage('priors'):
+                self._priors = self._calc_priors(**kwargs_prior)
 
-        return self._final_table(self._match_raw, prob_ratio_secondary)
+        with profile.stage('final_table') as counts:
+            match = self._final_table(self._match_raw, prob_ratio_secondary)
+            counts['rows'] = len(match)
+
+        return match
 
     # def stats_rndmatch(self, match, match_rnd, ncutoff=101, plot_to_file=None):
     #     """
@@ -414,11 +430,11 @@ class XMatch(BaseMatch):
 
         match = self._calc_psingle(match)
 
-        match = self._calc_pi(match)
+        match, segments = self._calc_pi(match)
         #match = self._calc_pany_pi(match)
 
         log.info('Flagging and sorting final results...')
-        match = self._add_match_flags(match, prob_ratio_secondary)
+        match = self._add_match_flags(match, segments, prob_ratio_secondary)
 
         match = self._sort(match)
 
@@ -622,17 +638,14 @@ class XMatch(BaseMatch):
 
     def _add_magbias(self, match):
         total_bias = np.zeros(len(match))
-        match['SIDX'] = np.arange(len(match))
 
         for cat in self.scats:
             match_idcol = 'SRCID_{}'.format(cat.name)
             prior = self._priors[cat.name].to_nway_hists()
 
-            match_withcat = unique(match, keys=match_idcol)
-            match_withcat = [row[match_idcol] for row in match_withcat
-                             if not row[match_idcol].isspace()]
-
-            cat_withmatch = cat.select_by_id(match_withcat)
+            # Rows in cat of the counterparts (-1 for rows with no counterpart)
+            rows = cat.rows_by_id(match[match_idcol])
+            has_cat = rows >= 0
 
             for i, magcol in enumerate(cat.mags.colnames):
                 # using nway implementation for this
@@ -640,17 +653,12 @@ class XMatch(BaseMatch):
                 bins = np.concatenate((hist[0], [hist[1][-1]]))
                 func = fitfunc_histogram(bins, hist[2], hist[3])
 
-                weights = np.log10(func(cat_withmatch.mags[magcol]))
+                weights = np.log10(func(cat.mags[magcol][rows[has_cat]]))
                 weights[np.isnan(weights)] = 0 # undefined magnitudes do not contribute
 
-                magbias = Table()
-                magbias[match_idcol] = cat_withmatch.ids
                 magbias_col = 'log_bias_{}'.format(magcol)
-                magbias[magbias_col] = weights
-
-                match = join(match, magbias, keys=match_idcol, join_type='left')
-                match[magbias_col][match[magbias_col].mask] = 0.0
-                match.sort('SIDX')
+                match[magbias_col] = 0.0
+                match[magbias_col][has_cat] = np.ma.filled(weights, 0.0)
 
                 total_bias += match[magbias_col]
 
@@ -663,27 +671,26 @@ class XMatch(BaseMatch):
         mask = np.isneginf(total_bias)
         match['p_single'][mask] = 0.0
 
-        match.remove_column('SIDX')
-
         return match
 
     def _calc_pi(self, match):
         ## Estimate relative probabilities for different
         ## matchs of a single primary source
-        # Group match by primary sources
+        # Group match by primary sources. The segments of each primary
+        # source are returned for reusing them when flagging the matchs.
         pidcol = 'SRCID_{}'.format(self.pcat.name)
-        match = match.group_by(pidcol)
-        group_size = np.diff(match.groups.indices)
+        sorter, segments = Segments.group(match[pidcol])
+        match = match[sorter]
 
         # For each primary source, find the sum of posterior probabilities
-        psum = match['p_single'].groups.aggregate(np.sum)
+        psum = segments.sum(match['p_single'])
 
         # The previous array has a length equal to the number of groups.
         # We need to rebuild the array having the same length as the
         # original table for using element-wise operations. We repeat
         # each element of psum as many times as the size of the
         # corresponding group
-        psum = np.repeat(psum, group_size)
+        psum = segments.broadcast(psum)
 
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", category=RuntimeWarning)
@@ -692,7 +699,7 @@ class XMatch(BaseMatch):
         mask = match['ncat'] == 1
         match['prob_this_match'][mask] = 0 # Set p_i to zero for no match rows
 
-        return match
+        return match, segments
 
     def _calc_pany_pi(self, match):
         # Group match by primary sources
@@ -726,26 +733,25 @@ class XMatch(BaseMatch):
 
         return match
 
-    def _add_match_flags(self, match, prob_ratio_secondary):
+    def _add_match_flags(self, match, segments, prob_ratio_secondary):
         ## Add match_flag column, default value to zero
         #idx_flag = match.colnames.index('prob_has_match')
         idx_flag = match.colnames.index('prob_this_match')
         col_flag = Column(name='match_flag', data=[0]*len(match))
         match.add_column(col_flag, index=idx_flag)
 
-        pcat_idcol = 'SRCID_{}'.format(self.pcat.name)
-        match = match.group_by(pcat_idcol)
-        group_size = np.diff(match.groups.indices)
+        # The match table is already grouped by primary
+        # source (see _calc_pi), as given by segments
 
         ## For each primary source, find the match with maximum p_i
-        pi_max = match['prob_this_match'].groups.aggregate(np.max)
+        pi_max = segments.max(match['prob_this_match'])
 
         # The previous array has a length equal to the number of groups.
         # We need to rebuild the array having the same length as the
         # original table for using element-wise operations. We repeat
         # each element of sumlr as many times as the size of the
         # corresponding group
-        pi_max = np.repeat(pi_max, group_size)
+        pi_max = segments.broadcast(pi_max)
 
         mask = match['prob_this_match'] == pi_max
         match['match_flag'][mask] = 1
@@ -790,13 +796,15 @@ class XMatch(BaseMatch):
 
         return match[~mask]
 
-    def _match_rndcat(self, xmatchserver_user=None, **kwargs):
+    @profiled('random_match')
+    def _match_rndcat(self, xmatchserver_user=None, seed=None, **kwargs):
         # Cross-match secondary catalogue with a randomized
         # version of the primary catalogue
         xm_rnd = XMatch(
-            self.pcat.randomise(numrepeat=1),
+            self.pcat.randomise(numrepeat=1, seed=seed),
             *self.scats
         )
+        xm_rnd.profile = self.profile
 
         if self._priors:
             use_mags = True